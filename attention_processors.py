@@ -0,0 +1,201 @@
+"""
+Attention processors for the IC-Light UNet
+"""
+
+import math
+import threading
+from contextlib import contextmanager
+
+import torch
+import torch.nn.functional as F
+from diffusers.models.attention_processor import AttnProcessor2_0
+
+_kv_cache = threading.local()
+_token_merging = threading.local()
+
+
+@contextmanager
+def cross_attention_kv_cache(cache):
+    """Let UNet calls on this thread reuse cross-attention keys and values stored in cache (a dict)"""
+    previous = getattr(_kv_cache, 'cache', None)
+    _kv_cache.cache = cache
+    try:
+        yield cache
+    finally:
+        _kv_cache.cache = previous
+
+
+@contextmanager
+def token_merging(ratio, latent_height, latent_width, max_downsample=1):
+    """
+    Let UNet calls on this thread merge a ratio of self-attention tokens (ToMe)
+    Only layers at most max_downsample times below the latent resolution merge,
+    latent_height and latent_width are the size of the UNet input.
+    """
+    previous = getattr(_token_merging, 'state', None)
+    _token_merging.state = (ratio, latent_height, latent_width, max_downsample) if ratio > 0 else None
+    try:
+        yield
+    finally:
+        _token_merging.state = previous
+
+
+def _identity(x):
+    return x
+
+
+def bipartite_soft_matching_2d(metric, width, height, r, stride=2):
+    """
+    ToMe bipartite soft matching over a (height, width) token grid (Bolya et al.)
+
+    The top-left token of every stride x stride cell is a destination, the others are
+    sources. The r sources most similar (cosine) to their best destination are averaged
+    into it. Returns merge and unmerge functions for (B, N, C) tensors laid out like metric,
+    unmerge copies each merged token back to all of its sources.
+    """
+    batch, tokens, _ = metric.shape
+    if r <= 0:
+        return _identity, _identity
+
+    with torch.no_grad():
+        cells_y, cells_x = height // stride, width // stride
+        # 0 marks sources, -1 destinations, so argsort puts the destinations first
+        cell = torch.zeros(cells_y, cells_x, stride * stride, device=metric.device, dtype=torch.int64)
+        cell[..., 0] = -1
+        cell = cell.view(cells_y, cells_x, stride, stride).transpose(1, 2).reshape(cells_y * stride, cells_x * stride)
+        grid = torch.zeros(height, width, device=metric.device, dtype=torch.int64)
+        grid[:cells_y * stride, :cells_x * stride] = cell
+        order = grid.reshape(1, -1, 1).argsort(dim=1)
+        num_dst = cells_y * cells_x
+        src_order, dst_order = order[:, num_dst:, :], order[:, :num_dst, :]
+
+        def split(x):
+            channels = x.shape[-1]
+            src = x.gather(1, src_order.expand(x.shape[0], tokens - num_dst, channels))
+            dst = x.gather(1, dst_order.expand(x.shape[0], num_dst, channels))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        src, dst = split(metric)
+        scores = src @ dst.transpose(-1, -2)
+        r = min(src.shape[1], r)
+        best_score, best_dst = scores.max(dim=-1)
+        ranked = best_score.argsort(dim=-1, descending=True)[..., None]
+        kept_idx = ranked[..., r:, :]
+        merged_idx = ranked[..., :r, :]
+        merged_dst = best_dst[..., None].gather(-2, merged_idx)
+
+    def merge(x):
+        src, dst = split(x)
+        channels = x.shape[-1]
+        kept = src.gather(-2, kept_idx.expand(batch, src.shape[1] - r, channels))
+        src = src.gather(-2, merged_idx.expand(batch, r, channels))
+        dst = dst.scatter_reduce(-2, merged_dst.expand(batch, r, channels), src, reduce='mean')
+        return torch.cat([kept, dst], dim=1)
+
+    def unmerge(x):
+        num_kept = kept_idx.shape[1]
+        kept, dst = x[..., :num_kept, :], x[..., num_kept:, :]
+        channels = x.shape[-1]
+        src = dst.gather(-2, merged_dst.expand(batch, r, channels))
+        out = torch.empty(batch, tokens, channels, device=x.device, dtype=x.dtype)
+        out.scatter_(-2, dst_order.expand(batch, num_dst, channels), dst)
+        src_positions = src_order.expand(batch, tokens - num_dst, 1)
+        out.scatter_(-2, src_positions.gather(1, kept_idx).expand(batch, num_kept, channels), kept)
+        out.scatter_(-2, src_positions.gather(1, merged_idx).expand(batch, r, channels), src)
+        return out
+
+    return merge, unmerge
+
+
+class CachedKVAttnProcessor2_0(AttnProcessor2_0):
+    """
+    AttnProcessor2_0 that projects cross-attention keys and values once
+
+    The text embeddings are the same tensor at every denoising step, so while a cache
+    is active each layer's projections are stored against that tensor and reused.
+    Self-attention, and any call without an active cache, runs AttnProcessor2_0 unchanged.
+    """
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None,
+                 *args, **kwargs):
+        cache = getattr(_kv_cache, 'cache', None)
+        if (cache is None or encoder_hidden_states is None
+                or attn.spatial_norm is not None or attn.group_norm is not None):
+            return super().__call__(attn, hidden_states, encoder_hidden_states, attention_mask, temb,
+                                    *args, **kwargs)
+
+        residual = hidden_states
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size, sequence_length, _ = encoder_hidden_states.shape
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        entry = cache.get(attn)
+        if entry is None or entry[0] is not encoder_hidden_states:
+            context = encoder_hidden_states
+            if attn.norm_cross:
+                context = attn.norm_encoder_hidden_states(context)
+            key = attn.to_k(context)
+            value = attn.to_v(context)
+            head_dim = key.shape[-1] // attn.heads
+            key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+            value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+            entry = cache[attn] = (encoder_hidden_states, key, value)
+        _, key, value = entry
+        head_dim = key.shape[-1]
+
+        query = attn.to_q(hidden_states)
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        hidden_states = F.scaled_dot_product_attention(
+            query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+        )
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        # linear proj and dropout
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+class TokenMergingAttnProcessor2_0(CachedKVAttnProcessor2_0):
+    """
+    CachedKVAttnProcessor2_0 that merges redundant self-attention tokens (ToMe)
+
+    While token_merging is active, self-attention in the highest-resolution layers runs
+    on the tokens left after bipartite soft matching and the result is unmerged back
+    to the full sequence, cutting the quadratic attention cost. Cross-attention and
+    calls outside token_merging run CachedKVAttnProcessor2_0 unchanged.
+    """
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None,
+                 *args, **kwargs):
+        state = getattr(_token_merging, 'state', None)
+        if state is None or encoder_hidden_states is not None or hidden_states.ndim != 3:
+            return super().__call__(attn, hidden_states, encoder_hidden_states, attention_mask, temb,
+                                    *args, **kwargs)
+
+        ratio, latent_height, latent_width, max_downsample = state
+        tokens = hidden_states.shape[1]
+        downsample = int(math.ceil(math.sqrt(latent_height * latent_width / tokens)))
+        if downsample > max_downsample:
+            return super().__call__(attn, hidden_states, encoder_hidden_states, attention_mask, temb,
+                                    *args, **kwargs)
+
+        merge, unmerge = bipartite_soft_matching_2d(
+            hidden_states, math.ceil(latent_width / downsample), math.ceil(latent_height / downsample),
+            int(tokens * ratio))
+        hidden_states = super().__call__(attn, merge(hidden_states), None, attention_mask, temb, *args, **kwargs)
+        return unmerge(hidden_states)
@@ -0,0 +1,86 @@
+"""
+Benchmark DeepCache-style step feature caching: speedup and drift
+Relights one image through the handler at each step cache interval and compares it to
+the uncached result (PSNR). By default tiny random models with an SD-like three-level UNet
+run on CPU, --pretrained uses the real models.
+
+Usage: python benchmark_deepcache.py [--intervals 1 2 3 5] [--steps 20] [--runs 2] [--pretrained]
+"""
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+
+def tiny_components():
+    from diffusers import UNet2DConditionModel
+    from conftest import make_tiny_components
+
+    components = make_tiny_components(tempfile.mkdtemp())
+    torch.manual_seed(0)
+    components['unet'] = UNet2DConditionModel(
+        sample_size=32, in_channels=4, out_channels=4, layers_per_block=2,
+        block_out_channels=(32, 64, 128), norm_num_groups=16,
+        down_block_types=("CrossAttnDownBlock2D", "CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32, attention_head_dim=8,
+    )
+    return components
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--intervals', type=int, nargs='*', default=[1, 2, 3, 5])
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=2)
+    parser.add_argument('--pretrained', action='store_true')
+    parser.add_argument('--image', default='imgs/i1.webp')
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--height', type=int, default=640)
+    parser.add_argument('--highres_scale', type=float, default=1.0)
+    args = parser.parse_args()
+
+    import rp_handler
+
+    if args.pretrained:
+        rp_handler.initialize_models()
+    else:
+        from conftest import make_tiny_sd_offsets
+
+        components = tiny_components()
+        rp_handler.CPU_DTYPE = 'fp32'
+        rp_handler.initialize_models(components, make_tiny_sd_offsets(components['unet']))
+    fg = np.array(rp_handler.Image.open(args.image).convert('RGB'))
+
+    print(f"{'pretrained' if args.pretrained else 'tiny'} models, {args.width}x{args.height} "
+          f"at highres {args.highres_scale}, {args.steps} steps, {args.runs} runs")
+    print(f"{'interval':<10}{'best s':>10}{'speedup':>10}{'cached':>10}{'PSNR dB':>10}")
+    reference, base_time = None, None
+    for interval in args.intervals:
+        times = []
+        for _ in range(args.runs):
+            stats = {}
+            start = time.perf_counter()
+            images = rp_handler.process_relight(
+                fg, None, 'beautiful woman, detailed face, sunshine from window', args.width, args.height,
+                steps=args.steps, highres_scale=args.highres_scale, highres=args.highres_scale > 1.0,
+                bg_source='left', step_cache_interval=interval, stats=stats)
+            times.append(time.perf_counter() - start)
+        if reference is None:
+            reference, base_time = images[0], min(times)
+        step_cache = stats.get('step_cache', {'full_steps': 1, 'cached_steps': 0})
+        cached = step_cache['cached_steps'] / (step_cache['full_steps'] + step_cache['cached_steps'])
+        print(f"{interval:<10}{min(times):>10.3f}{base_time / min(times):>10.2f}{cached:>10.2f}"
+              f"{psnr(images[0], reference):>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
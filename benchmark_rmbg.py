@@ -0,0 +1,115 @@
+"""
+Benchmark BriaRMBG matting variants
+Each variant runs in its own process so peak memory is measured independently.
+
+Usage: python benchmark_rmbg.py [--size 1024] [--runs 3] [--device cpu] [--pretrained]
+"""
+
+import argparse
+import multiprocessing
+import resource
+import time
+
+import torch
+
+from briarmbg import BriaRMBG
+
+
+def full_forward(model):
+    return lambda x: model(x)[0][0]
+
+
+def predict(model):
+    return model.predict
+
+
+def predict_fused(model):
+    return model.fuse_batchnorm().predict
+
+
+def channels_last(model):
+    model = model.fuse_batchnorm().to(memory_format=torch.channels_last)
+    return lambda x: model.predict(x.contiguous(memory_format=torch.channels_last))
+
+
+def autocast(dtype):
+    def prepare(model):
+        fn = channels_last(model)
+
+        def run(x):
+            with torch.autocast(x.device.type, dtype=dtype):
+                return fn(x)
+        return run
+    return prepare
+
+
+# Each variant prepares the loaded model and returns the function to time
+VARIANTS = {
+    'forward': full_forward,
+    'predict': predict,
+    'fused': predict_fused,
+    'channels_last': channels_last,
+    'bf16': autocast(torch.bfloat16),
+    'fp16': autocast(torch.float16),  # GPU only
+}
+
+
+def load_model(pretrained, device):
+    if pretrained:
+        model = BriaRMBG.from_pretrained("briaai/RMBG-1.4")
+    else:
+        torch.manual_seed(0)
+        model = BriaRMBG()
+    return model.eval().to(device)
+
+
+def run_variant(name, args, results):
+    device = torch.device(args.device)
+    model = load_model(args.pretrained, device)
+    x = torch.rand(1, 3, args.size, args.size, device=device)
+    fn = VARIANTS[name](model)
+    with torch.inference_mode():
+        fn(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            fn(x)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            times.append(time.perf_counter() - start)
+    if device.type == 'cuda':
+        peak_mb = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    else:
+        peak_mb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, rss_before) / 1024
+    results[name] = (min(times), sum(times) / len(times), peak_mb)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--pretrained', action='store_true')
+    parser.add_argument('--variants', nargs='*', default=['forward', 'predict', 'fused', 'channels_last', 'bf16'])
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Manager().dict()
+    for name in args.variants:
+        process = ctx.Process(target=run_variant, args=(name, args, results))
+        process.start()
+        process.join()
+
+    print(f"BriaRMBG {args.size}x{args.size} on {args.device}, {args.runs} runs")
+    print(f"{'variant':<16}{'best s':>10}{'mean s':>10}{'peak MB':>10}")
+    for name in args.variants:
+        best, mean, peak_mb = results[name]
+        print(f"{name:<16}{best:>10.3f}{mean:>10.3f}{peak_mb:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark token merging (ToMe) quality against speed
+By default a tiny SD-like UNet with attention at full latent resolution is timed at a
+highres-pass latent size. --pretrained relights a real image through the handler at
+each ratio and tracks image similarity (PSNR) to the unmerged result.
+
+Usage: python benchmark_tome.py [--latent 96] [--runs 3] [--ratios 0 0.3 0.5 0.7] [--pretrained]
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from attention_processors import TokenMergingAttnProcessor2_0, token_merging
+
+
+def tiny_unet():
+    from diffusers import UNet2DConditionModel
+
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        sample_size=64, in_channels=12, out_channels=4, layers_per_block=1,
+        block_out_channels=(64, 128, 128), norm_num_groups=16,
+        down_block_types=("CrossAttnDownBlock2D", "CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=64, attention_head_dim=8,
+    ).eval()
+    unet.set_attn_processor(TokenMergingAttnProcessor2_0())
+    return unet
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+@torch.inference_mode()
+def benchmark_tiny(args):
+    unet = tiny_unet()
+    generator = torch.Generator().manual_seed(0)
+    sample = torch.randn(2, 12, args.latent, args.latent, generator=generator)
+    context = torch.randn(2, 77, 64, generator=generator)
+
+    print(f"Tiny UNet, latent {args.latent}x{args.latent}, batch 2, {args.runs} runs")
+    print(f"{'ratio':<8}{'best s':>10}{'speedup':>10}{'cosine':>10}{'rel err':>10}")
+    reference, base_time = None, None
+    for ratio in args.ratios:
+        times = []
+        with token_merging(ratio, args.latent, args.latent):
+            unet(sample, 10, context)
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                output = unet(sample, 10, context).sample
+                times.append(time.perf_counter() - start)
+        if reference is None:
+            reference, base_time = output, min(times)
+        cosine = torch.nn.functional.cosine_similarity(output.flatten(), reference.flatten(), dim=0).item()
+        rel_err = ((output - reference).norm() / reference.norm()).item()
+        print(f"{ratio:<8}{min(times):>10.3f}{base_time / min(times):>10.2f}{cosine:>10.4f}{rel_err:>10.4f}")
+
+
+def benchmark_pretrained(args):
+    import rp_handler
+
+    rp_handler.initialize_models()
+    fg = np.array(rp_handler.Image.open(args.image).convert('RGB'))
+    print(f"{args.image}, {args.width}x{args.height} at highres {args.highres_scale}, {args.steps} steps")
+    print(f"{'ratio':<8}{'best s':>10}{'speedup':>10}{'PSNR dB':>10}")
+    reference, base_time = None, None
+    for ratio in args.ratios:
+        times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            images = rp_handler.process_relight(
+                fg, None, 'beautiful woman, detailed face, sunshine from window', args.width, args.height,
+                steps=args.steps, highres_scale=args.highres_scale, bg_source='left', token_merging_ratio=ratio)
+            times.append(time.perf_counter() - start)
+        if reference is None:
+            reference, base_time = images[0], min(times)
+        print(f"{ratio:<8}{min(times):>10.3f}{base_time / min(times):>10.2f}{psnr(images[0], reference):>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latent', type=int, default=96)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--ratios', type=float, nargs='*', default=[0.0, 0.3, 0.5, 0.7])
+    parser.add_argument('--pretrained', action='store_true')
+    parser.add_argument('--image', default='imgs/i1.webp')
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--height', type=int, default=640)
+    parser.add_argument('--highres_scale', type=float, default=2.0)
+    parser.add_argument('--steps', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.pretrained:
+        benchmark_pretrained(args)
+    else:
+        benchmark_tiny(args)
+
+
+if __name__ == '__main__':
+    main()
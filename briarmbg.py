@@ -6,6 +6,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from huggingface_hub import PyTorchModelHubMixin
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 class REBNCONV(nn.Module):
@@ -388,6 +389,22 @@ class BriaRMBG(nn.Module, PyTorchModelHubMixin):
 
         # self.outconv = nn.Conv2d(6*out_ch,out_ch,1)
 
+    @torch.no_grad()
+    def fuse_batchnorm(self):
+        """
+        Fold the frozen BatchNorm of every conv-BN-ReLU block into its convolution
+        Inference only: the model must be in eval mode and cannot be trained afterwards.
+        """
+        assert not self.training, "fuse_batchnorm requires eval mode"
+        for module in self.modules():
+            if isinstance(module, REBNCONV) and isinstance(module.bn_s1, nn.BatchNorm2d):
+                module.conv_s1 = fuse_conv_bn_eval(module.conv_s1, module.bn_s1)
+                module.bn_s1 = nn.Identity()
+            elif isinstance(module, myrebnconv) and isinstance(module.bn, nn.BatchNorm2d):
+                module.conv = fuse_conv_bn_eval(module.conv, module.bn)
+                module.bn = nn.Identity()
+        return self
+
     def forward(self, x):
         hx = x
 
@@ -460,3 +477,31 @@ class BriaRMBG(nn.Module, PyTorchModelHubMixin):
             F.sigmoid(d5),
             F.sigmoid(d6),
         ], [hx1d, hx2d, hx3d, hx4d, hx5d, hx6]
+
+    @torch.inference_mode()
+    def predict(self, x):
+        """
+        Inference-only forward returning just the fused matte (side1, sigmoid, input size)
+        Skips the other five side outputs and releases encoder/decoder activations
+        as soon as the decoder no longer needs them.
+        """
+        hx1 = self.stage1(self.conv_in(x))
+        hx2 = self.stage2(self.pool12(hx1))
+        hx3 = self.stage3(self.pool23(hx2))
+        hx4 = self.stage4(self.pool34(hx3))
+        hx5 = self.stage5(self.pool45(hx4))
+        hx = self.stage6(self.pool56(hx5))
+
+        # -------------------- decoder --------------------
+        hx = self.stage5d(torch.cat((_upsample_like(hx, hx5), hx5), 1))
+        del hx5
+        hx = self.stage4d(torch.cat((_upsample_like(hx, hx4), hx4), 1))
+        del hx4
+        hx = self.stage3d(torch.cat((_upsample_like(hx, hx3), hx3), 1))
+        del hx3
+        hx = self.stage2d(torch.cat((_upsample_like(hx, hx2), hx2), 1))
+        del hx2
+        hx = self.stage1d(torch.cat((_upsample_like(hx, hx1), hx1), 1))
+        del hx1
+
+        return F.sigmoid(_upsample_like(self.side1(hx), x))
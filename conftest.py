@@ -0,0 +1,159 @@
+"""
+Shared test fixtures
+Builds tiny random models with the same structure as the real ones so the
+handler can be exercised end to end on CPU without downloading weights
+"""
+
+import json
+import os
+import string
+import subprocess
+import sys
+import textwrap
+
+import pytest
+import torch
+from huggingface_hub import PyTorchModelHubMixin
+
+
+class TinyMatting(torch.nn.Module, PyTorchModelHubMixin):
+    """Stand-in for BriaRMBG with the same output layout, cheap enough for CPU tests"""
+
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 1, 3, padding=1)
+
+    def forward(self, x):
+        return [torch.sigmoid(self.conv(x))], []
+
+    def predict(self, x):
+        return self.forward(x)[0][0]
+
+    def fuse_batchnorm(self):
+        return self
+
+
+def make_tiny_tokenizer(path):
+    """CLIP tokenizer with a character-level vocabulary"""
+    from transformers import CLIPTokenizer
+
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+    for c in string.ascii_lowercase + ",":
+        vocab.setdefault(c, len(vocab))
+        vocab.setdefault(c + "</w>", len(vocab))
+    with open(os.path.join(path, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(path, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(os.path.join(path, "vocab.json"), os.path.join(path, "merges.txt"), model_max_length=77)
+
+
+def make_tiny_components(path):
+    """Tiny random tokenizer, text encoder, VAE, UNet and matting model"""
+    from transformers import CLIPTextModel, CLIPTextConfig
+    from diffusers import AutoencoderKL, UNet2DConditionModel
+
+    torch.manual_seed(0)
+    tokenizer = make_tiny_tokenizer(path)
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=len(tokenizer.get_vocab()), hidden_size=32, intermediate_size=37,
+        num_hidden_layers=2, num_attention_heads=4, max_position_embeddings=77,
+        bos_token_id=0, eos_token_id=1, pad_token_id=1,
+    ))
+    # Four blocks so the latent scale factor is 8 like SD1.5
+    vae = AutoencoderKL(
+        in_channels=3, out_channels=3, latent_channels=4,
+        down_block_types=["DownEncoderBlock2D"] * 4, up_block_types=["UpDecoderBlock2D"] * 4,
+        block_out_channels=[8, 8, 8, 8], layers_per_block=1, norm_num_groups=8,
+    )
+    unet = UNet2DConditionModel(
+        sample_size=8, in_channels=4, out_channels=4, layers_per_block=1,
+        block_out_channels=(32, 64), norm_num_groups=8,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32, attention_head_dim=8,
+    )
+    return {
+        'tokenizer': tokenizer,
+        'text_encoder': text_encoder,
+        'vae': vae,
+        'unet': unet,
+        'rmbg': TinyMatting(),
+    }
+
+
+def make_tiny_offset(unet, in_channels=12, seed=1):
+    """IC-Light style offsets: only the conditioning channels of conv_in are non-zero"""
+    generator = torch.Generator().manual_seed(seed)
+    sd_offset = {k: torch.zeros_like(v) for k, v in unet.state_dict().items()}
+    weight = unet.conv_in.weight
+    sd_offset['conv_in.weight'] = torch.zeros(weight.shape[0], in_channels, *weight.shape[2:])
+    sd_offset['conv_in.weight'][:, 4:] = torch.randn(weight.shape[0], in_channels - 4, *weight.shape[2:], generator=generator) * 0.05
+    return sd_offset
+
+
+def make_tiny_fc_offset(unet):
+    """fc variant offsets: foreground-only conv_in plus a perturbed up block"""
+    generator = torch.Generator().manual_seed(2)
+    sd_offset = make_tiny_offset(unet, in_channels=8, seed=2)
+    for k, v in sd_offset.items():
+        if k.startswith('up_blocks.0.'):
+            sd_offset[k] = torch.randn(v.shape, generator=generator) * 0.01
+    return sd_offset
+
+
+def make_tiny_sd_offsets(unet):
+    """Offsets of every IC-Light variant for a tiny UNet"""
+    return {'fbc': make_tiny_offset(unet), 'fc': make_tiny_fc_offset(unet)}
+
+
+# Runs before the script body of run_tiny_worker in its fresh process
+TINY_WORKER_PRELUDE = """
+import json, sys, tempfile
+import numpy as np, torch
+import conftest, rp_handler
+
+components = conftest.make_tiny_components(tempfile.mkdtemp())
+sd_offsets = conftest.make_tiny_sd_offsets(components['unet'])
+fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+
+def initialize():
+    rp_handler.initialize_models(components, sd_offsets, torch.device('cpu'))
+    rp_handler.worker_status['status'] = 'ready'
+    rp_handler.models_ready.set()
+
+def report(result):
+    print(json.dumps(result))
+"""
+
+
+@pytest.fixture
+def run_tiny_worker():
+    """
+    Run a script body in a fresh process with the tiny models, for tests that change process-wide
+    state such as dtypes, compiled forwards or worker initialization
+    The body sees components, sd_offsets, a foreground fg, initialize() and report(result), and
+    the dict it reports is returned. env is applied on top of float32 CPU settings.
+    """
+    def run(script_body, env=None, args=()):
+        env = {**os.environ, 'CPU_DTYPE': 'fp32', 'RMBG_PRECISION': 'fp32', **(env or {})}
+        script = TINY_WORKER_PRELUDE + textwrap.dedent(script_body)
+        output = subprocess.run([sys.executable, '-c', script, *args], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                env=env, check=True, capture_output=True, text=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+    return run
+
+
+@pytest.fixture(scope="session")
+def tiny_models(tmp_path_factory):
+    """rp_handler initialized with tiny float32 models on CPU"""
+    import rp_handler
+
+    components = make_tiny_components(str(tmp_path_factory.mktemp("tiny_tokenizer")))
+    sd_offsets = make_tiny_sd_offsets(components['unet'])
+    rp_handler.CPU_DTYPE = 'fp32'
+    rp_handler.RMBG_PRECISION = 'fp32'
+    rp_handler.initialize_models(components, sd_offsets, torch.device('cpu'))
+    rp_handler.worker_status['status'] = 'ready'
+    rp_handler.models_ready.set()
+    return rp_handler
@@ -23,7 +23,7 @@ tokenizer = CLIPTokenizer.from_pretrained(sd15_name, subfolder="tokenizer")
 text_encoder = CLIPTextModel.from_pretrained(sd15_name, subfolder="text_encoder")
 vae = AutoencoderKL.from_pretrained(sd15_name, subfolder="vae")
 unet = UNet2DConditionModel.from_pretrained(sd15_name, subfolder="unet")
-rmbg = BriaRMBG.from_pretrained("briaai/RMBG-1.4")
+rmbg = BriaRMBG.from_pretrained("briaai/RMBG-1.4").eval().fuse_batchnorm()
 
 # Change UNet
 
@@ -223,7 +223,7 @@ def run_rmbg(img, sigma=0.0):
     k = (256.0 / float(H * W)) ** 0.5
     feed = resize_without_crop(img, int(64 * round(W * k)), int(64 * round(H * k)))
     feed = numpy2pytorch([feed]).to(device=device, dtype=torch.float32)
-    alpha = rmbg(feed)[0][0]
+    alpha = rmbg.predict(feed)
     alpha = torch.nn.functional.interpolate(alpha, size=(H, W), mode="bilinear")
     alpha = alpha.movedim(1, -1)[0]
     alpha = alpha.detach().float().cpu().numpy().clip(0, 1)
@@ -231,10 +231,7 @@ def run_rmbg(img, sigma=0.0):
     return result.clip(0, 255).astype(np.uint8), alpha
 
 
-@torch.inference_mode()
-def process(input_fg, input_bg, prompt, image_width, image_height, num_samples, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source):
-    bg_source = BGSource(bg_source)
-
+def process_background(bg_source, input_bg, image_width, image_height):
     if bg_source == BGSource.UPLOAD:
         pass
     elif bg_source == BGSource.UPLOAD_FLIP:
@@ -259,14 +256,40 @@ def process(input_fg, input_bg, prompt, image_width, image_height, num_samples,
         input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
     else:
         raise 'Wrong background source!'
+    return input_bg
+
+
+@torch.inference_mode()
+def process(input_fg, input_bg, prompt, image_width, image_height, num_samples, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source):
+    input_bg = process_background(BGSource(bg_source), input_bg, image_width, image_height)
 
     rng = torch.Generator(device=device).manual_seed(seed)
 
+    pixels, fg, bgs = process_batch(input_fg, [input_bg], prompt, image_width, image_height, num_samples, rng, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise)
+    pixels = pytorch2numpy(pixels, quant=False)
+
+    return pixels, [fg, bgs[0]]
+
+
+@torch.inference_mode()
+def encode_concat_conds(fg, bgs):
+    # the foreground is encoded once and shared by all backgrounds
+    latents = numpy2pytorch([fg] + bgs).to(device=vae.device, dtype=vae.dtype)
+    latents = vae.encode(latents).latent_dist.mode() * vae.config.scaling_factor
+    fg_latent, bg_latents = latents[:1], latents[1:]
+    return torch.cat([fg_latent.repeat(len(bgs), 1, 1, 1), bg_latents], dim=1)
+
+
+@torch.inference_mode()
+def process_batch(input_fg, input_bgs, prompt, image_width, image_height, num_samples, generator, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise):
+    # all backgrounds run as one batch, images are ordered background-major
+    num_images = len(input_bgs) * num_samples
+
     fg = resize_and_center_crop(input_fg, image_width, image_height)
-    bg = resize_and_center_crop(input_bg, image_width, image_height)
-    concat_conds = numpy2pytorch([fg, bg]).to(device=vae.device, dtype=vae.dtype)
-    concat_conds = vae.encode(concat_conds).latent_dist.mode() * vae.config.scaling_factor
-    concat_conds = torch.cat([c[None, ...] for c in concat_conds], dim=1)
+    bgs = [resize_and_center_crop(input_bg, image_width, image_height) for input_bg in input_bgs]
+    concat_conds = encode_concat_conds(fg, bgs)
+    if len(input_bgs) > 1:
+        concat_conds = concat_conds.repeat_interleave(num_samples, dim=0)
 
     conds, unconds = encode_prompt_pair(positive_prompt=prompt + ', ' + a_prompt, negative_prompt=n_prompt)
 
@@ -276,8 +299,8 @@ def process(input_fg, input_bg, prompt, image_width, image_height, num_samples,
         width=image_width,
         height=image_height,
         num_inference_steps=steps,
-        num_images_per_prompt=num_samples,
-        generator=rng,
+        num_images_per_prompt=num_images,
+        generator=generator,
         output_type='latent',
         guidance_scale=cfg,
         cross_attention_kwargs={'concat_conds': concat_conds},
@@ -297,10 +320,10 @@ def process(input_fg, input_bg, prompt, image_width, image_height, num_samples,
 
     image_height, image_width = latents.shape[2] * 8, latents.shape[3] * 8
     fg = resize_and_center_crop(input_fg, image_width, image_height)
-    bg = resize_and_center_crop(input_bg, image_width, image_height)
-    concat_conds = numpy2pytorch([fg, bg]).to(device=vae.device, dtype=vae.dtype)
-    concat_conds = vae.encode(concat_conds).latent_dist.mode() * vae.config.scaling_factor
-    concat_conds = torch.cat([c[None, ...] for c in concat_conds], dim=1)
+    bgs = [resize_and_center_crop(input_bg, image_width, image_height) for input_bg in input_bgs]
+    concat_conds = encode_concat_conds(fg, bgs)
+    if len(input_bgs) > 1:
+        concat_conds = concat_conds.repeat_interleave(num_samples, dim=0)
 
     latents = i2i_pipe(
         image=latents,
@@ -310,17 +333,16 @@ def process(input_fg, input_bg, prompt, image_width, image_height, num_samples,
         width=image_width,
         height=image_height,
         num_inference_steps=int(round(steps / highres_denoise)),
-        num_images_per_prompt=num_samples,
-        generator=rng,
+        num_images_per_prompt=num_images,
+        generator=generator,
         output_type='latent',
         guidance_scale=cfg,
         cross_attention_kwargs={'concat_conds': concat_conds},
     ).images.to(vae.dtype) / vae.config.scaling_factor
 
     pixels = vae.decode(latents).sample
-    pixels = pytorch2numpy(pixels, quant=False)
 
-    return pixels, [fg, bg]
+    return pixels, fg, bgs
 
 
 @torch.inference_mode()
@@ -335,49 +357,45 @@ def process_relight(input_fg, input_bg, prompt, image_width, image_height, num_s
 def process_normal(input_fg, input_bg, prompt, image_width, image_height, num_samples, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source):
     input_fg, matting = run_rmbg(input_fg, sigma=16)
 
-    print('left ...')
-    left = process(input_fg, input_bg, prompt, image_width, image_height, 1, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, BGSource.LEFT.value)[0][0]
-
-    print('right ...')
-    right = process(input_fg, input_bg, prompt, image_width, image_height, 1, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, BGSource.RIGHT.value)[0][0]
+    # left, right, bottom and top lights run as one batch, each seeded like a single run
+    directions = [BGSource.LEFT, BGSource.RIGHT, BGSource.BOTTOM, BGSource.TOP]
+    input_bgs = [process_background(direction, None, image_width, image_height) for direction in directions]
+    generators = [torch.Generator(device=device).manual_seed(seed) for _ in directions]
 
-    print('bottom ...')
-    bottom = process(input_fg, input_bg, prompt, image_width, image_height, 1, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, BGSource.BOTTOM.value)[0][0]
-
-    print('top ...')
-    top = process(input_fg, input_bg, prompt, image_width, image_height, 1, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, BGSource.TOP.value)[0][0]
+    print('left, right, bottom, top ...')
+    pixels = process_batch(input_fg, input_bgs, prompt, image_width, image_height, 1, generators, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise)[0]
+    pixels = (pixels.float() * 0.5 + 0.5).clip(0, 1)
+    left, right, bottom, top = pixels.unbind(0)
 
     inner_results = [left * 2.0 - 1.0, right * 2.0 - 1.0, bottom * 2.0 - 1.0, top * 2.0 - 1.0]
 
-    ambient = (left + right + bottom + top) / 4.0
-    h, w, _ = ambient.shape
-    matting = resize_and_center_crop((matting[..., 0] * 255.0).clip(0, 255).astype(np.uint8), w, h).astype(np.float32)[..., None] / 255.0
+    ambient = pixels.mean(dim=0, keepdim=True)
+    h, w = ambient.shape[2:]
+    matting = resize_and_center_crop((matting[..., 0] * 255.0).clip(0, 255).astype(np.uint8), w, h)
+    matting = torch.from_numpy(matting).to(pixels) / 255.0
 
     def safa_divide(a, b):
         e = 1e-5
         return ((a + e) / (b + e)) - 1.0
 
-    left = safa_divide(left, ambient)
-    right = safa_divide(right, ambient)
-    bottom = safa_divide(bottom, ambient)
-    top = safa_divide(top, ambient)
+    left, right, bottom, top = safa_divide(pixels, ambient).unbind(0)
 
     u = (right - left) * 0.5
     v = (top - bottom) * 0.5
 
     sigma = 10.0
-    u = np.mean(u, axis=2)
-    v = np.mean(v, axis=2)
+    u = u.mean(dim=0)
+    v = v.mean(dim=0)
     h = (1.0 - u ** 2.0 - v ** 2.0).clip(0, 1e5) ** (0.5 * sigma)
-    z = np.zeros_like(h)
+    z = torch.zeros_like(h)
 
-    normal = np.stack([u, v, h], axis=2)
-    normal /= np.sum(normal ** 2.0, axis=2, keepdims=True) ** 0.5
-    normal = normal * matting + np.stack([z, z, 1 - z], axis=2) * (1 - matting)
+    normal = torch.stack([u, v, h], dim=0)
+    normal /= normal.square().sum(dim=0, keepdim=True) ** 0.5
+    normal = normal * matting + torch.stack([z, z, 1 - z], dim=0) * (1 - matting)
 
-    results = [normal, left, right, bottom, top] + inner_results
-    results = [(x * 127.5 + 127.5).clip(0, 255).astype(np.uint8) for x in results]
-    return results
+    results = torch.stack([normal, left, right, bottom, top] + inner_results, dim=0)
+    results = (results * 127.5 + 127.5).clip(0, 255).to(torch.uint8).movedim(1, -1).cpu().numpy()
+    return list(results)
 
 
 quick_prompts = [
@@ -437,7 +455,7 @@ with block:
                 a_prompt = gr.Textbox(label="Added Prompt", value='best quality')
                 n_prompt = gr.Textbox(label="Negative Prompt",
                                       value='lowres, bad anatomy, bad hands, cropped, worst quality')
-                normal_button = gr.Button(value="Compute Normal (4x Slower)")
+                normal_button = gr.Button(value="Compute Normal (4 Lights, Batched)")
         with gr.Column():
             result_gallery = gr.Gallery(height=832, object_fit='contain', label='Outputs')
     with gr.Row():
@@ -0,0 +1,192 @@
+"""
+Local HTTP serving mode
+Serves the handler over HTTP with the RunPod request and response schema, without the
+RunPod runtime: POST /runsync waits for the result, POST /run queues the job and
+GET /status/{id} polls it. Jobs run through the same in-process handler and job pipeline
+as the serverless worker, connections are kept alive between requests.
+
+Usage: python http_server.py [--host 0.0.0.0] [--port 8000] [--concurrency N] [--stub-delay SECONDS]
+"""
+
+import argparse
+import asyncio
+import os
+import time
+import uuid
+
+from aiohttp import web
+
+HTTP_HOST = os.environ.get('HTTP_HOST', '0.0.0.0')
+HTTP_PORT = int(os.environ.get('HTTP_PORT', '8000'))
+# Seconds /runsync waits before answering IN_PROGRESS, the job keeps running and can be polled
+HTTP_SYNC_TIMEOUT = float(os.environ.get('HTTP_SYNC_TIMEOUT', '300'))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', '75'))
+# Finished jobs are kept for HTTP_JOB_TTL seconds, at most HTTP_MAX_JOBS jobs are stored
+HTTP_JOB_TTL = float(os.environ.get('HTTP_JOB_TTL', '600'))
+HTTP_MAX_JOBS = int(os.environ.get('HTTP_MAX_JOBS', '1000'))
+
+
+class JobStore:
+    """
+    In-memory jobs by id, in the RunPod states IN_QUEUE, IN_PROGRESS, COMPLETED and FAILED
+    Finished jobs expire after ttl seconds. With max_jobs stored, new jobs are refused.
+    """
+
+    def __init__(self, ttl=HTTP_JOB_TTL, max_jobs=HTTP_MAX_JOBS):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.jobs = {}
+
+    def create(self, job_input):
+        """New queued job, None when the store is full"""
+        self.expire()
+        if len(self.jobs) >= self.max_jobs:
+            return None
+        job = {'id': uuid.uuid4().hex, 'status': 'IN_QUEUE', 'input': job_input, 'output': None,
+               'error': None, 'created': time.time(), 'started': None, 'finished': None,
+               'done': asyncio.Event()}
+        self.jobs[job['id']] = job
+        return job
+
+    def get(self, job_id):
+        self.expire()
+        return self.jobs.get(job_id)
+
+    def expire(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job['finished'] is not None and now - job['finished'] > self.ttl]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def counts(self):
+        counts = {'IN_QUEUE': 0, 'IN_PROGRESS': 0, 'COMPLETED': 0, 'FAILED': 0}
+        for job in self.jobs.values():
+            counts[job['status']] += 1
+        return counts
+
+
+def job_response(job):
+    """RunPod-style job status, with delayTime and executionTime in milliseconds"""
+    response = {'id': job['id'], 'status': job['status']}
+    if job['started'] is not None:
+        response['delayTime'] = round((job['started'] - job['created']) * 1000)
+    if job['finished'] is not None:
+        response['executionTime'] = round((job['finished'] - job['started']) * 1000)
+    if job['status'] == 'COMPLETED':
+        response['output'] = job['output']
+    elif job['status'] == 'FAILED':
+        response['error'] = job['error']
+    return response
+
+
+def error_response(status, message):
+    return web.json_response({'error': message}, status=status)
+
+
+def create_app(handler, concurrency=1, health=None, store=None, sync_timeout=HTTP_SYNC_TIMEOUT):
+    """
+    aiohttp application around an async handler(event) -> output
+    At most concurrency jobs are handed to the handler at once, the rest wait IN_QUEUE.
+    health() returns the worker state reported by GET /health.
+    """
+    store = store or JobStore()
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def run_job(job):
+        async with slots:
+            job['status'] = 'IN_PROGRESS'
+            job['started'] = time.time()
+            try:
+                job['output'] = await handler({'id': job['id'], 'input': job['input']})
+                job['status'] = 'COMPLETED'
+            except Exception as e:
+                job['error'] = f"{type(e).__name__}: {e}"
+                job['status'] = 'FAILED'
+            finally:
+                job['finished'] = time.time()
+                job['done'].set()
+
+    async def submit(request):
+        try:
+            body = await request.json()
+        except ValueError:
+            return None, error_response(400, "Request body must be JSON")
+        if not isinstance(body, dict) or 'input' not in body:
+            return None, error_response(400, "Missing 'input' field in request")
+        job = store.create(body['input'])
+        if job is None:
+            return None, error_response(429, f"Job store full ({store.max_jobs} jobs)")
+        task = asyncio.create_task(run_job(job))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return job, None
+
+    async def run(request):
+        job, error = await submit(request)
+        if error is not None:
+            return error
+        return web.json_response(job_response(job))
+
+    async def runsync(request):
+        job, error = await submit(request)
+        if error is not None:
+            return error
+        try:
+            await asyncio.wait_for(job['done'].wait(), sync_timeout)
+        except asyncio.TimeoutError:
+            pass
+        return web.json_response(job_response(job))
+
+    async def status(request):
+        job = store.get(request.match_info['job_id'])
+        if job is None:
+            return error_response(404, f"Unknown job {request.match_info['job_id']}")
+        return web.json_response(job_response(job))
+
+    async def get_health(request):
+        return web.json_response({'worker': health() if health else {'status': 'ready'}, 'jobs': store.counts()})
+
+    app = web.Application(client_max_size=256 * 1024 * 1024)
+    app.add_routes([
+        web.post('/run', run),
+        web.post('/runsync', runsync),
+        web.get('/status/{job_id}', status),
+        web.get('/health', get_health),
+    ])
+    return app
+
+
+def make_stub_handler(delay=0.0):
+    """Handler that answers after delay seconds without any models, for tests and HTTP load tests"""
+    async def stub_handler(event):
+        await asyncio.sleep(delay)
+        return {'status': 'success', 'images': [], 'stub': True, 'input_keys': sorted(event['input'])}
+    return stub_handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=HTTP_HOST)
+    parser.add_argument('--port', type=int, default=HTTP_PORT)
+    parser.add_argument('--stub-delay', type=float, default=None,
+                        help="serve a stub handler answering after this many seconds instead of the models")
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help="jobs handed to the handler at once (default: PIPELINE_CONCURRENCY, 1 with --stub-delay)")
+    args = parser.parse_args()
+
+    if args.stub_delay is not None:
+        app = create_app(make_stub_handler(args.stub_delay), args.concurrency or 1)
+    else:
+        import rp_handler
+
+        # Serve right away, jobs wait for the background initialization like on RunPod
+        rp_handler.start_worker_initialization()
+        app = create_app(rp_handler.async_handler, args.concurrency or rp_handler.PIPELINE_CONCURRENCY,
+                         lambda: rp_handler.get_worker_status()['worker'])
+    web.run_app(app, host=args.host, port=args.port, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+
+
+if __name__ == '__main__':
+    main()
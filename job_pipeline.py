@@ -0,0 +1,86 @@
+"""
+Staged job pipeline for the IC-Light worker
+Overlaps CPU preprocessing and output encoding of neighbouring jobs with diffusion
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+_STOP = object()
+
+
+class StagedPipeline:
+    """
+    Three-stage pipeline: prepare (CPU pool) -> run (single GPU thread) -> finish (CPU pool)
+
+    The queues after prepare are bounded so a burst of jobs cannot pile up decoded
+    images in memory. The intake queue only holds raw requests and is unbounded, so
+    submit never blocks (it is called from the event loop). While job N is in the GPU
+    stage, job N+1 can be decoded and job N-1 encoded on the CPU workers.
+    """
+
+    def __init__(self, prepare, run, finish, num_cpu_workers=2, queue_size=2):
+        self.prepare = prepare
+        self.run = run
+        self.finish = finish
+        self._prepare_queue = queue.Queue()
+        self._run_queue = queue.Queue(maxsize=queue_size)
+        self._finish_queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._num_cpu_workers = num_cpu_workers
+
+        for i in range(num_cpu_workers):
+            self._start(f'prepare-{i}', self._prepare_queue, self.prepare, self._run_queue, 'prepare')
+            self._start(f'finish-{i}', self._finish_queue, self.finish, None, 'finish')
+        self._start('run', self._run_queue, self.run, self._finish_queue, 'run')
+
+    def _start(self, name, inbox, fn, outbox, stage_name):
+        thread = threading.Thread(target=self._stage_loop, args=(inbox, fn, outbox, stage_name),
+                                  name=f'pipeline-{name}', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    @staticmethod
+    def _stage_loop(inbox, fn, outbox, stage_name):
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                break
+            future, payload, timings = item
+            if future.done():
+                continue
+            try:
+                start = time.perf_counter()
+                result = fn(payload)
+                timings[stage_name] = time.perf_counter() - start
+            except BaseException as e:
+                future.set_exception(e)
+                continue
+            if outbox is None:
+                future.set_result((result, timings))
+            else:
+                outbox.put((future, result, timings))
+
+    def submit(self, payload):
+        """Queue a job without blocking; returns a Future resolving to (result, stage_timings)"""
+        future = Future()
+        self._prepare_queue.put((future, payload, {}))
+        return future
+
+    def shutdown(self):
+        """Stop all stage threads once the queued jobs have drained"""
+        for _ in range(self._num_cpu_workers):
+            self._prepare_queue.put(_STOP)
+        for thread in self._threads:
+            if thread.name.startswith('pipeline-prepare'):
+                thread.join()
+        self._run_queue.put(_STOP)
+        for thread in self._threads:
+            if thread.name == 'pipeline-run':
+                thread.join()
+        for _ in range(self._num_cpu_workers):
+            self._finish_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
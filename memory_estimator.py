@@ -0,0 +1,73 @@
+"""
+Peak memory estimator for IC-Light jobs
+Predicts the device memory a job needs from its shape so impossible jobs can be
+rejected, and large ones split, before any GPU time is spent.
+"""
+
+import json
+
+import numpy as np
+
+
+class MemoryEstimator:
+    """
+    Peak memory of a job above the idle model footprint, in bytes
+
+    Modelled as base + linear * images * pixels + quadratic * images * pixels**2, where
+    images is the number of images diffused together and pixels the output pixels of the
+    largest pass (the quadratic term covers attention). Coefficients are fitted by least
+    squares to measured (images, pixels, peak) samples and scaled by safety_margin.
+    """
+
+    def __init__(self, coefficients=None, safety_margin=1.2):
+        self.coefficients = coefficients
+        self.safety_margin = safety_margin
+        self.samples = []
+
+    def add_sample(self, images, pixels, peak_bytes):
+        self.samples.append((images, pixels, peak_bytes))
+
+    def fit(self):
+        """Fit the coefficients to the samples, negative fits are clipped to zero"""
+        if len(self.samples) < 3:
+            raise ValueError(f"Need at least 3 memory samples to fit, got {len(self.samples)}")
+        images, pixels, peaks = (np.array(column, dtype=np.float64) for column in zip(*self.samples))
+        features = np.stack([np.ones_like(pixels), images * pixels, images * pixels ** 2], axis=1)
+        coefficients, *_ = np.linalg.lstsq(features, peaks, rcond=None)
+        self.coefficients = [max(float(c), 0.0) for c in coefficients]
+        return self.coefficients
+
+    def estimate(self, images, pixels):
+        """Estimated peak bytes for images diffused together at pixels output pixels"""
+        base, linear, quadratic = self.coefficients
+        return self.safety_margin * (base + linear * images * pixels + quadratic * images * pixels ** 2)
+
+    def max_batch(self, pixels, budget_bytes):
+        """Largest number of images at pixels that fits in budget_bytes, 0 if not even one does"""
+        base, linear, quadratic = self.coefficients
+        per_image = linear * pixels + quadratic * pixels ** 2
+        available = budget_bytes / self.safety_margin - base
+        if available < per_image:
+            return 0
+        if per_image <= 0:
+            return float('inf')
+        return int(available // per_image)
+
+    def save(self, path, device_name):
+        with open(path, 'w') as f:
+            json.dump({'device_name': device_name, 'coefficients': self.coefficients,
+                       'samples': self.samples}, f, indent=2)
+
+    @classmethod
+    def load(cls, path, device_name, safety_margin=1.2):
+        """Load a calibration, None if it is missing or was measured on another device"""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('device_name') != device_name:
+            return None
+        estimator = cls(data['coefficients'], safety_margin)
+        estimator.samples = [tuple(sample) for sample in data.get('samples', [])]
+        return estimator
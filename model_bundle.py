@@ -0,0 +1,183 @@
+"""
+Offline model bundle
+Collects every model artefact the handler needs into one local directory with a manifest
+of SHA-256 hashes and sizes, so workers can verify their files and start without the hub.
+Downloads resume from a .part file and are only renamed into place once complete.
+
+Usage: python model_bundle.py build ./models/bundle
+       python model_bundle.py verify ./models/bundle [--sizes-only]
+"""
+
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import re
+import time
+import urllib.error
+import urllib.request
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+CHUNK_SIZE = 8 << 20
+
+
+class BundleError(Exception):
+    """A missing, incomplete or corrupt model bundle or download"""
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _expected_size(response, offset):
+    """Total file size from a 206 Content-Range or a 200 Content-Length, None if unknown"""
+    content_range = response.headers.get('Content-Range')
+    if content_range:
+        match = re.match(r'bytes \d+-\d+/(\d+)', content_range)
+        if match:
+            return int(match.group(1))
+    length = response.headers.get('Content-Length')
+    return offset + int(length) if length is not None else None
+
+
+def download_file(url, dst, sha256=None, size=None, retries=3, timeout=60, backoff=1.0):
+    """
+    Download url to dst, resuming an interrupted download from dst + '.part'
+    The finished file is checked against size and sha256 when given and only then
+    atomically renamed to dst, so dst is either absent or complete.
+    """
+    part = dst + '.part'
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    attempt = 0
+    while True:
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+                if offset and response.status != 206:
+                    # The server ignored the range, start over
+                    offset = 0
+                total = _expected_size(response, offset)
+                with open(part, 'ab' if offset else 'wb') as f:
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+            received = os.path.getsize(part)
+            if total is not None and received < total:
+                raise http.client.IncompleteRead(b'', total - received)
+            break
+        except urllib.error.HTTPError as e:
+            # 416: the .part already holds the whole file
+            if e.code == 416 and offset:
+                break
+            if e.code < 500 or attempt >= retries:
+                raise
+            error = e
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            if attempt >= retries:
+                raise
+            error = e
+        attempt += 1
+        print(f"Download of {url} interrupted ({error!r}), resuming (attempt {attempt}/{retries})...")
+        time.sleep(backoff * 2 ** (attempt - 1))
+
+    received = os.path.getsize(part)
+    if size is not None and received != size:
+        os.remove(part)
+        raise BundleError(f"{url}: expected {size} bytes, got {received}")
+    if sha256 is not None and file_sha256(part) != sha256:
+        os.remove(part)
+        raise BundleError(f"{url}: SHA-256 mismatch")
+    os.replace(part, dst)
+    return dst
+
+
+def file_problem(path, sha256=None, size=None, hashes=True):
+    """Why path does not match the expected size (and SHA-256 when hashes), None if it does"""
+    if not os.path.isfile(path):
+        return "missing"
+    if size is not None and os.path.getsize(path) != size:
+        return f"{os.path.getsize(path)} bytes, expected {size}"
+    if hashes and sha256 is not None and file_sha256(path) != sha256:
+        return "SHA-256 mismatch"
+    return None
+
+
+def write_manifest(bundle_dir, sources=None):
+    """Hash every file in bundle_dir into its manifest, written last and atomically"""
+    files = {}
+    for root, _, names in os.walk(bundle_dir):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, bundle_dir).replace(os.sep, '/')
+            if relpath == MANIFEST_NAME or name.endswith(('.part', '.tmp')):
+                continue
+            files[relpath] = {'size': os.path.getsize(path), 'sha256': file_sha256(path)}
+    manifest = {'version': MANIFEST_VERSION, 'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'sources': sources or {}, 'files': dict(sorted(files.items()))}
+    path = os.path.join(bundle_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return manifest
+
+
+def load_manifest(bundle_dir):
+    path = os.path.join(bundle_dir, MANIFEST_NAME)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        raise BundleError(f"No model bundle manifest at {path}")
+    except ValueError as e:
+        raise BundleError(f"Unreadable model bundle manifest {path}: {e}")
+    if manifest.get('version') != MANIFEST_VERSION or not isinstance(manifest.get('files'), dict):
+        raise BundleError(f"Unsupported model bundle manifest {path}")
+    return manifest
+
+
+def verify_bundle(bundle_dir, hashes=True):
+    """
+    Check every file of the manifest exists with the recorded size (and SHA-256 when hashes)
+    Raises BundleError listing all problems, returns the manifest.
+    """
+    manifest = load_manifest(bundle_dir)
+    problems = []
+    for relpath, entry in manifest['files'].items():
+        problem = file_problem(os.path.join(bundle_dir, relpath), entry['sha256'], entry['size'], hashes)
+        if problem is not None:
+            problems.append(f"{relpath}: {problem}")
+    if problems:
+        raise BundleError(f"Model bundle {bundle_dir} failed verification: " + '; '.join(problems))
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['build', 'verify'])
+    parser.add_argument('bundle_dir')
+    parser.add_argument('--sizes-only', action='store_true', help="verify sizes without hashing")
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.command == 'build':
+        import rp_handler
+
+        manifest = rp_handler.build_model_bundle(args.bundle_dir)
+    else:
+        manifest = verify_bundle(args.bundle_dir, hashes=not args.sizes_only)
+    total = sum(entry['size'] for entry in manifest['files'].values())
+    print(f"{args.command}: {len(manifest['files'])} files, {total / 2 ** 30:.2f} GiB "
+          f"in {time.time() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Exported BriaRMBG runtime and CPU matting worker pool
+Lets matting run in separate CPU processes (or on CPU-only nodes) from a TorchScript
+export, so the diffusion worker only receives precomputed alphas.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+_worker_model = None
+
+
+class MattePredictor(torch.nn.Module):
+    """Wraps a matting model so its inference path is the module forward"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.predict(x)
+
+
+@torch.no_grad()
+def export_rmbg(model, path, example_size=(1024, 1024)):
+    """
+    Trace a float32 CPU matting model to TorchScript and save it to path
+    The trace keeps input shapes dynamic, any (B, 3, H, W) feed works.
+    """
+    height, width = example_size
+    example = torch.rand(1, 3, height, width)
+    traced = torch.jit.trace(MattePredictor(model).eval(), example, check_trace=False)
+    traced.save(path)
+    print(f"Exported matting model to {path}")
+    return path
+
+
+def load_rmbg(path):
+    """Load an exported matting model on CPU"""
+    return torch.jit.load(path, map_location='cpu').eval()
+
+
+def _init_worker(path, num_threads):
+    global _worker_model
+    torch.set_num_threads(num_threads)
+    _worker_model = load_rmbg(path)
+
+
+def _predict(feed):
+    with torch.inference_mode():
+        return _worker_model(torch.from_numpy(feed)).numpy()
+
+
+class MattingWorkerPool:
+    """
+    Pool of CPU processes running the exported matting model
+
+    Each worker loads the TorchScript file once and uses num_threads intra-op threads.
+    submit() takes a (B, 3, H, W) float32 feed and returns a Future of the
+    (B, 1, H, W) alpha at feed resolution.
+    """
+
+    def __init__(self, path, num_workers=2, num_threads=1):
+        self.path = path
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(path, num_threads),
+        )
+
+    def submit(self, feed):
+        return self._executor.submit(_predict, feed)
+
+    def shutdown(self):
+        self._executor.shutdown()
@@ -5,19 +5,29 @@ Handles relighting requests with foreground and background conditioning
 
 import os
 import math
+import re
 import base64
+import hashlib
 import io
-import runpod
+import time
+import itertools
+
+# Process start, for the time to worker-registered and to ready
+PROCESS_START = time.time()
+
+import asyncio
+import threading
+import traceback
 import numpy as np
 import torch
 import safetensors.torch as sf
-from PIL import Image
-from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline
-from diffusers import AutoencoderKL, UNet2DConditionModel, DDIMScheduler, EulerAncestralDiscreteScheduler, DPMSolverMultistepScheduler
-from diffusers.models.attention_processor import AttnProcessor2_0
-from transformers import CLIPTextModel, CLIPTokenizer
-from briarmbg import BriaRMBG
-from torch.hub import download_url_to_file
+from PIL import Image, ImageOps, ExifTags
+from job_pipeline import StagedPipeline
+from unet_variants import UNetVariantRegistry
+from rmbg_runtime import MattingWorkerPool, export_rmbg
+from memory_estimator import MemoryEstimator
+from step_cache import StepFeatureCache
+from model_bundle import MANIFEST_NAME, BundleError, download_file, file_problem, verify_bundle, write_manifest
 
 # Global variables for model components
 device = None
@@ -26,128 +36,595 @@ text_encoder = None
 vae = None
 unet = None
 rmbg = None
-t2i_pipe = None
-i2i_pipe = None
-
-def download_models():
-    """Download required model files"""
-    model_path = './models/iclight_sd15_fbc.safetensors'
-    os.makedirs('./models', exist_ok=True)
-    
-    if not os.path.exists(model_path):
-        print("Downloading IC-Light model...")
-        download_url_to_file(
-            url='https://huggingface.co/lllyasviel/ic-light/resolve/main/iclight_sd15_fbc.safetensors',
-            dst=model_path
-        )
-        print("Model downloaded successfully!")
-    return model_path
+schedulers = {}
+unet_variants = None
+matting_pool = None
+memory_estimator = None
+memory_budget = None
+job_pipeline = None
+_job_pipeline_lock = threading.Lock()
+_model_libraries_imported = False
+_model_libraries_lock = threading.Lock()
 
-def initialize_models():
-    """Initialize all models and pipelines"""
-    global device, tokenizer, text_encoder, vae, unet, rmbg, t2i_pipe, i2i_pipe
-    
-    print("Initializing models...")
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f"Using device: {device}")
+# Worker readiness: 'not_started' until start_worker_initialization, then 'initializing'
+# while the models load in the background and 'ready' or 'failed' once models_ready is set
+worker_status = {'status': 'not_started', 'error': None, 'timings': {},
+                 'time_to_registered': None, 'time_to_ready': None}
+models_ready = threading.Event()
+
+# Job pipeline configuration
+# Jobs in flight per worker: one preparing, one in diffusion, one encoding
+PIPELINE_CONCURRENCY = int(os.environ.get('PIPELINE_CONCURRENCY', '3'))
+PIPELINE_CPU_WORKERS = int(os.environ.get('PIPELINE_CPU_WORKERS', '2'))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', '2'))
+
+# Worker startup: the worker registers right away and loads the models in a background thread.
+# Jobs that arrive meanwhile wait up to INIT_WAIT_TIMEOUT seconds for them. INIT_WARMUP runs one
+# INIT_WARMUP_SIZE square job through the pipeline at the end of init, so the first real job
+# does not pay for lazy kernel and allocator setup.
+INIT_WAIT_TIMEOUT = float(os.environ.get('INIT_WAIT_TIMEOUT', '900'))
+INIT_WARMUP = os.environ.get('INIT_WARMUP', '1') == '1'
+INIT_WARMUP_SIZE = int(os.environ.get('INIT_WARMUP_SIZE', '256'))
+
+# IC-Light UNet variants served from one base UNet, selected by the 'model' request field
+# fbc: foreground and background conditioned, fc: foreground conditioned only
+# sha256 and size pin the downloaded offsets. Unpinned (None) files are checked against the
+# SHA-256 and size the hub reports in its LFS metadata instead.
+UNET_VARIANTS = {
+    'fbc': {'filename': 'iclight_sd15_fbc.safetensors', 'in_channels': 12, 'cfg_scale': 7.0,
+            'sha256': None, 'size': None},
+    'fc': {'filename': 'iclight_sd15_fc.safetensors', 'in_channels': 8, 'cfg_scale': 2.0,
+           'sha256': None, 'size': None},
+}
+DEFAULT_UNET_VARIANT = 'fbc'
+# Hub sources of the base model, the matting model and the IC-Light offsets
+SD15_NAME = 'stablediffusionapi/realistic-vision-v51'
+RMBG_NAME = 'briaai/RMBG-1.4'
+IC_LIGHT_URL = 'https://huggingface.co/lllyasviel/ic-light/resolve/main/{filename}'
+# Offline model bundle built by model_bundle.py. MODEL_BUNDLE 'auto' loads strictly offline from
+# MODEL_BUNDLE_DIR when it has a manifest and from the hub otherwise, 'require' fails startup
+# without a bundle, 'off' always uses the hub. A bundle that fails verification always fails startup.
+# MODEL_BUNDLE_VERIFY 'sha256' hashes every file, 'size' only checks the sizes.
+MODEL_BUNDLE = os.environ.get('MODEL_BUNDLE', 'auto')
+MODEL_BUNDLE_DIR = os.environ.get('MODEL_BUNDLE_DIR', './models/bundle')
+MODEL_BUNDLE_VERIFY = os.environ.get('MODEL_BUNDLE_VERIFY', 'sha256')
+
+# Model dtypes on GPU, the UNet and text encoder run in fp16 and the VAE in bf16
+MODEL_DTYPES = {
+    'text_encoder': torch.float16,
+    'vae': torch.bfloat16,
+    'unet': torch.float16,
+    'rmbg': torch.float32,
+}
+
+# CPU backend. CPUs have no fast fp16 kernels: 'auto' runs the text encoder, VAE and UNet in bf16
+# on CPUs with native bf16 and in fp32 otherwise, 'fp32' or 'bf16' force one dtype.
+CPU_DTYPE = os.environ.get('CPU_DTYPE', 'auto')
+CPU_DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16}
+# Intra-op and inter-op thread counts, 0 keeps the torch defaults
+CPU_THREADS = int(os.environ.get('CPU_THREADS', '0'))
+CPU_INTEROP_THREADS = int(os.environ.get('CPU_INTEROP_THREADS', '0'))
+# oneDNN convolutions are fastest on NHWC tensors
+CPU_CHANNELS_LAST = os.environ.get('CPU_CHANNELS_LAST', '1') == '1'
+
+# torch.compile mode for the UNet, VAE and BriaRMBG ('off', 'default', 'reduce-overhead',
+# 'max-autotune'). Every new tensor shape compiles once, so use it with resolution buckets;
+# TORCH_COMPILE_WARMUP compiles every bucket at startup instead of on the first requests.
+# Compiled kernels and autotune results persist in TORCH_COMPILE_CACHE_DIR, put it on a
+# network volume so later workers start warm.
+TORCH_COMPILE_MODE = os.environ.get('TORCH_COMPILE_MODE', 'off')
+TORCH_COMPILE_MODES = ('off', 'default', 'reduce-overhead', 'max-autotune')
+TORCH_COMPILE_WARMUP = os.environ.get('TORCH_COMPILE_WARMUP', '1') == '1'
+TORCH_COMPILE_CACHE_DIR = os.environ.get('TORCH_COMPILE_CACHE_DIR', './models/torch_compile_cache')
+
+# Resolution buckets (W x H, multiples of 64) that keep the set of tensor shapes small.
+# 'off' runs at the requested size. 'crop' runs at the bucket closest in aspect ratio and
+# area and returns images at the bucket size. 'pad' runs at the smallest bucket containing
+# the request, pads the inputs around it and crops the results back to the requested size.
+RESOLUTION_BUCKETING = os.environ.get('RESOLUTION_BUCKETING', 'off')
+RESOLUTION_BUCKETING_MODES = ('off', 'crop', 'pad')
+RESOLUTION_BUCKETS = [tuple(int(side) for side in bucket.split('x')) for bucket in os.environ.get(
+    'RESOLUTION_BUCKETS', '512x512,512x640,640x512,512x768,768x512,640x640,576x768,768x576,768x768').split(',')]
+# With bucketing on, highres scales snap to the nearest of these
+HIGHRES_SCALE_BUCKETS = [float(scale) for scale in os.environ.get('HIGHRES_SCALE_BUCKETS', '1.25,1.5,2.0').split(',')]
+
+# Matting runs with fp32 weights under autocast: 'auto' picks fp16 on GPU and bf16 on CPUs
+# with native bf16, 'fp32' disables autocast. The reduced precision is only kept if mattes of
+# the reference images stay within RMBG_GUARD_TOLERANCE (mean abs alpha error) of fp32.
+RMBG_PRECISION = os.environ.get('RMBG_PRECISION', 'auto')
+RMBG_CHANNELS_LAST = os.environ.get('RMBG_CHANNELS_LAST', '1') == '1'
+RMBG_GUARD_IMAGES = os.environ.get('RMBG_GUARD_IMAGES', 'imgs/i1.webp,imgs/i6.jpg,imgs/i7.jpg,imgs/i8.webp').split(',')
+RMBG_GUARD_TOLERANCE = float(os.environ.get('RMBG_GUARD_TOLERANCE', '0.01'))
+RMBG_AUTOCAST_DTYPES = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+rmbg_autocast_dtype = None
+
+# CPU matting workers running a TorchScript export of BriaRMBG, 0 keeps matting on the device.
+# The export is written on first start if RMBG_TORCHSCRIPT does not exist yet.
+RMBG_CPU_WORKERS = int(os.environ.get('RMBG_CPU_WORKERS', '0'))
+RMBG_CPU_THREADS = int(os.environ.get('RMBG_CPU_THREADS', '1'))
+RMBG_TORCHSCRIPT = os.environ.get('RMBG_TORCHSCRIPT', './models/rmbg_1.4_torchscript.pt')
+
+# Matting resolution tiers (side of the roughly square pixel budget fed to BriaRMBG).
+# 'auto' picks fast when the final output is at most MATTING_AUTO_FAST_MAX_SIDE on its longest side.
+MATTING_RESOLUTIONS = {'fast': 512, 'quality': 1024}
+MATTING_RESOLUTION = os.environ.get('MATTING_RESOLUTION', 'auto')
+MATTING_AUTO_FAST_MAX_SIDE = 768
+
+# Token merging (ToMe) in the self-attention of the highest-resolution UNet layers, the
+# default fraction of merged tokens (0 disables it, requests can set token_merging_ratio).
+# TOKEN_MERGING_PASSES 'highres' merges only in the highres pass, 'all' in both passes.
+TOKEN_MERGING_RATIO = float(os.environ.get('TOKEN_MERGING_RATIO', '0.0'))
+TOKEN_MERGING_PASSES = os.environ.get('TOKEN_MERGING_PASSES', 'highres')
+TOKEN_MERGING_MAX_DOWNSAMPLE = int(os.environ.get('TOKEN_MERGING_MAX_DOWNSAMPLE', '1'))
+MAX_TOKEN_MERGING_RATIO = 0.75
+
+# Step feature caching (DeepCache): every step_cache_interval-th UNet step of a pass runs
+# in full and caches the input of the shallowest up blocks, the steps in between only run
+# the shallow levels. 1 disables it, requests can set step_cache_interval.
+# STEP_CACHE_BRANCH is the number of extra block levels the cheap steps still run.
+STEP_CACHE_INTERVAL = int(os.environ.get('STEP_CACHE_INTERVAL', '1'))
+STEP_CACHE_BRANCH = int(os.environ.get('STEP_CACHE_BRANCH', '0'))
+MAX_STEP_CACHE_INTERVAL = 10
+
+# Request limits checked before a job is queued
+MAX_NUM_SAMPLES = int(os.environ.get('MAX_NUM_SAMPLES', '16'))
+MAX_IMAGE_SIDE = int(os.environ.get('MAX_IMAGE_SIDE', '2048'))
+MAX_HIGHRES_SCALE = float(os.environ.get('MAX_HIGHRES_SCALE', '4.0'))
+
+# Admission control against a peak memory estimate ('auto' enables it on GPU). Jobs where
+# not even one image fits the budget are rejected, larger batches run as micro-batches that fit.
+# The estimator is calibrated once per GPU model with probe jobs (images, width, height) and
+# the result is cached in MEMORY_CALIBRATION_FILE.
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'auto')
+MEMORY_BUDGET_FRACTION = float(os.environ.get('MEMORY_BUDGET_FRACTION', '0.9'))
+MEMORY_SAFETY_MARGIN = float(os.environ.get('MEMORY_SAFETY_MARGIN', '1.2'))
+MEMORY_CALIBRATION_FILE = os.environ.get('MEMORY_CALIBRATION_FILE', './models/memory_calibration.json')
+MEMORY_CALIBRATION_PROBES = [(1, 512, 512), (2, 512, 512), (1, 768, 768), (1, 1024, 1024)]
+
+# Uploads above this many pixels are rejected from the header, before any pixel is decoded
+MAX_INPUT_PIXELS = int(os.environ.get('MAX_INPUT_PIXELS', str(64 * 1024 * 1024)))
+
+BG_SOURCES = ('grey', 'left', 'right', 'top', 'bottom', 'upload')
+# For the fc model the light direction picks the initial latent instead of a background
+FC_BG_SOURCES = ('none', 'left', 'right', 'top', 'bottom')
+
+# Sampler registry: name -> (diffusers scheduler class name, scheduler config)
+SAMPLER_CONFIGS = {
+    'dpmpp_2m_sde_karras': ('DPMSolverMultistepScheduler', dict(
+        num_train_timesteps=1000,
+        beta_start=0.00085,
+        beta_end=0.012,
+        algorithm_type="sde-dpmsolver++",
+        use_karras_sigmas=True,
+        steps_offset=1
+    )),
+    'dpmpp_2m_karras': ('DPMSolverMultistepScheduler', dict(
+        num_train_timesteps=1000,
+        beta_start=0.00085,
+        beta_end=0.012,
+        algorithm_type="dpmsolver++",
+        use_karras_sigmas=True,
+        steps_offset=1
+    )),
+    'ddim': ('DDIMScheduler', dict(
+        num_train_timesteps=1000,
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        clip_sample=False,
+        set_alpha_to_one=False,
+        steps_offset=1
+    )),
+    'euler_a': ('EulerAncestralDiscreteScheduler', dict(
+        num_train_timesteps=1000,
+        beta_start=0.00085,
+        beta_end=0.012,
+        steps_offset=1
+    )),
+}
+DEFAULT_SAMPLER = 'dpmpp_2m_sde_karras'
+
+# Steps used when a request picks a sampler but not a step count
+SAMPLER_DEFAULT_STEPS = {
+    'dpmpp_2m_sde_karras': 20,
+    'dpmpp_2m_karras': 12,
+    'ddim': 25,
+    'euler_a': 25,
+}
+
+# Named quality/speed presets, explicit request fields override preset values
+PRESETS = {
+    'preview': {'sampler': 'dpmpp_2m_karras', 'steps': 8, 'highres_scale': 1.0, 'highres_denoise': 0.5},
+    'fast': {'sampler': 'dpmpp_2m_karras', 'steps': 12, 'highres_scale': 1.25, 'highres_denoise': 0.5},
+    'balanced': {'sampler': 'dpmpp_2m_sde_karras', 'steps': 20, 'highres_scale': 1.5, 'highres_denoise': 0.5},
+    'quality': {'sampler': 'dpmpp_2m_sde_karras', 'steps': 30, 'highres_scale': 2.0, 'highres_denoise': 0.5},
+}
+
+# 'auto' runs the highres pass only when it upscales (highres_scale > 1)
+HIGHRES_MODES = ('auto', 'on', 'off')
+
+class RequestError(Exception):
+    """Invalid request, the message is returned to the client"""
+
+def import_model_libraries():
+    """
+    Import diffusers, transformers and the modules built on them
+    Kept out of module import so the worker registers while they load, safe to call repeatedly.
+    """
+    global _model_libraries_imported, diffusers, StableDiffusionPipeline, StableDiffusionImg2ImgPipeline
+    global AutoencoderKL, UNet2DConditionModel, AttnProcessor2_0, UNet2DConditionOutput
+    global CLIPTextModel, CLIPTokenizer, BriaRMBG
+    global TokenMergingAttnProcessor2_0, cross_attention_kv_cache, token_merging
+    with _model_libraries_lock:
+        if _model_libraries_imported:
+            return
+        import diffusers
+        from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline
+        from diffusers import AutoencoderKL, UNet2DConditionModel
+        from diffusers.models.attention_processor import AttnProcessor2_0
+        from diffusers.models.unets.unet_2d_condition import UNet2DConditionOutput
+        from transformers import CLIPTextModel, CLIPTokenizer
+        from briarmbg import BriaRMBG
+        from attention_processors import TokenMergingAttnProcessor2_0, cross_attention_kv_cache, token_merging
+        _model_libraries_imported = True
+
+def ic_light_checksums(variant):
+    """Expected SHA-256 and size of a variant's IC-Light offsets, pinned or from the hub's LFS metadata"""
+    config = UNET_VARIANTS[variant]
+    if config['sha256'] is not None and config['size'] is not None:
+        return config['sha256'], config['size']
+    from huggingface_hub import get_hf_file_metadata
+    metadata = get_hf_file_metadata(IC_LIGHT_URL.format(filename=config['filename']))
+    if not re.fullmatch(r'[0-9a-f]{64}', metadata.etag or ''):
+        raise BundleError(f"The hub reports no SHA-256 for {config['filename']}")
+    return metadata.etag, metadata.size
+
+def download_models(variant=DEFAULT_UNET_VARIANT, model_dir='./models'):
+    """
+    Download the IC-Light offsets of a variant, resuming partial downloads
+    An existing file is checked first (its SHA-256 too with MODEL_BUNDLE_VERIFY 'sha256')
+    and downloaded again when it is truncated or corrupt.
+    """
+    filename = UNET_VARIANTS[variant]['filename']
+    model_path = os.path.join(model_dir, filename)
+    sha256, size = ic_light_checksums(variant)
     
-    # Load base model
-    sd15_name = 'stablediffusionapi/realistic-vision-v51'
+    if os.path.exists(model_path):
+        problem = file_problem(model_path, sha256, size, hashes=MODEL_BUNDLE_VERIFY == 'sha256')
+        if problem is None:
+            return model_path
+        print(f"IC-Light model {model_path} is corrupt ({problem}), downloading it again...")
+        os.remove(model_path)
+    print(f"Downloading IC-Light model ({variant})...")
+    download_file(IC_LIGHT_URL.format(filename=filename), model_path, sha256=sha256, size=size)
+    print("Model downloaded successfully!")
+    return model_path
+
+def resolve_model_bundle():
+    """Verified model bundle directory to load from, None to load from the hub"""
+    if MODEL_BUNDLE == 'off':
+        return None
+    if MODEL_BUNDLE == 'auto' and not os.path.exists(os.path.join(MODEL_BUNDLE_DIR, MANIFEST_NAME)):
+        print(f"No model bundle at {MODEL_BUNDLE_DIR}, loading models from the hub")
+        return None
+    start = time.time()
+    manifest = verify_bundle(MODEL_BUNDLE_DIR, hashes=MODEL_BUNDLE_VERIFY == 'sha256')
+    print(f"Model bundle {MODEL_BUNDLE_DIR} verified ({len(manifest['files'])} files, "
+          f"{MODEL_BUNDLE_VERIFY}) in {time.time() - start:.1f}s")
+    return MODEL_BUNDLE_DIR
+
+def load_pretrained_models(bundle_dir=None, fuse=True):
+    """
+    Load model components from the hub, or strictly offline from a model bundle
+    fuse folds the matting BatchNorms for inference, bundles are built from unfused weights.
+    """
+    import_model_libraries()
+    sd15_name = bundle_dir or SD15_NAME
+    rmbg_name = os.path.join(bundle_dir, 'rmbg') if bundle_dir else RMBG_NAME
+    offline = bundle_dir is not None
     
     print("Loading tokenizer and text encoder...")
-    tokenizer = CLIPTokenizer.from_pretrained(sd15_name, subfolder="tokenizer")
-    text_encoder = CLIPTextModel.from_pretrained(sd15_name, subfolder="text_encoder")
+    tokenizer = CLIPTokenizer.from_pretrained(sd15_name, subfolder="tokenizer", local_files_only=offline)
+    text_encoder = CLIPTextModel.from_pretrained(sd15_name, subfolder="text_encoder", local_files_only=offline)
     
     print("Loading VAE...")
-    vae = AutoencoderKL.from_pretrained(sd15_name, subfolder="vae")
+    vae = AutoencoderKL.from_pretrained(sd15_name, subfolder="vae", local_files_only=offline)
     
     print("Loading UNet...")
-    unet = UNet2DConditionModel.from_pretrained(sd15_name, subfolder="unet")
+    unet = UNet2DConditionModel.from_pretrained(sd15_name, subfolder="unet", local_files_only=offline)
     
     print("Loading background removal model...")
-    rmbg = BriaRMBG.from_pretrained("briaai/RMBG-1.4")
-    
-    # Modify UNet for IC-Light
-    print("Modifying UNet for IC-Light...")
-    with torch.no_grad():
-        new_conv_in = torch.nn.Conv2d(12, unet.conv_in.out_channels, 
-                                      unet.conv_in.kernel_size, 
-                                      unet.conv_in.stride, 
-                                      unet.conv_in.padding)
-        new_conv_in.weight.zero_()
-        new_conv_in.weight[:, :4, :, :].copy_(unet.conv_in.weight)
-        new_conv_in.bias = unet.conv_in.bias
-        unet.conv_in = new_conv_in
-    
-    # Hook UNet forward
-    unet_original_forward = unet.forward
-    
-    def hooked_unet_forward(sample, timestep, encoder_hidden_states, **kwargs):
-        c_concat = kwargs['cross_attention_kwargs']['concat_conds'].to(sample)
-        c_concat = torch.cat([c_concat] * (sample.shape[0] // c_concat.shape[0]), dim=0)
-        new_sample = torch.cat([sample, c_concat], dim=1)
-        kwargs['cross_attention_kwargs'] = {}
-        return unet_original_forward(new_sample, timestep, encoder_hidden_states, **kwargs)
-    
-    unet.forward = hooked_unet_forward
-    
-    # Load IC-Light weights
+    rmbg = BriaRMBG.from_pretrained(rmbg_name, local_files_only=offline).eval()
+    if fuse:
+        rmbg = rmbg.fuse_batchnorm()
+    
+    return {
+        'tokenizer': tokenizer,
+        'text_encoder': text_encoder,
+        'vae': vae,
+        'unet': unet,
+        'rmbg': rmbg,
+    }
+
+def build_model_bundle(bundle_dir, components=None, sd_offsets=None):
+    """
+    Collect every model artefact into bundle_dir and write its manifest
+    components and sd_offsets default to the hub models and IC-Light downloads.
+    The manifest is written last, so an interrupted build is never loaded.
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+    manifest_path = os.path.join(bundle_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    if components is None:
+        components = load_pretrained_models(fuse=False)
+    for name in ('tokenizer', 'text_encoder', 'vae', 'unet', 'rmbg'):
+        print(f"Saving {name}...")
+        components[name].save_pretrained(os.path.join(bundle_dir, name))
+    for variant, config in UNET_VARIANTS.items():
+        if sd_offsets is not None:
+            sf.save_file(sd_offsets[variant], os.path.join(bundle_dir, config['filename']))
+        else:
+            download_models(variant, bundle_dir)
+    print("Hashing model bundle...")
+    return write_manifest(bundle_dir, sources={
+        'sd15': SD15_NAME, 'rmbg': RMBG_NAME,
+        **{variant: IC_LIGHT_URL.format(filename=config['filename']) for variant, config in UNET_VARIANTS.items()},
+    })
+
+def initialize_models(components=None, sd_offsets=None, target_device=None):
+    """
+    Initialize all models and schedulers
+    components and sd_offsets ({variant: offsets}) default to the pretrained models
+    and the IC-Light weights of every variant in UNET_VARIANTS
+    """
+    global device, tokenizer, text_encoder, vae, unet, rmbg, schedulers, unet_variants, rmbg_autocast_dtype, matting_pool
+    
+    import_model_libraries()
+    print("Initializing models...")
+    device = target_device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f"Using device: {device}")
+    if device.type == 'cpu':
+        configure_cpu_threads()
+    
+    bundle_dir = None
+    if components is None:
+        bundle_dir = resolve_model_bundle()
+        components = load_pretrained_models(bundle_dir)
+    tokenizer = components['tokenizer']
+    text_encoder = components['text_encoder']
+    vae = components['vae']
+    unet = components['unet']
+    rmbg = components['rmbg']
+    
+    # Register IC-Light variants as deltas against the shared base UNet
     print("Loading IC-Light weights...")
-    model_path = download_models()
-    sd_offset = sf.load_file(model_path)
-    sd_origin = unet.state_dict()
-    sd_merged = {k: sd_origin[k] + sd_offset[k] for k in sd_origin.keys()}
-    unet.load_state_dict(sd_merged, strict=True)
-    del sd_offset, sd_origin, sd_merged
+    model_dtypes = select_model_dtypes(device)
+    unet_variants = UNetVariantRegistry(unet, model_dtypes['unet'])
+    for variant, config in UNET_VARIANTS.items():
+        if sd_offsets is not None:
+            sd_offset = sd_offsets[variant]
+        elif bundle_dir is not None:
+            sd_offset = sf.load_file(os.path.join(bundle_dir, config['filename']))
+        else:
+            sd_offset = sf.load_file(download_models(variant))
+        unet_variants.register(variant, sd_offset, config['in_channels'])
+        del sd_offset
+    
+    if RMBG_CPU_WORKERS > 0:
+        print("Starting CPU matting workers...")
+        if not os.path.exists(RMBG_TORCHSCRIPT):
+            export_rmbg(rmbg.float().cpu(), RMBG_TORCHSCRIPT)
+        matting_pool = MattingWorkerPool(RMBG_TORCHSCRIPT, RMBG_CPU_WORKERS, RMBG_CPU_THREADS)
     
     # Move models to device
     print("Moving models to device...")
-    text_encoder = text_encoder.to(device=device, dtype=torch.float16)
-    vae = vae.to(device=device, dtype=torch.bfloat16)
-    unet = unet.to(device=device, dtype=torch.float16)
-    rmbg = rmbg.to(device=device, dtype=torch.float32)
+    print(f"Model dtypes: {', '.join(f'{name} {dtype}' for name, dtype in model_dtypes.items())}")
+    memory_format = torch.channels_last if device.type == 'cpu' and CPU_CHANNELS_LAST else torch.preserve_format
+    text_encoder = text_encoder.to(device=device, dtype=model_dtypes['text_encoder'])
+    vae = vae.to(device=device, dtype=model_dtypes['vae'], memory_format=memory_format)
+    unet = unet.to(device=device, dtype=model_dtypes['unet'], memory_format=memory_format)
+    rmbg = rmbg.to(device=device, dtype=model_dtypes['rmbg'])
+    if RMBG_CHANNELS_LAST:
+        rmbg = rmbg.to(memory_format=torch.channels_last)
+    unet_variants.to(device, memory_format)
+    unet_variants.activate(DEFAULT_UNET_VARIANT)
     
     # Set attention processors
-    unet.set_attn_processor(AttnProcessor2_0())
+    unet.set_attn_processor(TokenMergingAttnProcessor2_0())
     vae.set_attn_processor(AttnProcessor2_0())
     
-    # Create scheduler
-    dpmpp_2m_sde_karras_scheduler = DPMSolverMultistepScheduler(
-        num_train_timesteps=1000,
-        beta_start=0.00085,
-        beta_end=0.012,
-        algorithm_type="sde-dpmsolver++",
-        use_karras_sigmas=True,
-        steps_offset=1
-    )
+    if TORCH_COMPILE_MODE != 'off':
+        compile_models(TORCH_COMPILE_MODE)
     
-    # Create pipelines
-    print("Creating pipelines...")
-    t2i_pipe = StableDiffusionPipeline(
-        vae=vae,
-        text_encoder=text_encoder,
-        tokenizer=tokenizer,
-        unet=unet,
-        scheduler=dpmpp_2m_sde_karras_scheduler,
-        safety_checker=None,
-        requires_safety_checker=False,
-        feature_extractor=None,
-        image_encoder=None
-    )
+    rmbg_autocast_dtype = select_rmbg_precision()
+    
+    # Create scheduler templates, requests clone their own instance from these
+    schedulers = {name: getattr(diffusers, scheduler_class)(**config) for name, (scheduler_class, config) in SAMPLER_CONFIGS.items()}
     
-    i2i_pipe = StableDiffusionImg2ImgPipeline(
+    if TORCH_COMPILE_MODE != 'off' and TORCH_COMPILE_WARMUP:
+        warmup_buckets()
+    
+    if ADMISSION_CONTROL == 'on' or (ADMISSION_CONTROL == 'auto' and device.type == 'cuda'):
+        setup_admission_control()
+    
+    print("Models initialized successfully!")
+
+def memory_device_name():
+    """Name memory calibrations are stored under"""
+    return torch.cuda.get_device_name(device) if device.type == 'cuda' else 'cpu'
+
+def setup_admission_control():
+    """Load or measure the memory calibration and set the per-job memory budget"""
+    global memory_estimator, memory_budget
+    estimator = MemoryEstimator.load(MEMORY_CALIBRATION_FILE, memory_device_name(), MEMORY_SAFETY_MARGIN)
+    if estimator is None:
+        if device.type != 'cuda':
+            print("No CPU memory calibration found, admission control disabled")
+            return
+        estimator = calibrate_memory()
+        os.makedirs(os.path.dirname(os.path.abspath(MEMORY_CALIBRATION_FILE)), exist_ok=True)
+        estimator.save(MEMORY_CALIBRATION_FILE, memory_device_name())
+    # Activate every variant once so the idle footprint includes all variant state
+    for variant in UNET_VARIANTS:
+        unet_variants.activate(variant)
+    unet_variants.activate(DEFAULT_UNET_VARIANT)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        total = torch.cuda.get_device_properties(device).total_memory
+        idle = torch.cuda.memory_allocated(device)
+    else:
+        # On CPU the variants' host weight copies share the RAM with the jobs
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        idle = sum(p.numel() * p.element_size() for model in (text_encoder, vae, unet, rmbg) for p in model.parameters())
+        idle += unet_variants.stats['host_bytes']
+    memory_estimator = estimator
+    memory_budget = total * MEMORY_BUDGET_FRACTION - idle
+    print(f"Job memory budget: {memory_budget / 2 ** 30:.2f} GiB")
+
+@torch.inference_mode()
+def calibrate_memory():
+    """Fit a MemoryEstimator to the peak memory of one-step probe jobs on the GPU"""
+    estimator = MemoryEstimator(safety_margin=MEMORY_SAFETY_MARGIN)
+    for images, width, height in MEMORY_CALIBRATION_PROBES:
+        grey = np.full((height, width, 3), 127, dtype=np.uint8)
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        idle = torch.cuda.memory_allocated(device)
+        with unet_variants.use(DEFAULT_UNET_VARIANT):
+            process(grey, [grey], 'beautiful lighting', width, height, images, torch.Generator(device=device).manual_seed(0),
+                    1, 'best quality', 'lowres', 2.0, 1.0, 0.5, 1.0, DEFAULT_SAMPLER,
+                    {'steps': 0, 'guided_steps': 0}, highres=False)
+        peak = torch.cuda.max_memory_allocated(device) - idle
+        estimator.add_sample(images, width * height, peak)
+        print(f"Memory probe {images}x {width}x{height}: {peak / 2 ** 30:.2f} GiB")
+    estimator.fit()
+    return estimator
+
+def configure_compile_cache(cache_dir):
+    """Point the inductor and triton caches at cache_dir so compiled artefacts outlive the worker"""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(cache_dir))
+    os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(os.path.abspath(cache_dir), 'triton'))
+    import torch._inductor.config as inductor_config
+    # Whole compiled graphs are only cached by newer torch releases
+    if 'fx_graph_cache' in inductor_config._config:
+        inductor_config.fx_graph_cache = True
+
+def compile_models(mode):
+    """
+    torch.compile the UNet, the VAE encoder/decoder and the matting model in place
+    Only the forward functions are replaced, so variant switching, attention processors
+    and the conditioning state keep working on the original modules. Step-cached passes
+    (step_cache_interval > 1) call the UNet blocks directly and run uncompiled.
+    """
+    if mode not in TORCH_COMPILE_MODES:
+        raise ValueError(f"Unknown TORCH_COMPILE_MODE '{mode}', expected one of: {', '.join(TORCH_COMPILE_MODES)}")
+    print(f"Compiling models (mode {mode})...")
+    configure_compile_cache(TORCH_COMPILE_CACHE_DIR)
+    unet.forward = torch.compile(unet.forward, mode=mode)
+    vae.encoder.forward = torch.compile(vae.encoder.forward, mode=mode)
+    vae.decoder.forward = torch.compile(vae.decoder.forward, mode=mode)
+    # Matting feeds follow the foreground aspect ratio, let their shapes stay dynamic
+    rmbg.predict = torch.compile(rmbg.predict, mode=mode, dynamic=True)
+
+@torch.inference_mode()
+def warmup_buckets(steps=2):
+    """
+    Run every resolution bucket and highres scale through every UNet variant once
+    Guidance is truncated halfway so both the CFG and the conditional-only batch compile.
+    With TOKEN_MERGING_RATIO or STEP_CACHE_INTERVAL set, their default path runs too.
+    Returns the seconds spent per (variant, width, height, highres_scale).
+    """
+    paths = [(0.0, 1)]
+    if TOKEN_MERGING_RATIO > 0 or STEP_CACHE_INTERVAL > 1:
+        paths.append((TOKEN_MERGING_RATIO, STEP_CACHE_INTERVAL))
+    # Matting feeds have dynamic shapes, which still specialize on square and single-image feeds
+    square, tall = np.full((64, 64, 3), 127, dtype=np.uint8), np.full((96, 64, 3), 127, dtype=np.uint8)
+    for resolution in MATTING_RESOLUTIONS.values():
+        run_rmbg_batch([square, square, tall], resolution=resolution)
+    timings = {}
+    for width, height in RESOLUTION_BUCKETS:
+        grey = np.full((height, width, 3), 127, dtype=np.uint8)
+        for variant in UNET_VARIANTS:
+            # Same conditioning as process_relight: fc starts from noise or a lighting preference image
+            if variant == 'fc':
+                conditionings = [([], None), ([], build_initial_latent_image('left', width, height))]
+            else:
+                conditionings = [([grey], None)]
+            for highres_scale in HIGHRES_SCALE_BUCKETS:
+                start = time.perf_counter()
+                with unet_variants.use(variant):
+                    for (input_bgs, initial_image), (token_merging_ratio, step_cache_interval) in \
+                            itertools.product(conditionings, paths):
+                        process(grey, input_bgs, 'beautiful lighting', width, height, 1,
+                                torch.Generator(device=device).manual_seed(0), steps, 'best quality', 'lowres', 2.0,
+                                highres_scale, 0.5, 0.5, DEFAULT_SAMPLER, {'steps': 0, 'guided_steps': 0},
+                                initial_image, token_merging_ratio=token_merging_ratio,
+                                step_cache_interval=step_cache_interval)
+                key = (variant, width, height, highres_scale)
+                timings[key] = time.perf_counter() - start
+                print(f"Warmed up {variant} {width}x{height} at highres {highres_scale} in {timings[key]:.1f}s")
+    unet_variants.activate(DEFAULT_UNET_VARIANT)
+    return timings
+
+class ConcatCondUNet:
+    """
+    Per-request view of the shared IC-Light UNet
+    Holds the request's conditioning latents, nothing request-specific is stored on the
+    shared UNet. Their conv_in contribution is computed once per batch layout (with and
+    without CFG) and added on every step instead of concatenating them onto the latents.
+    Cross-attention keys and values of the prompt embeddings are likewise projected once
+    and kept until the view is dropped at the end of the pass. With a step_cache
+    (StepFeatureCache) the steps reuse deep UNet features between full steps.
+    """
+
+    def __init__(self, unet, concat_conds, step_cache=None):
+        self.unet = unet
+        self.concat_conds = concat_conds
+        self.step_cache = step_cache
+        self._base_term = None
+        self._cond_terms = {}
+        self._kv_cache = {}
+
+    def __getattr__(self, name):
+        return getattr(self.unet, name)
+
+    def cond_term(self, sample):
+        """conv_in term of the conditioning for this batch size, computed once per layout"""
+        n = sample.shape[0]
+        if n not in self._cond_terms:
+            if self._base_term is None:
+                self._base_term = self.unet.conv_in.condition_term(self.concat_conds.to(sample))
+            self._cond_terms[n] = self._base_term.repeat(n // self._base_term.shape[0], 1, 1, 1)
+        return self._cond_terms[n]
+
+    def __call__(self, sample, timestep, encoder_hidden_states, return_dict=True, **kwargs):
+        with self.unet.conv_in.conditioned(self.cond_term(sample)), cross_attention_kv_cache(self._kv_cache):
+            if self.step_cache is None:
+                return self.unet(sample, timestep, encoder_hidden_states, return_dict=return_dict, **kwargs)
+            output = self.step_cache(self.unet, sample, timestep, encoder_hidden_states)
+            return UNet2DConditionOutput(sample=output) if return_dict else (output,)
+
+def new_scheduler(sampler):
+    """Clone a fresh scheduler from the frozen config of a registry template"""
+    template = schedulers[sampler]
+    return template.__class__.from_config(template.config)
+
+def make_pipeline(pipeline_class, sampler, concat_conds, step_cache=None):
+    """Create a per-request pipeline around the shared models"""
+    return pipeline_class(
         vae=vae,
         text_encoder=text_encoder,
         tokenizer=tokenizer,
-        unet=unet,
-        scheduler=dpmpp_2m_sde_karras_scheduler,
+        unet=ConcatCondUNet(unet, concat_conds, step_cache),
+        scheduler=new_scheduler(sampler),
         safety_checker=None,
         requires_safety_checker=False,
         feature_extractor=None,
         image_encoder=None
     )
-    
-    print("Models initialized successfully!")
 
 @torch.inference_mode()
 def encode_prompt_inner(txt: str):
@@ -172,8 +649,10 @@ def encode_prompt_inner(txt: str):
 
 @torch.inference_mode()
 def encode_prompt_pair(positive_prompt, negative_prompt):
-    """Encode positive and negative prompts"""
+    """Encode positive and negative prompts, negative_prompt=None skips the unconditional embedding"""
     c = encode_prompt_inner(positive_prompt)
+    if negative_prompt is None:
+        return torch.cat([p[None, ...] for p in c], dim=1), None
     uc = encode_prompt_inner(negative_prompt)
 
     c_len = float(len(c))
@@ -234,26 +713,280 @@ def resize_without_crop(image, target_width, target_height):
     resized_image = pil_image.resize((target_width, target_height), Image.LANCZOS)
     return np.array(resized_image)
 
-@torch.inference_mode()
-def run_rmbg(img, sigma=0.0):
-    """Run background removal"""
+def cpu_supports_bf16():
+    """True if the CPU has native bf16 instructions (AVX512-BF16 or AMX)"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+def select_model_dtypes(target_device):
+    """Dtypes of the diffusion models on a device, see CPU_DTYPE"""
+    if target_device.type == 'cuda':
+        return dict(MODEL_DTYPES)
+    if CPU_DTYPE == 'auto':
+        dtype = torch.bfloat16 if cpu_supports_bf16() else torch.float32
+    elif CPU_DTYPE in CPU_DTYPES:
+        dtype = CPU_DTYPES[CPU_DTYPE]
+    else:
+        raise ValueError(f"Unknown CPU_DTYPE '{CPU_DTYPE}', expected auto, {', '.join(CPU_DTYPES)}")
+    # Matting keeps fp32 weights, its reduced precision comes from autocast (RMBG_PRECISION)
+    return {'text_encoder': dtype, 'vae': dtype, 'unet': dtype, 'rmbg': torch.float32}
+
+def configure_cpu_threads():
+    """Apply CPU_THREADS and CPU_INTEROP_THREADS"""
+    if CPU_THREADS > 0:
+        torch.set_num_threads(CPU_THREADS)
+    if CPU_INTEROP_THREADS > 0:
+        try:
+            torch.set_num_interop_threads(CPU_INTEROP_THREADS)
+        except RuntimeError:
+            # Only allowed once, before any inter-op parallel work has started
+            print("Inter-op thread pool already started, keeping its size")
+    print(f"CPU threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+
+def resolve_rmbg_precision(precision, target_device):
+    """Map a RMBG_PRECISION setting to a precision name supported on the device"""
+    if precision == 'auto':
+        if target_device.type == 'cuda':
+            return 'fp16'
+        return 'bf16' if cpu_supports_bf16() else 'fp32'
+    if precision not in RMBG_AUTOCAST_DTYPES:
+        raise ValueError(f"Unknown RMBG_PRECISION '{precision}', expected auto, {', '.join(RMBG_AUTOCAST_DTYPES)}")
+    if precision == 'fp16' and target_device.type != 'cuda':
+        print("fp16 matting needs a GPU, using bf16 on CPU")
+        return 'bf16'
+    return precision
+
+def rmbg_feed_size(img, resolution=1024):
+    """Matting input size (W, H) for an image, multiples of 64 with about resolution**2 pixels"""
     H, W, C = img.shape
     assert C == 3
-    k = (256.0 / float(H * W)) ** 0.5
-    feed = resize_without_crop(img, int(64 * round(W * k)), int(64 * round(H * k)))
-    feed = numpy2pytorch([feed]).to(device=device, dtype=torch.float32)
-    alpha = rmbg(feed)[0][0]
-    alpha = torch.nn.functional.interpolate(alpha, size=(H, W), mode="bilinear")
-    alpha = alpha.movedim(1, -1)[0]
-    alpha = alpha.detach().float().cpu().numpy().clip(0, 1)
-    result = 127 + (img.astype(np.float32) - 127 + sigma) * alpha
-    return result.clip(0, 255).astype(np.uint8), alpha
-
-def decode_base64_image(base64_string):
-    """Decode base64 string to numpy array"""
-    image_data = base64.b64decode(base64_string)
-    image = Image.open(io.BytesIO(image_data))
-    return np.array(image)
+    k = ((resolution / 64.0) ** 2 / float(H * W)) ** 0.5
+    return int(64 * round(W * k)), int(64 * round(H * k))
+
+def rmbg_feed(imgs, resolution=1024):
+    """Resize images of the same feed size to the matting resolution and move them to the device"""
+    width, height = rmbg_feed_size(imgs[0], resolution)
+    feed = [resize_without_crop(img, width, height) for img in imgs]
+    feed = numpy2pytorch(feed).to(device=device, dtype=torch.float32)
+    if RMBG_CHANNELS_LAST:
+        feed = feed.contiguous(memory_format=torch.channels_last)
+    return feed
+
+def predict_alpha(feed, size, autocast_dtype):
+    """Run the matting model, optionally under autocast, and return alphas (B, H, W, 1) at size (H, W)"""
+    if autocast_dtype is None:
+        alpha = rmbg.predict(feed)
+    else:
+        with torch.autocast(device.type, dtype=autocast_dtype):
+            alpha = rmbg.predict(feed)
+    alpha = torch.nn.functional.interpolate(alpha.float(), size=size, mode="bilinear")
+    return alpha.movedim(1, -1)
+
+@torch.inference_mode()
+def select_rmbg_precision():
+    """Pick the matting autocast dtype, falling back to fp32 if the reference mattes drift"""
+    precision = resolve_rmbg_precision(RMBG_PRECISION, device)
+    autocast_dtype = RMBG_AUTOCAST_DTYPES[precision]
+    if autocast_dtype is None:
+        print("Matting precision: fp32")
+        return None
+    
+    errors = []
+    for path in RMBG_GUARD_IMAGES:
+        if not os.path.exists(path):
+            continue
+        img = np.array(Image.open(path).convert('RGB'))
+        feed = rmbg_feed([img])
+        reference = predict_alpha(feed, img.shape[:2], None)
+        reduced = predict_alpha(feed, img.shape[:2], autocast_dtype)
+        errors.append((reduced - reference).abs().mean().item())
+    
+    if not errors:
+        print(f"Matting precision: {precision} (no reference images found, accuracy guard skipped)")
+        return autocast_dtype
+    if max(errors) > RMBG_GUARD_TOLERANCE:
+        print(f"Matting precision: fp32 ({precision} mean alpha error {max(errors):.4f} "
+              f"exceeds tolerance {RMBG_GUARD_TOLERANCE})")
+        return None
+    print(f"Matting precision: {precision} (mean alpha error {max(errors):.4f} on {len(errors)} reference images)")
+    return autocast_dtype
+
+def working_scale(width, height, image_width, image_height, highres_scale, matting_resolution=0):
+    """
+    Scale factor (at most 1) that shrinks a width x height upload to the largest size any pass needs
+    Diffusion center crops to at most the highres size and matting reads about
+    matting_resolution**2 pixels, anything above that only costs memory and time.
+    """
+    scale = max(highres_scale, 1.0)
+    target_width = int(round(image_width * scale / 64.0) * 64)
+    target_height = int(round(image_height * scale / 64.0) * 64)
+    k = max(target_width / width, target_height / height, matting_resolution / float(width * height) ** 0.5)
+    return min(k, 1.0)
+
+def downscale_to_working_size(image, image_width, image_height, highres_scale, matting_resolution=0):
+    """Shrink an upload to the largest size any pass needs, keeping the aspect ratio"""
+    H, W = image.shape[:2]
+    k = working_scale(W, H, image_width, image_height, highres_scale, matting_resolution)
+    if k >= 1.0:
+        return image
+    return resize_without_crop(image, int(math.ceil(W * k)), int(math.ceil(H * k)))
+
+def resolve_matting_resolution(tier, image_width, image_height, highres_scale):
+    """Map a matting tier name or 'auto' to the matting resolution for a request"""
+    if tier == 'auto':
+        output_side = max(image_width, image_height) * max(highres_scale, 1.0)
+        tier = 'fast' if output_side <= MATTING_AUTO_FAST_MAX_SIDE else 'quality'
+    if tier not in MATTING_RESOLUTIONS:
+        raise RequestError(f"Unknown matting_resolution '{tier}', expected auto, {', '.join(MATTING_RESOLUTIONS)}")
+    return MATTING_RESOLUTIONS[tier]
+
+def select_bucket(image_width, image_height):
+    """Resolution bucket (W, H) a request runs at, see RESOLUTION_BUCKETING"""
+    if RESOLUTION_BUCKETING not in RESOLUTION_BUCKETING_MODES:
+        raise ValueError(f"Unknown RESOLUTION_BUCKETING '{RESOLUTION_BUCKETING}', expected one of: {', '.join(RESOLUTION_BUCKETING_MODES)}")
+    if RESOLUTION_BUCKETING == 'pad':
+        covering = [b for b in RESOLUTION_BUCKETS if b[0] >= image_width and b[1] >= image_height]
+        if not covering:
+            raise RequestError(f"Image size {image_width}x{image_height} is larger than every resolution bucket")
+        return min(covering, key=lambda b: b[0] * b[1])
+    aspect = math.log(image_width / image_height)
+    return min(RESOLUTION_BUCKETS, key=lambda b: (round(abs(math.log(b[0] / b[1]) - aspect), 3),
+                                                  abs(b[0] * b[1] - image_width * image_height)))
+
+def snap_highres_scale(highres_scale):
+    """Nearest of HIGHRES_SCALE_BUCKETS, scales up to 1 (no highres pass) are kept"""
+    if highres_scale <= 1.0:
+        return highres_scale
+    return min(HIGHRES_SCALE_BUCKETS, key=lambda scale: abs(scale - highres_scale))
+
+def pad_to_bucket(image, image_width, image_height, bucket_width, bucket_height, value=127):
+    """
+    Lay an input out for a padded bucket
+    The image is centre cropped to the requested aspect ratio at its own resolution, then
+    padded evenly to the bucket aspect ratio with value (edge pixels if value is None).
+    """
+    H, W = image.shape[:2]
+    k = min(W / image_width, H / image_height)
+    content_width, content_height = int(round(image_width * k)), int(round(image_height * k))
+    left, top = (W - content_width) // 2, (H - content_height) // 2
+    image = image[top:top + content_height, left:left + content_width]
+    pad_width = int(round(bucket_width * k)) - content_width
+    pad_height = int(round(bucket_height * k)) - content_height
+    pads = [(pad_height // 2, pad_height - pad_height // 2),
+            (pad_width // 2, pad_width - pad_width // 2)] + [(0, 0)] * (image.ndim - 2)
+    if value is None:
+        return np.pad(image, pads, mode='edge')
+    return np.pad(image, pads, constant_values=value)
+
+def crop_from_bucket(image, image_width, image_height, bucket_width, bucket_height):
+    """Cut the requested window back out of a result generated for a padded bucket"""
+    H, W = image.shape[:2]
+    crop_width = int(round(image_width * W / bucket_width))
+    crop_height = int(round(image_height * H / bucket_height))
+    left, top = (W - crop_width) // 2, (H - crop_height) // 2
+    return np.ascontiguousarray(image[top:top + crop_height, left:left + crop_width])
+
+@torch.inference_mode()
+def run_rmbg_batch(imgs, sigma=0.0, resolution=1024):
+    """
+    Run background removal on several images
+    Images with the same matting input size share one forward pass.
+    Returns a list of (composited image, alpha) in input order.
+    """
+    groups = {}
+    for i, img in enumerate(imgs):
+        groups.setdefault((rmbg_feed_size(img, resolution), img.shape[:2]), []).append(i)
+    
+    results = [None] * len(imgs)
+    for (_, size), indices in groups.items():
+        alphas = predict_alpha(rmbg_feed([imgs[i] for i in indices], resolution), size, rmbg_autocast_dtype)
+        for i, alpha in zip(indices, alphas):
+            results[i] = composite_foreground(imgs[i], alpha, sigma)
+    return results
+
+def run_rmbg(img, sigma=0.0, resolution=1024):
+    """Run background removal"""
+    return run_rmbg_batch([img], sigma, resolution)[0]
+
+@torch.inference_mode()
+def composite_foreground(img, alpha, sigma=0.0):
+    """
+    Composite an image over grey with an alpha (H, W, 1) tensor or array in [0, 1]
+    Runs on the device, only the uint8 result and the alpha come back.
+    """
+    alpha = torch.as_tensor(alpha).to(device=device, dtype=torch.float32).clip(0, 1)
+    img = torch.from_numpy(img).to(device)
+    result = 127 + (img.float() - 127 + sigma) * alpha
+    return result.clip(0, 255).to(torch.uint8).cpu().numpy(), alpha.cpu().numpy()
+
+@torch.inference_mode()
+def cpu_matte(img, resolution=1024):
+    """Compute the alpha (H, W, 1) of an image on the CPU matting workers"""
+    width, height = rmbg_feed_size(img, resolution)
+    feed = numpy2pytorch([resize_without_crop(img, width, height)]).contiguous().numpy()
+    alpha = torch.from_numpy(matting_pool.submit(feed).result())
+    alpha = torch.nn.functional.interpolate(alpha, size=img.shape[:2], mode="bilinear")
+    return alpha.movedim(1, -1)[0].clip(0, 1).numpy()
+
+def open_base64_image(base64_string):
+    """Open a base64 image lazily, rejecting images above MAX_INPUT_PIXELS from the header alone"""
+    image = Image.open(io.BytesIO(base64.b64decode(base64_string)))
+    width, height = image.size
+    if width * height > MAX_INPUT_PIXELS:
+        raise RequestError(f"Image is {width}x{height}, more than the {MAX_INPUT_PIXELS} pixel limit")
+    return image
+
+def has_transparency(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+def decode_base64_matte(base64_string):
+    """
+    Decode a base64 alpha matte to a uint8 (H, W) array
+    Mattes with transparency use their alpha channel, unless it is fully opaque, and
+    greyscale or colour mattes their luminance. The EXIF orientation is applied.
+    """
+    image = ImageOps.exif_transpose(open_base64_image(base64_string))
+    if has_transparency(image):
+        alpha = image.convert('RGBA').getchannel('A')
+        if alpha.getextrema() != (255, 255):
+            return np.array(alpha)
+    return np.array(image.convert('L'))
+
+def decode_base64_image(base64_string, scale_for=None, stats=None):
+    """
+    Decode a base64 image to an RGB uint8 numpy array
+    Rejects images above MAX_INPUT_PIXELS from the header alone and applies the EXIF
+    orientation. scale_for(width, height) may return a downscale factor for the
+    upright image, JPEGs are then decoded at reduced scale (draft mode) close to it.
+    Transparent pixels are composited over grey. Fills stats with sizes and decode time.
+    """
+    start = time.perf_counter()
+    image = open_base64_image(base64_string)
+    width, height = image.size
+    
+    if scale_for is not None:
+        # Orientations 5-8 rotate by 90 degrees, the pipeline sees the upright size
+        transposed = image.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8)
+        k = scale_for(height, width) if transposed else scale_for(width, height)
+        if k < 1.0:
+            image.draft('RGB', (int(math.ceil(width * k)), int(math.ceil(height * k))))
+    
+    image = ImageOps.exif_transpose(image)
+    if has_transparency(image):
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (127, 127, 127, 255))
+        image = Image.alpha_composite(background, image)
+    result = np.array(image.convert('RGB'))
+    
+    if stats is not None:
+        stats['original_size'] = [width, height]
+        stats['decoded_size'] = [result.shape[1], result.shape[0]]
+        stats['decode_seconds'] = round(time.perf_counter() - start, 4)
+    return result
 
 def encode_image_to_base64(image_array):
     """Encode numpy array to base64 string"""
@@ -262,16 +995,8 @@ def encode_image_to_base64(image_array):
     image.save(buffered, format="PNG")
     return base64.b64encode(buffered.getvalue()).decode()
 
-@torch.inference_mode()
-def process_relight(input_fg, input_bg, prompt, image_width=512, image_height=640, 
-                   num_samples=1, seed=12345, steps=20, 
-                   a_prompt='best quality', 
-                   n_prompt='lowres, bad anatomy, bad hands, cropped, worst quality',
-                   cfg=7.0, highres_scale=1.5, highres_denoise=0.5, 
-                   bg_source='grey'):
-    """Process relighting with foreground and background"""
-    
-    # Handle background source
+def build_background(bg_source, input_bg, image_width, image_height):
+    """Build the background conditioning image for a background source"""
     if bg_source == 'grey':
         input_bg = np.zeros(shape=(image_height, image_width, 3), dtype=np.uint8) + 64
     elif bg_source == 'left':
@@ -290,34 +1015,151 @@ def process_relight(input_fg, input_bg, prompt, image_width=512, image_height=64
         gradient = np.linspace(32, 224, image_height)[:, None]
         image = np.tile(gradient, (1, image_width))
         input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
-    
-    # Remove background from foreground
-    input_fg, matting = run_rmbg(input_fg)
-    
-    rng = torch.Generator(device=device).manual_seed(seed)
+    return input_bg
+
+def build_initial_latent_image(bg_source, image_width, image_height):
+    """Build the lighting preference image the fc model starts from, None for no preference"""
+    input_bg = None
+    if bg_source == 'left':
+        gradient = np.linspace(255, 0, image_width)
+        image = np.tile(gradient, (image_height, 1))
+        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+    elif bg_source == 'right':
+        gradient = np.linspace(0, 255, image_width)
+        image = np.tile(gradient, (image_height, 1))
+        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+    elif bg_source == 'top':
+        gradient = np.linspace(255, 0, image_height)[:, None]
+        image = np.tile(gradient, (1, image_width))
+        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+    elif bg_source == 'bottom':
+        gradient = np.linspace(0, 255, image_height)[:, None]
+        image = np.tile(gradient, (1, image_width))
+        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+    return input_bg
+
+def make_guidance_callback(cfg_truncation, stats):
+    """
+    Step-end callback that counts guided steps and, once the first cfg_truncation
+    fraction of the pass is done, drops the unconditional branch for the remaining steps
+    """
+    def callback(pipe, step_index, timestep, callback_kwargs):
+        stats['steps'] += 1
+        if pipe.do_classifier_free_guidance:
+            stats['guided_steps'] += 1
+            if step_index + 1 >= math.ceil(cfg_truncation * pipe.num_timesteps):
+                pipe._guidance_scale = 1.0
+                # prompt_embeds is [unconds, conds], keep the conditional half
+                callback_kwargs['prompt_embeds'] = callback_kwargs['prompt_embeds'].chunk(2)[1]
+        return callback_kwargs
+    return callback
+
+def denoise_steps(steps, strength):
+    """Scheduler steps for an img2img pass that runs about steps denoising steps, never none"""
+    return max(int(round(steps / strength)), math.ceil(1 / strength))
+
+def guidance_report(stats):
+    """Summarise UNet work saved against running CFG on every step"""
+    full_rows = 2 * stats['steps']
+    rows = stats['steps'] + stats['guided_steps']
+    return {
+        "steps": stats['steps'],
+        "guided_steps": stats['guided_steps'],
+        "unet_batch_saving": round(1.0 - rows / full_rows, 4) if full_rows else 0.0
+    }
+
+@torch.inference_mode()
+def encode_concat_conds(fg, bgs):
+    """
+    VAE-encode the foreground once together with every background
+    Returns one conditioning latent per background, foreground and background stacked on channels.
+    Without backgrounds (fc model) the foreground latent alone is the conditioning.
+    """
+    latents = numpy2pytorch([fg] + bgs).to(device=vae.device, dtype=vae.dtype)
+    latents = vae.encode(latents).latent_dist.mode() * vae.config.scaling_factor
+    fg_latent, bg_latents = latents[:1], latents[1:]
+    if not bgs:
+        return fg_latent
+    return torch.cat([fg_latent.repeat(len(bgs), 1, 1, 1), bg_latents], dim=1)
+
+@torch.inference_mode()
+def process(input_fg, input_bgs, prompt, image_width, image_height, num_samples, generator, steps,
+            a_prompt, n_prompt, cfg, highres_scale, highres_denoise, cfg_truncation, sampler, guidance_stats,
+            initial_image=None, lowres_denoise=0.9, highres=True, token_merging_ratio=0.0,
+            step_cache_interval=1):
+    """
+    Run both diffusion passes for a matted foreground under one or more backgrounds
+    All backgrounds share the prompt encoding and foreground latent and run as one batch,
+    images are ordered background-major. Returns decoded pixels in [-1, 1].
+    An empty input_bgs conditions on the foreground only (fc model), and initial_image
+    starts the first pass from that image at lowres_denoise strength instead of pure noise.
+    With highres=False the first pass is decoded and returned directly.
+    token_merging_ratio merges that fraction of self-attention tokens in the highres pass
+    (and the first pass too with TOKEN_MERGING_PASSES 'all').
+    step_cache_interval > 1 reuses deep UNet features between full steps in both passes,
+    counting full and cached steps in guidance_stats['step_cache'].
+    """
+    num_images = max(len(input_bgs), 1) * num_samples
     
     fg = resize_and_center_crop(input_fg, image_width, image_height)
-    bg = resize_and_center_crop(input_bg, image_width, image_height)
-    concat_conds = numpy2pytorch([fg, bg]).to(device=vae.device, dtype=vae.dtype)
-    concat_conds = vae.encode(concat_conds).latent_dist.mode() * vae.config.scaling_factor
-    concat_conds = torch.cat([c[None, ...] for c in concat_conds], dim=1)
+    bgs = [resize_and_center_crop(input_bg, image_width, image_height) for input_bg in input_bgs]
+    concat_conds = encode_concat_conds(fg, bgs)
+    if len(input_bgs) > 1:
+        concat_conds = concat_conds.repeat_interleave(num_samples, dim=0)
     
+    use_cfg = cfg > 1.0 and cfg_truncation > 0.0
+    if not use_cfg:
+        cfg = 1.0
     conds, unconds = encode_prompt_pair(positive_prompt=prompt + ', ' + a_prompt, 
-                                       negative_prompt=n_prompt)
+                                       negative_prompt=n_prompt if use_cfg else None)
+    
+    def step_cache():
+        if step_cache_interval <= 1:
+            return None
+        stats = guidance_stats.setdefault('step_cache', {'interval': step_cache_interval})
+        return StepFeatureCache(step_cache_interval, STEP_CACHE_BRANCH, stats)
     
     # First pass
-    latents = t2i_pipe(
-        prompt_embeds=conds,
-        negative_prompt_embeds=unconds,
-        width=image_width,
-        height=image_height,
-        num_inference_steps=steps,
-        num_images_per_prompt=num_samples,
-        generator=rng,
-        output_type='latent',
-        guidance_scale=cfg,
-        cross_attention_kwargs={'concat_conds': concat_conds},
-    ).images.to(vae.dtype) / vae.config.scaling_factor
+    first_pass_ratio = token_merging_ratio if TOKEN_MERGING_PASSES == 'all' else 0.0
+    with token_merging(first_pass_ratio, image_height // 8, image_width // 8, TOKEN_MERGING_MAX_DOWNSAMPLE):
+        if initial_image is None:
+            t2i_pipe = make_pipeline(StableDiffusionPipeline, sampler, concat_conds, step_cache())
+            latents = t2i_pipe(
+                prompt_embeds=conds,
+                negative_prompt_embeds=unconds,
+                width=image_width,
+                height=image_height,
+                num_inference_steps=steps,
+                num_images_per_prompt=num_images,
+                generator=generator,
+                output_type='latent',
+                guidance_scale=cfg,
+                callback_on_step_end=make_guidance_callback(cfg_truncation, guidance_stats),
+                callback_on_step_end_tensor_inputs=['prompt_embeds'],
+            ).images.to(vae.dtype) / vae.config.scaling_factor
+        else:
+            initial_image = resize_and_center_crop(initial_image, image_width, image_height)
+            initial_latent = numpy2pytorch([initial_image]).to(device=vae.device, dtype=vae.dtype)
+            initial_latent = vae.encode(initial_latent).latent_dist.mode() * vae.config.scaling_factor
+            i2i_pipe = make_pipeline(StableDiffusionImg2ImgPipeline, sampler, concat_conds, step_cache())
+            latents = i2i_pipe(
+                image=initial_latent,
+                strength=lowres_denoise,
+                prompt_embeds=conds,
+                negative_prompt_embeds=unconds,
+                width=image_width,
+                height=image_height,
+                num_inference_steps=denoise_steps(steps, lowres_denoise),
+                num_images_per_prompt=num_images,
+                generator=generator,
+                output_type='latent',
+                guidance_scale=cfg,
+                callback_on_step_end=make_guidance_callback(cfg_truncation, guidance_stats),
+                callback_on_step_end_tensor_inputs=['prompt_embeds'],
+            ).images.to(vae.dtype) / vae.config.scaling_factor
+    
+    if not highres:
+        return vae.decode(latents).sample
     
     pixels = vae.decode(latents).sample
     pixels = pytorch2numpy(pixels)
@@ -334,103 +1176,627 @@ def process_relight(input_fg, input_bg, prompt, image_width=512, image_height=64
     
     image_height, image_width = latents.shape[2] * 8, latents.shape[3] * 8
     fg = resize_and_center_crop(input_fg, image_width, image_height)
-    bg = resize_and_center_crop(input_bg, image_width, image_height)
-    concat_conds = numpy2pytorch([fg, bg]).to(device=vae.device, dtype=vae.dtype)
-    concat_conds = vae.encode(concat_conds).latent_dist.mode() * vae.config.scaling_factor
-    concat_conds = torch.cat([c[None, ...] for c in concat_conds], dim=1)
-    
-    latents = i2i_pipe(
-        image=latents,
-        strength=highres_denoise,
-        prompt_embeds=conds,
-        negative_prompt_embeds=unconds,
-        width=image_width,
-        height=image_height,
-        num_inference_steps=int(round(steps / highres_denoise)),
-        num_images_per_prompt=num_samples,
-        generator=rng,
-        output_type='latent',
-        guidance_scale=cfg,
-        cross_attention_kwargs={'concat_conds': concat_conds},
-    ).images.to(vae.dtype) / vae.config.scaling_factor
+    bgs = [resize_and_center_crop(input_bg, image_width, image_height) for input_bg in input_bgs]
+    concat_conds = encode_concat_conds(fg, bgs)
+    if len(input_bgs) > 1:
+        concat_conds = concat_conds.repeat_interleave(num_samples, dim=0)
     
-    pixels = vae.decode(latents).sample
-    pixels = pytorch2numpy(pixels, quant=False)
-    results = [(x * 255.0).clip(0, 255).astype(np.uint8) for x in pixels]
+    i2i_pipe = make_pipeline(StableDiffusionImg2ImgPipeline, sampler, concat_conds, step_cache())
+    with token_merging(token_merging_ratio, latents.shape[2], latents.shape[3], TOKEN_MERGING_MAX_DOWNSAMPLE):
+        latents = i2i_pipe(
+            image=latents,
+            strength=highres_denoise,
+            prompt_embeds=conds,
+            negative_prompt_embeds=unconds,
+            width=image_width,
+            height=image_height,
+            num_inference_steps=denoise_steps(steps, highres_denoise),
+            num_images_per_prompt=num_images,
+            generator=generator,
+            output_type='latent',
+            guidance_scale=cfg,
+            callback_on_step_end=make_guidance_callback(cfg_truncation, guidance_stats),
+            callback_on_step_end_tensor_inputs=['prompt_embeds'],
+        ).images.to(vae.dtype) / vae.config.scaling_factor
+    
+    return vae.decode(latents).sample
+
+@torch.inference_mode()
+def process_relight(input_fg, input_bg, prompt, image_width=512, image_height=640, 
+                   num_samples=1, seed=12345, steps=20, 
+                   a_prompt='best quality', 
+                   n_prompt='lowres, bad anatomy, bad hands, cropped, worst quality',
+                   cfg=7.0, highres_scale=1.5, highres_denoise=0.5, 
+                   bg_source='grey', cfg_truncation=1.0, sampler=DEFAULT_SAMPLER,
+                   model=DEFAULT_UNET_VARIANT, lowres_denoise=0.9, matting_resolution=1024,
+                   foreground_alpha=None, seeds=None, highres=True, micro_batch_size=None,
+                   token_merging_ratio=0.0, step_cache_interval=1, stats=None):
+    """
+    Process relighting with foreground and background
+    cfg_truncation is the fraction of steps in each pass that use classifier-free guidance,
+    cfg <= 1 or cfg_truncation <= 0 skips the unconditional branch entirely.
+    With model='fc' there is no background condition, bg_source picks the initial
+    lighting (none, left, right, top, bottom) denoised at lowres_denoise.
+    matting_resolution is the BriaRMBG input size (about matting_resolution**2 pixels),
+    a precomputed foreground_alpha (H, W, 1) in [0, 1] skips matting.
+    seeds gives every sample its own generator (and sets num_samples), so each image
+    is reproducible alone or in any batch; otherwise all samples draw from seed.
+    With seeds, micro_batch_size diffuses at most that many samples at a time.
+    highres=False skips the highres pass and returns images at the base size.
+    token_merging_ratio merges that fraction of self-attention tokens in the highres pass,
+    step_cache_interval > 1 runs only every interval-th UNet step in full (DeepCache).
+    If a stats dict is given it is filled with per-request guidance and model statistics.
+    """
+    
+    if model == 'fc':
+        input_bgs = []
+        initial_image = build_initial_latent_image(bg_source, image_width, image_height)
+    else:
+        input_bgs = [build_background(bg_source, input_bg, image_width, image_height)]
+        initial_image = None
+    
+    # Remove background from foreground
+    if foreground_alpha is None:
+        input_fg, matting = run_rmbg(input_fg, resolution=matting_resolution)
+    else:
+        input_fg, matting = composite_foreground(input_fg, foreground_alpha)
+    
+    if seeds is not None:
+        num_samples = len(seeds)
+        rng = [torch.Generator(device=device).manual_seed(s) for s in seeds]
+        micro_batch_size = micro_batch_size or num_samples
+        batches = [rng[i:i + micro_batch_size] for i in range(0, num_samples, micro_batch_size)]
+    else:
+        batches = [torch.Generator(device=device).manual_seed(seed)]
+    guidance_stats = {'steps': 0, 'guided_steps': 0}
+    
+    results = []
+    with unet_variants.use(model) as model_info:
+        for batch_rng in batches:
+            batch_size = len(batch_rng) if isinstance(batch_rng, list) else num_samples
+            pixels = process(input_fg, input_bgs, prompt, image_width, image_height, batch_size, batch_rng, steps,
+                             a_prompt, n_prompt, cfg, highres_scale, highres_denoise, cfg_truncation, sampler, guidance_stats,
+                             initial_image, lowres_denoise, highres, token_merging_ratio, step_cache_interval)
+            pixels = pytorch2numpy(pixels, quant=False)
+            results += [(x * 255.0).clip(0, 255).astype(np.uint8) for x in pixels]
+    
+    if stats is not None:
+        stats['guidance'] = guidance_report(guidance_stats)
+        stats['model'] = model_info
+        if 'step_cache' in guidance_stats:
+            stats['step_cache'] = guidance_stats['step_cache']
     
     return results
 
-def handler(event):
+@torch.inference_mode()
+def compute_normal(left, right, bottom, top, matting, sigma=10.0):
     """
-    RunPod handler function
+    Estimate a normal map from four directionally lit images
+    Images are (3, H, W) tensors in [0, 1], matting is (H, W) in [0, 1].
+    Returns the normal map and the four shading maps, all in [-1, 1].
+    """
+    shading = torch.stack([left, right, bottom, top], dim=0)
+    ambient = shading.mean(dim=0, keepdim=True)
+    
+    e = 1e-5
+    left, right, bottom, top = ((shading + e) / (ambient + e) - 1.0).unbind(0)
+    
+    u = ((right - left) * 0.5).mean(dim=0)
+    v = ((top - bottom) * 0.5).mean(dim=0)
+    h = (1.0 - u ** 2.0 - v ** 2.0).clip(0, 1e5) ** (0.5 * sigma)
+    
+    normal = torch.stack([u, v, h], dim=0)
+    normal = normal / normal.square().sum(dim=0, keepdim=True).sqrt()
+    flat = torch.zeros_like(normal)
+    flat[2] = 1.0
+    normal = normal * matting + flat * (1 - matting)
+    
+    return normal, [left, right, bottom, top]
+
+@torch.inference_mode()
+def process_normal(input_fg, input_bg, prompt, image_width=512, image_height=640, 
+                   num_samples=1, seed=12345, steps=20, 
+                   a_prompt='best quality', 
+                   n_prompt='lowres, bad anatomy, bad hands, cropped, worst quality',
+                   cfg=7.0, highres_scale=1.5, highres_denoise=0.5, 
+                   bg_source='grey', cfg_truncation=1.0, sampler=DEFAULT_SAMPLER,
+                   model=DEFAULT_UNET_VARIANT, lowres_denoise=0.9, matting_resolution=1024,
+                   foreground_alpha=None, seeds=None, highres=True, micro_batch_size=None,
+                   token_merging_ratio=0.0, step_cache_interval=1, stats=None):
     """
+    Estimate normals by relighting the foreground from the left, right, bottom and top
+    The four lights run as one batch (or micro_batch_size lights at a time), each with its
+    own generator seeded like a single run.
+    Needs the background-conditioned fbc model, input_bg, num_samples, seeds and bg_source are ignored.
+    Returns the normal map, the four shading maps and the four relit images.
+    """
+    if foreground_alpha is None:
+        input_fg, matting = run_rmbg(input_fg, sigma=16, resolution=matting_resolution)
+    else:
+        input_fg, matting = composite_foreground(input_fg, foreground_alpha, sigma=16)
+    
+    directions = ['left', 'right', 'bottom', 'top']
+    input_bgs = [build_background(direction, None, image_width, image_height) for direction in directions]
+    generators = [torch.Generator(device=device).manual_seed(seed) for _ in directions]
+    guidance_stats = {'steps': 0, 'guided_steps': 0}
+    
+    micro_batch_size = micro_batch_size or len(directions)
+    with unet_variants.use('fbc') as model_info:
+        pixels = torch.cat([
+            process(input_fg, input_bgs[i:i + micro_batch_size], prompt, image_width, image_height, 1,
+                    generators[i:i + micro_batch_size], steps, a_prompt, n_prompt, cfg, highres_scale,
+                    highres_denoise, cfg_truncation, sampler, guidance_stats, highres=highres,
+                    token_merging_ratio=token_merging_ratio, step_cache_interval=step_cache_interval)
+            for i in range(0, len(directions), micro_batch_size)])
+    pixels = (pixels.float() * 0.5 + 0.5).clip(0, 1)
+    
+    h, w = pixels.shape[2], pixels.shape[3]
+    matting = resize_and_center_crop((matting[..., 0] * 255.0).clip(0, 255).astype(np.uint8), w, h)
+    matting = torch.from_numpy(matting).to(pixels).div(255.0)
+    
+    normal, shading = compute_normal(*pixels.unbind(0), matting)
+    relit = [p * 2.0 - 1.0 for p in pixels.unbind(0)]
+    
+    results = torch.stack([normal] + shading + relit, dim=0)
+    results = (results * 127.5 + 127.5).clip(0, 255).to(torch.uint8).movedim(1, -1).cpu().numpy()
+    
+    if stats is not None:
+        stats['guidance'] = guidance_report(guidance_stats)
+        stats['model'] = model_info
+        if 'step_cache' in guidance_stats:
+            stats['step_cache'] = guidance_stats['step_cache']
+    
+    return list(results)
+
+@torch.inference_mode()
+def process_matte(input_fg, matting_resolution=1024, foreground_alpha=None, stats=None, **unused):
+    """Only remove the background, returns the alpha as a single greyscale image"""
+    if foreground_alpha is None:
+        _, foreground_alpha = run_rmbg(input_fg, resolution=matting_resolution)
+    return [(np.asarray(foreground_alpha)[..., 0] * 255.0).round().clip(0, 255).astype(np.uint8)]
+
+PROCESS_MODES = {
+    'relight': process_relight,
+    'normal': process_normal,
+    'matte_only': process_matte,
+}
+
+NORMAL_OUTPUT_LABELS = [
+    'normal',
+    'shading_left', 'shading_right', 'shading_bottom', 'shading_top',
+    'relit_left', 'relit_right', 'relit_bottom', 'relit_top',
+]
+
+def resolve_sampling_params(input_data):
+    """Resolve sampler, steps and highres params from the preset, the sampler and explicit fields"""
+    preset_name = input_data.get('preset')
+    if preset_name is not None and preset_name not in PRESETS:
+        raise RequestError(f"Unknown preset '{preset_name}', expected one of: {', '.join(PRESETS)}")
+    preset = PRESETS.get(preset_name, {})
+    
+    sampler = input_data.get('sampler', preset.get('sampler', DEFAULT_SAMPLER))
+    if sampler not in SAMPLER_CONFIGS:
+        raise RequestError(f"Unknown sampler '{sampler}', expected one of: {', '.join(SAMPLER_CONFIGS)}")
+    
+    highres_scale = input_data.get('highres_scale', preset.get('highres_scale', 1.5))
+    if isinstance(highres_scale, bool) or not isinstance(highres_scale, (int, float)) or not 0 < highres_scale <= MAX_HIGHRES_SCALE:
+        raise RequestError(f"'highres_scale' must be a number above 0 and at most {MAX_HIGHRES_SCALE}")
+    highres = input_data.get('highres', 'auto')
+    if highres not in HIGHRES_MODES:
+        raise RequestError(f"Unknown highres '{highres}', expected one of: {', '.join(HIGHRES_MODES)}")
+    
+    steps = input_data.get('steps', preset.get('steps', SAMPLER_DEFAULT_STEPS[sampler]))
+    if isinstance(steps, bool) or not isinstance(steps, int) or steps < 1:
+        raise RequestError("'steps' must be a positive integer")
+    highres_denoise = input_data.get('highres_denoise', preset.get('highres_denoise', 0.5))
+    if isinstance(highres_denoise, bool) or not isinstance(highres_denoise, (int, float)) or not 0 < highres_denoise <= 1:
+        raise RequestError("'highres_denoise' must be a number above 0 and at most 1")
+    
+    return {
+        'sampler': sampler,
+        'steps': steps,
+        'highres': highres == 'on' or (highres == 'auto' and highres_scale > 1.0),
+        'highres_scale': highres_scale,
+        'highres_denoise': highres_denoise,
+    }
+
+def sample_seed(seed, index):
+    """
+    Seed of sample index in a multi-sample request seeded with seed
+    Hashed rather than seed + index, so sample i of one seed is not sample 0 of another.
+    """
+    digest = hashlib.sha256(f"{seed}:{index}".encode()).digest()
+    return int.from_bytes(digest[:4], 'big')
+
+def admit_job(num_images, pixels):
+    """
+    Check a job of num_images images at pixels output pixels against the memory budget
+    Returns the micro-batch size and an admission report (None without admission control),
+    raises RequestError if not even a single image fits.
+    """
+    if memory_estimator is None:
+        return num_images, None
+    micro_batch_size = min(memory_estimator.max_batch(pixels, memory_budget), num_images)
+    if micro_batch_size < 1:
+        raise RequestError(
+            f"Request needs about {memory_estimator.estimate(1, pixels) / 2 ** 30:.1f} GiB for a single image but "
+            f"the worker has {memory_budget / 2 ** 30:.1f} GiB, reduce image_width, image_height or highres_scale")
+    return micro_batch_size, {
+        'estimated_gib': round(memory_estimator.estimate(micro_batch_size, pixels) / 2 ** 30, 2),
+        'budget_gib': round(memory_budget / 2 ** 30, 2),
+        'micro_batch_size': micro_batch_size,
+        'micro_batches': math.ceil(num_images / micro_batch_size),
+    }
+
+def prepare_job(input_data):
+    """CPU stage: validate the request, decode images and build the background"""
+    # Validate required fields
+    if 'foreground_image' not in input_data:
+        raise RequestError("Missing required field: 'foreground_image'")
+    
+    mode = input_data.get('mode', 'relight')
+    if mode not in PROCESS_MODES:
+        raise RequestError(f"Unknown mode '{mode}', expected one of: {', '.join(PROCESS_MODES)}")
+    
+    model = input_data.get('model', DEFAULT_UNET_VARIANT)
+    if model not in UNET_VARIANTS:
+        raise RequestError(f"Unknown model '{model}', expected one of: {', '.join(UNET_VARIANTS)}")
+    if mode == 'normal' and model != 'fbc':
+        raise RequestError("mode 'normal' requires model 'fbc'")
+    
+    # Normal estimation lights the foreground itself and ignores the background
+    if mode in ('normal', 'matte_only'):
+        bg_source = 'grey'
+    else:
+        bg_source = input_data.get('bg_source', 'none' if model == 'fc' else 'grey')
+    bg_image = None
+    
+    bg_sources = FC_BG_SOURCES if model == 'fc' else BG_SOURCES
+    if bg_source not in bg_sources:
+        raise RequestError(f"Unknown bg_source '{bg_source}' for model '{model}', expected one of: {', '.join(bg_sources)}")
+    if bg_source == 'upload' and 'background_image' not in input_data:
+        raise RequestError("bg_source is 'upload' but 'background_image' is missing")
+    
+    # Get parameters
+    image_width = input_data.get('image_width', 512)
+    image_height = input_data.get('image_height', 640)
+    for name, value in (('image_width', image_width), ('image_height', image_height)):
+        if isinstance(value, bool) or not isinstance(value, int) or not 0 < value <= MAX_IMAGE_SIDE or value % 8:
+            raise RequestError(f"'{name}' must be a positive multiple of 8 up to {MAX_IMAGE_SIDE}")
+    
+    seed = input_data.get('seed', 12345)
+    if isinstance(seed, bool) or not isinstance(seed, int):
+        raise RequestError("'seed' must be an integer")
+    num_samples = input_data.get('num_samples', 1)
+    if isinstance(num_samples, bool) or not isinstance(num_samples, int) or not 1 <= num_samples <= MAX_NUM_SAMPLES:
+        raise RequestError(f"'num_samples' must be an integer between 1 and {MAX_NUM_SAMPLES}")
+    seeds = input_data.get('seeds')
+    if seeds is not None:
+        if not isinstance(seeds, list) or not seeds or not all(isinstance(s, int) for s in seeds):
+            raise RequestError("'seeds' must be a non-empty list of integers")
+        if 'num_samples' in input_data and num_samples != len(seeds):
+            raise RequestError(f"num_samples is {num_samples} but {len(seeds)} seeds were given")
+        if len(seeds) > MAX_NUM_SAMPLES:
+            raise RequestError(f"At most {MAX_NUM_SAMPLES} seeds are allowed")
+        num_samples = len(seeds)
+    
+    sampling_params = resolve_sampling_params(input_data)
+    cfg = input_data.get('cfg_scale', UNET_VARIANTS[model]['cfg_scale'])
+    if isinstance(cfg, bool) or not isinstance(cfg, (int, float)):
+        raise RequestError("'cfg_scale' must be a number")
+    cfg_truncation = input_data.get('cfg_truncation', 1.0)
+    if isinstance(cfg_truncation, bool) or not isinstance(cfg_truncation, (int, float)) or not 0 <= cfg_truncation <= 1:
+        raise RequestError("'cfg_truncation' must be a number between 0 and 1")
+    lowres_denoise = input_data.get('lowres_denoise', 0.9)
+    if isinstance(lowres_denoise, bool) or not isinstance(lowres_denoise, (int, float)) or not 0 < lowres_denoise <= 1:
+        raise RequestError("'lowres_denoise' must be a number above 0 and at most 1")
+    token_merging_ratio = input_data.get('token_merging_ratio', TOKEN_MERGING_RATIO)
+    if isinstance(token_merging_ratio, bool) or not isinstance(token_merging_ratio, (int, float)) \
+            or not 0 <= token_merging_ratio <= MAX_TOKEN_MERGING_RATIO:
+        raise RequestError(f"'token_merging_ratio' must be a number between 0 and {MAX_TOKEN_MERGING_RATIO}")
+    step_cache_interval = input_data.get('step_cache_interval', STEP_CACHE_INTERVAL)
+    if isinstance(step_cache_interval, bool) or not isinstance(step_cache_interval, int) \
+            or not 1 <= step_cache_interval <= MAX_STEP_CACHE_INTERVAL:
+        raise RequestError(f"'step_cache_interval' must be an integer between 1 and {MAX_STEP_CACHE_INTERVAL}")
+    
+    # Snap the diffusion size to a resolution bucket, padded buckets crop results back afterwards
+    bucket = None
+    output_crop = None
+    if RESOLUTION_BUCKETING != 'off' and mode != 'matte_only':
+        bucket = select_bucket(image_width, image_height)
+        sampling_params['highres_scale'] = snap_highres_scale(sampling_params['highres_scale'])
+        if RESOLUTION_BUCKETING == 'pad':
+            output_crop = (image_width, image_height) + bucket
+        image_width, image_height = bucket
+    
+    # Without the highres pass nothing reads the images above the base size
+    highres_scale = sampling_params['highres_scale'] if sampling_params['highres'] else 1.0
+    
+    # Multi-sample relights without seeds get per-sample seeds derived from seed, so the images
+    # do not depend on whether admission control splits the job into micro-batches
+    if mode == 'relight' and seeds is None and num_samples > 1:
+        seeds = [sample_seed(seed, i) for i in range(num_samples)]
+    
+    # Reject jobs that cannot fit in memory and split the ones that only fit in parts
+    micro_batch_size, admission = None, None
+    if mode != 'matte_only':
+        num_images = 4 if mode == 'normal' else num_samples
+        pixels = image_width * image_height
+        if sampling_params['highres']:
+            pixels = max(pixels, int(round(image_width * highres_scale / 64.0) * 64) *
+                         int(round(image_height * highres_scale / 64.0) * 64))
+        micro_batch_size, admission = admit_job(num_images, pixels)
+    matting_resolution = resolve_matting_resolution(input_data.get('matting_resolution', MATTING_RESOLUTION),
+                                                    image_width, image_height, highres_scale)
+    
+    # Decode images near the largest size any pass needs, huge uploads are shrunk
+    # before matting, compositing and background building. matte_only needs no diffusion size.
+    fg_width, fg_height = (0, 0) if mode == 'matte_only' else (image_width, image_height)
+    ingest = {'foreground_image': {}}
     try:
-        if 'input' not in event:
-            return {"status": "error", "message": "Missing 'input' field in request"}
-            
-        input_data = event['input']
-        
-        # Validate required fields
-        if 'foreground_image' not in input_data:
-            return {"status": "error", "message": "Missing required field: 'foreground_image'"}
-        
-        # Decode images
+        fg_image = decode_base64_image(
+            input_data['foreground_image'],
+            lambda w, h: working_scale(w, h, fg_width, fg_height, highres_scale, matting_resolution),
+            ingest['foreground_image'])
+    except Exception as e:
+        raise RequestError(f"Failed to decode foreground_image: {str(e)}")
+    fg_image = downscale_to_working_size(fg_image, fg_width, fg_height, highres_scale, matting_resolution)
+    
+    # A precomputed alpha skips matting, otherwise the CPU matting workers (if any) compute it here
+    foreground_alpha = None
+    if 'foreground_alpha' in input_data:
+        try:
+            foreground_alpha = decode_base64_matte(input_data['foreground_alpha'])
+        except Exception as e:
+            raise RequestError(f"Failed to decode foreground_alpha: {str(e)}")
+        # The foreground may be downscaled, allow for its rounding but never stretch the matte
+        (alpha_height, alpha_width), (fg_h, fg_w) = foreground_alpha.shape, fg_image.shape[:2]
+        if abs(alpha_width / alpha_height - fg_w / fg_h) > 0.02 * fg_w / fg_h:
+            raise RequestError(f"foreground_alpha is {alpha_width}x{alpha_height}, its aspect ratio does not "
+                               f"match the {fg_w}x{fg_h} foreground_image")
+        foreground_alpha = resize_without_crop(foreground_alpha, fg_image.shape[1], fg_image.shape[0])
+        foreground_alpha = foreground_alpha[..., None].astype(np.float32) / 255.0
+    if output_crop is not None:
+        fg_image = pad_to_bucket(fg_image, *output_crop)
+        if foreground_alpha is not None:
+            foreground_alpha = pad_to_bucket(foreground_alpha, *output_crop, value=0.0)
+    if foreground_alpha is None and matting_pool is not None:
+        foreground_alpha = cpu_matte(fg_image, matting_resolution)
+    
+    if bg_source == 'upload':
+        ingest['background_image'] = {}
         try:
-            fg_image = decode_base64_image(input_data['foreground_image'])
+            bg_image = decode_base64_image(
+                input_data['background_image'],
+                lambda w, h: working_scale(w, h, image_width, image_height, highres_scale),
+                ingest['background_image'])
         except Exception as e:
-            return {"status": "error", "message": f"Failed to decode foreground_image: {str(e)}"}
-        
-        bg_source = input_data.get('bg_source', 'grey')
-        bg_image = None
-        
-        if bg_source == 'upload':
-            if 'background_image' not in input_data:
-                return {"status": "error", "message": "bg_source is 'upload' but 'background_image' is missing"}
-            try:
-                bg_image = decode_base64_image(input_data['background_image'])
-            except Exception as e:
-                return {"status": "error", "message": f"Failed to decode background_image: {str(e)}"}
-        
-        # Get parameters
-        prompt = input_data.get('prompt', 'beautiful lighting')
-        image_width = input_data.get('image_width', 512)
-        image_height = input_data.get('image_height', 640)
-        num_samples = input_data.get('num_samples', 1)
-        seed = input_data.get('seed', 12345)
-        steps = input_data.get('steps', 20)
-        cfg = input_data.get('cfg_scale', 7.0)
-        highres_scale = input_data.get('highres_scale', 1.5)
-        highres_denoise = input_data.get('highres_denoise', 0.5)
-        a_prompt = input_data.get('added_prompt', 'best quality')
-        n_prompt = input_data.get('negative_prompt', 'lowres, bad anatomy, bad hands, cropped, worst quality')
-        
-        # Process
-        results = process_relight(
-            fg_image, bg_image, prompt,
-            image_width, image_height, num_samples, seed, steps,
-            a_prompt, n_prompt, cfg, highres_scale, highres_denoise,
-            bg_source
-        )
-        
-        # Encode results
-        output_images = [encode_image_to_base64(img) for img in results]
-        
-        return {
-            "status": "success",
-            "images": output_images
-        }
-        
+            raise RequestError(f"Failed to decode background_image: {str(e)}")
+        bg_image = downscale_to_working_size(bg_image, image_width, image_height, highres_scale)
+    
+    if model == 'fbc':
+        # The background is built here, the GPU stage only needs to use it
+        if output_crop is not None:
+            bg_image = build_background(bg_source, bg_image, output_crop[0], output_crop[1])
+            bg_image = pad_to_bucket(bg_image, *output_crop, value=None)
+        else:
+            bg_image = build_background(bg_source, bg_image, image_width, image_height)
+        bg_source = 'upload'
+    
+    return {
+        'mode': mode,
+        'ingest': ingest,
+        'model': model,
+        'input_fg': fg_image,
+        'input_bg': bg_image,
+        'prompt': input_data.get('prompt', 'beautiful lighting'),
+        'image_width': image_width,
+        'image_height': image_height,
+        'num_samples': num_samples,
+        'seed': seed,
+        'seeds': seeds,
+        'a_prompt': input_data.get('added_prompt', 'best quality'),
+        'n_prompt': input_data.get('negative_prompt', 'lowres, bad anatomy, bad hands, cropped, worst quality'),
+        'cfg': cfg,
+        **sampling_params,
+        'cfg_truncation': cfg_truncation,
+        'lowres_denoise': lowres_denoise,
+        'matting_resolution': matting_resolution,
+        'foreground_alpha': foreground_alpha,
+        'bg_source': bg_source,
+        'bucket': bucket,
+        'output_crop': output_crop,
+        'micro_batch_size': micro_batch_size,
+        'admission': admission,
+        'token_merging_ratio': token_merging_ratio,
+        'step_cache_interval': step_cache_interval,
+    }
+
+def run_job(job):
+    """GPU stage: matting and diffusion"""
+    stats = {'ingest': job.pop('ingest')}
+    mode = job.pop('mode')
+    bucket = job.pop('bucket')
+    output_crop = job.pop('output_crop')
+    admission = job.pop('admission')
+    if admission is not None:
+        stats['memory'] = admission
+    images = PROCESS_MODES[mode](**job, stats=stats)
+    if output_crop is not None:
+        images = [crop_from_bucket(image, *output_crop) for image in images]
+    settings = {key: job[key] for key in ('model', 'sampler', 'steps', 'highres', 'highres_scale',
+                                          'highres_denoise', 'seed', 'matting_resolution', 'token_merging_ratio',
+                                          'step_cache_interval')}
+    if job['seeds'] is not None:
+        settings['seeds'] = job['seeds']
+    if bucket is not None:
+        settings['resolution_bucket'] = f"{bucket[0]}x{bucket[1]}"
+    # Highres scaling and 'crop' buckets make the images differ from image_width x image_height
+    settings['output_height'], settings['output_width'] = images[0].shape[:2]
+    output = {"images": images, "settings": settings, **stats}
+    if mode == 'normal':
+        output["labels"] = NORMAL_OUTPUT_LABELS
+    return output
+
+def finish_job(output):
+    """CPU stage: encode result images"""
+    output["images"] = [encode_image_to_base64(img) for img in output["images"]]
+    return {"status": "success", **output}
+
+def get_job_pipeline():
+    """Get the worker's staged job pipeline, starting it on first use"""
+    global job_pipeline
+    with _job_pipeline_lock:
+        if job_pipeline is None:
+            job_pipeline = StagedPipeline(
+                prepare_job, run_job, finish_job,
+                num_cpu_workers=PIPELINE_CPU_WORKERS,
+                queue_size=PIPELINE_QUEUE_SIZE
+            )
+    return job_pipeline
+
+def make_response(output, timings):
+    """Attach per-stage timings to a successful job output"""
+    output["timings"] = {stage: round(seconds, 4) for stage, seconds in timings.items()}
+    return output
+
+def make_error_response(error):
+    """Turn a failed job into an error response"""
+    if isinstance(error, RequestError):
+        return {"status": "error", "message": str(error)}
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        torch.cuda.empty_cache()
+        return {"status": "error",
+                "message": "Out of GPU memory, reduce num_samples, image_width, image_height or highres_scale"}
+    traceback.print_exception(error)
+    return {
+        "status": "error",
+        "message": f"Internal processing error: {str(error)}"
+    }
+
+def readiness_error():
+    """Error response for jobs while the models cannot serve them, None once they can"""
+    if worker_status['status'] == 'not_started':
+        return {"status": "error", "message": "Worker not initialized"}
+    if worker_status['status'] == 'failed':
+        return {"status": "error", "message": f"Worker initialization failed: {worker_status['error']}"}
+    if worker_status['status'] == 'initializing':
+        return {"status": "error", "message": f"Worker still initializing after {INIT_WAIT_TIMEOUT:.0f}s"}
+    return None
+
+def get_worker_status():
+    """Readiness and startup timings of this worker"""
+    return {"status": "success", "worker": {**worker_status, 'timings': dict(worker_status['timings']),
+                                            'uptime': round(time.time() - PROCESS_START, 2)}}
+
+def handler(event):
+    """
+    RunPod handler function
+    """
+    if 'input' not in event:
+        return {"status": "error", "message": "Missing 'input' field in request"}
+    if isinstance(event['input'], dict) and event['input'].get('health_check'):
+        return get_worker_status()
+    
+    # Jobs that arrive during initialization wait for the models instead of failing
+    if worker_status['status'] == 'initializing':
+        models_ready.wait(INIT_WAIT_TIMEOUT)
+    error = readiness_error()
+    if error is not None:
+        return error
+    
+    try:
+        output, timings = get_job_pipeline().submit(event['input']).result()
+    except Exception as e:
+        return make_error_response(e)
+    
+    return make_response(output, timings)
+
+async def async_handler(event):
+    """
+    Async RunPod handler function
+    Lets the worker keep several jobs in flight so their CPU stages overlap diffusion
+    """
+    if 'input' not in event:
+        return {"status": "error", "message": "Missing 'input' field in request"}
+    if isinstance(event['input'], dict) and event['input'].get('health_check'):
+        return get_worker_status()
+    
+    if worker_status['status'] == 'initializing':
+        await asyncio.to_thread(models_ready.wait, INIT_WAIT_TIMEOUT)
+    error = readiness_error()
+    if error is not None:
+        return error
+    
+    try:
+        output, timings = await asyncio.wrap_future(get_job_pipeline().submit(event['input']))
+    except Exception as e:
+        return make_error_response(e)
+    
+    return make_response(output, timings)
+
+def warmup_inference():
+    """Run one small relight job through the whole job pipeline"""
+    grey = np.full((INIT_WARMUP_SIZE, INIT_WARMUP_SIZE, 3), 127, dtype=np.uint8)
+    output, _ = get_job_pipeline().submit({
+        'foreground_image': encode_image_to_base64(grey), 'prompt': 'beautiful lighting',
+        'image_width': INIT_WARMUP_SIZE, 'image_height': INIT_WARMUP_SIZE,
+        'steps': 2, 'highres_scale': 1.0, 'bg_source': 'left',
+    }).result()
+    return output
+
+def initialize_worker(components=None, sd_offsets=None, target_device=None):
+    """
+    Import the model libraries, initialize the models and run the warmup job
+    Sets worker_status and models_ready, a failure is recorded instead of raised.
+    """
+    timings = worker_status['timings']
+    try:
+        start = time.perf_counter()
+        import_model_libraries()
+        timings['imports'] = round(time.perf_counter() - start, 2)
+        start = time.perf_counter()
+        initialize_models(components, sd_offsets, target_device)
+        timings['models'] = round(time.perf_counter() - start, 2)
+        if INIT_WARMUP:
+            start = time.perf_counter()
+            warmup_inference()
+            timings['warmup'] = round(time.perf_counter() - start, 2)
+        worker_status['time_to_ready'] = round(time.time() - PROCESS_START, 2)
+        worker_status['status'] = 'ready'
+        print(f"Worker ready {worker_status['time_to_ready']}s after start ({timings})")
     except Exception as e:
-        import traceback
         traceback.print_exc()
-        return {
-            "status": "error",
-            "message": f"Internal processing error: {str(e)}"
-        }
+        worker_status['error'] = f"{type(e).__name__}: {e}"
+        worker_status['status'] = 'failed'
+    finally:
+        models_ready.set()
+
+def start_worker_initialization(components=None, sd_offsets=None, target_device=None):
+    """Initialize the worker in a background thread, jobs wait on models_ready"""
+    worker_status['status'] = 'initializing'
+    thread = threading.Thread(target=initialize_worker, args=(components, sd_offsets, target_device),
+                              name='worker-init', daemon=True)
+    thread.start()
+    return thread
+
+def worker_concurrency(current_concurrency):
+    """
+    RunPod concurrency modifier, first called once the worker is registered and polling
+    Takes one job at a time until the models are ready.
+    """
+    if worker_status['time_to_registered'] is None:
+        worker_status['time_to_registered'] = round(time.time() - PROCESS_START, 2)
+        print(f"Worker registered {worker_status['time_to_registered']}s after start")
+    return PIPELINE_CONCURRENCY if worker_status['status'] == 'ready' else 1
 
 if __name__ == "__main__":
-    # Initialize models on startup
-    initialize_models()
+    # Load the models in the background so the worker registers right away
+    start_worker_initialization()
     
     # Start RunPod serverless worker
-    runpod.serverless.start({"handler": handler})
+    import runpod
+    runpod.serverless.start({
+        "handler": async_handler,
+        "concurrency_modifier": worker_concurrency
+    })
@@ -0,0 +1,98 @@
+"""
+Step-to-step UNet feature caching (DeepCache)
+The deep, low-resolution UNet features change very little between adjacent denoising
+steps. A full step caches the input of the shallowest up blocks, the cheap steps in
+between only run the shallow down and up blocks around that cached feature.
+"""
+
+
+def _run_block(block, sample, emb, encoder_hidden_states, **kwargs):
+    if getattr(block, 'has_cross_attention', False):
+        return block(hidden_states=sample, temb=emb, encoder_hidden_states=encoder_hidden_states, **kwargs)
+    return block(hidden_states=sample, temb=emb, **kwargs)
+
+
+def unet_forward(unet, sample, timestep, encoder_hidden_states, branch, cached=None):
+    """
+    UNet2DConditionModel forward for SD-style UNets, split at a cache branch
+
+    branch is the deepest block level (0 = the shallowest) that cheap steps still run.
+    Without cached the full UNet runs; with cached (the input of up block
+    len(up_blocks) - 1 - branch from an earlier step) only levels 0..branch run.
+    Returns the output and the feature to cache.
+    """
+    up_factor = 2 ** unet.num_upsamplers
+    forward_upsample_size = any(dim % up_factor != 0 for dim in sample.shape[-2:])
+    upsample_size = None
+
+    emb = unet.time_embedding(unet.get_time_embed(sample=sample, timestep=timestep), None)
+    if unet.time_embed_act is not None:
+        emb = unet.time_embed_act(emb)
+    encoder_hidden_states = unet.process_encoder_hidden_states(encoder_hidden_states, None)
+
+    sample = unet.conv_in(sample)
+    down_block_res_samples = (sample,)
+    down_blocks = unet.down_blocks if cached is None else unet.down_blocks[:branch + 1]
+    for block in down_blocks:
+        sample, res_samples = _run_block(block, sample, emb, encoder_hidden_states)
+        down_block_res_samples += res_samples
+
+    cache_at = len(unet.up_blocks) - 1 - branch
+    if cached is None:
+        if unet.mid_block is not None:
+            sample = _run_block(unet.mid_block, sample, emb, encoder_hidden_states)
+        first_up = 0
+    else:
+        # The downsampled output of the last shallow block feeds the skipped deeper levels
+        if down_blocks[-1].downsamplers is not None:
+            down_block_res_samples = down_block_res_samples[:-1]
+        sample = cached
+        first_up = cache_at
+
+    feature = cached
+    for i, block in enumerate(unet.up_blocks[first_up:], start=first_up):
+        if i == cache_at:
+            feature = sample
+        res_samples = down_block_res_samples[-len(block.resnets):]
+        down_block_res_samples = down_block_res_samples[:-len(block.resnets)]
+        if i < len(unet.up_blocks) - 1 and forward_upsample_size:
+            upsample_size = down_block_res_samples[-1].shape[2:]
+        sample = _run_block(block, sample, emb, encoder_hidden_states,
+                            res_hidden_states_tuple=res_samples, upsample_size=upsample_size)
+
+    if unet.conv_norm_out:
+        sample = unet.conv_norm_out(sample)
+        sample = unet.conv_act(sample)
+    return unet.conv_out(sample), feature
+
+
+class StepFeatureCache:
+    """
+    Runs one diffusion pass of UNet steps with DeepCache-style feature reuse
+
+    Every interval-th call is a full step that refreshes the cached feature, the calls in
+    between reuse it. When the batch halves (CFG truncation) the conditional half of the
+    cached feature is kept. Call counts are accumulated in stats.
+    """
+
+    def __init__(self, interval, branch=0, stats=None):
+        self.interval = interval
+        self.branch = branch
+        self.stats = stats if stats is not None else {}
+        self.stats.setdefault('full_steps', 0)
+        self.stats.setdefault('cached_steps', 0)
+        self._feature = None
+        self._calls = 0
+
+    def __call__(self, unet, sample, timestep, encoder_hidden_states):
+        cached = self._feature
+        if cached is not None and cached.shape[0] != sample.shape[0]:
+            cached = cached.chunk(2)[1] if cached.shape[0] == 2 * sample.shape[0] else None
+        if self._calls % self.interval == 0 or cached is None:
+            cached = None
+            self.stats['full_steps'] += 1
+        else:
+            self.stats['cached_steps'] += 1
+        self._calls += 1
+        output, self._feature = unet_forward(unet, sample, timestep, encoder_hidden_states, self.branch, cached)
+        return output
@@ -0,0 +1,142 @@
+"""
+Tests for request validation, memory admission control and micro-batching
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import rp_handler
+from memory_estimator import MemoryEstimator
+
+
+def max_diff(a, b):
+    return max(np.abs(x.astype(int) - y.astype(int)).max() for x, y in zip(a, b))
+
+
+def test_estimator_fit_and_max_batch(tmp_path):
+    estimator = MemoryEstimator(safety_margin=1.0)
+    for images, pixels in [(1, 100), (2, 100), (1, 200), (3, 300)]:
+        estimator.add_sample(images, pixels, 1000 + 5 * images * pixels + 0.01 * images * pixels ** 2)
+    base, linear, quadratic = estimator.fit()
+    assert base == pytest.approx(1000) and linear == pytest.approx(5) and quadratic == pytest.approx(0.01)
+
+    per_image = 5 * 100 + 0.01 * 100 ** 2
+    assert estimator.max_batch(100, 1000 + 3.5 * per_image) == 3
+    assert estimator.max_batch(100, 1000 + 0.5 * per_image) == 0
+
+    path = str(tmp_path / 'calibration.json')
+    estimator.save(path, 'gpu-a')
+    assert MemoryEstimator.load(path, 'gpu-a').coefficients == estimator.coefficients
+    assert MemoryEstimator.load(path, 'gpu-b') is None
+    assert MemoryEstimator.load(str(tmp_path / 'missing.json'), 'gpu-a') is None
+
+
+def test_request_validation(tiny_models):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    request = {'foreground_image': tiny_models.encode_image_to_base64(fg), 'image_width': 64,
+               'image_height': 64, 'steps': 2}
+    for bad in ({'image_width': 100}, {'image_height': 0}, {'image_width': 4096}, {'image_width': '64'},
+                {'num_samples': 0}, {'num_samples': 100}, {'highres_scale': 10},
+                {'highres_scale': 'big'}, {'seeds': list(range(100))}):
+        response = tiny_models.handler({'input': {**request, **bad}})
+        assert response['status'] == 'error', bad
+
+
+def test_sampling_field_validation(tiny_models):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    request = {'foreground_image': tiny_models.encode_image_to_base64(fg), 'image_width': 64,
+               'image_height': 64, 'steps': 2, 'num_samples': 2}
+    for bad, message in (({'steps': 0}, "'steps' must be"), ({'steps': 'x'}, "'steps' must be"),
+                         ({'steps': 2.5}, "'steps' must be"), ({'cfg_scale': 'high'}, "'cfg_scale' must be"),
+                         ({'highres_denoise': 0}, "'highres_denoise' must be"),
+                         ({'highres_denoise': 1.5}, "'highres_denoise' must be"),
+                         ({'seed': 'abc'}, "'seed' must be"), ({'seed': True}, "'seed' must be")):
+        response = tiny_models.handler({'input': {**request, **bad}})
+        assert response['status'] == 'error', bad
+        assert response['message'].startswith(message), response['message']
+
+    # A single step still denoises in the img2img passes
+    response = tiny_models.handler({'input': {**request, 'steps': 1, 'model': 'fc', 'bg_source': 'left',
+                                              'highres_scale': 1.5, 'highres_denoise': 0.9}})
+    assert response['status'] == 'success', response
+
+
+def test_budget_counts_every_variant(tiny_models, monkeypatch):
+    monkeypatch.setattr(rp_handler, 'memory_estimator', None)
+    monkeypatch.setattr(rp_handler, 'memory_budget', None)
+    monkeypatch.setattr(MemoryEstimator, 'load', classmethod(lambda cls, *args: cls([0.0, 1.0, 0.0])))
+    switches = tiny_models.unet_variants.stats['switches']
+    tiny_models.setup_admission_control()
+
+    assert tiny_models.unet_variants.stats['switches'] >= switches + 2
+    assert tiny_models.unet_variants.active == tiny_models.DEFAULT_UNET_VARIANT
+    params = sum(p.numel() * p.element_size() for model in (tiny_models.text_encoder, tiny_models.vae,
+                                                             tiny_models.unet, tiny_models.rmbg)
+                 for p in model.parameters())
+    total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    idle = params + tiny_models.unet_variants.stats['host_bytes']
+    assert tiny_models.memory_budget == pytest.approx(total * tiny_models.MEMORY_BUDGET_FRACTION - idle)
+
+
+def test_admission_splits_and_rejects(tiny_models, monkeypatch):
+    # One image per 64x64 pixels fits 2.5 times in the budget
+    monkeypatch.setattr(rp_handler, 'memory_estimator', MemoryEstimator([0.0, 1.0, 0.0], safety_margin=1.0))
+    monkeypatch.setattr(rp_handler, 'memory_budget', 2.5 * 64 * 64)
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    request = {'foreground_image': tiny_models.encode_image_to_base64(fg), 'image_width': 64,
+               'image_height': 64, 'steps': 2, 'highres_scale': 1.0, 'num_samples': 5, 'seed': 7}
+
+    response = tiny_models.handler({'input': request})
+    assert response['status'] == 'success', response
+    assert len(response['images']) == 5
+    assert response['memory']['micro_batch_size'] == 2
+    assert response['memory']['micro_batches'] == 3
+    # Jobs without seeds get per-sample seeds derived from seed
+    assert response['settings']['seeds'] == [rp_handler.sample_seed(7, i) for i in range(5)]
+
+    response = tiny_models.handler({'input': {**request, 'image_width': 128, 'image_height': 128}})
+    assert response['status'] == 'error'
+    assert 'GiB' in response['message']
+
+
+def test_split_does_not_change_unseeded_images(tiny_models, monkeypatch):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    request = {'foreground_image': tiny_models.encode_image_to_base64(fg), 'image_width': 64,
+               'image_height': 64, 'steps': 4, 'highres_scale': 1.0, 'num_samples': 3, 'seed': 7}
+    unsplit = tiny_models.handler({'input': request})
+    assert unsplit['status'] == 'success', unsplit
+    assert 'memory' not in unsplit
+
+    monkeypatch.setattr(rp_handler, 'memory_estimator', MemoryEstimator([0.0, 1.0, 0.0], safety_margin=1.0))
+    monkeypatch.setattr(rp_handler, 'memory_budget', 1.5 * 64 * 64)
+    split = tiny_models.handler({'input': request})
+    assert split['status'] == 'success', split
+    assert split['memory']['micro_batches'] == 3
+
+    assert unsplit['settings']['seeds'] == split['settings']['seeds'] == [rp_handler.sample_seed(7, i) for i in range(3)]
+    decode = lambda response: [np.array(tiny_models.decode_base64_image(image)) for image in response['images']]
+    assert max_diff(decode(unsplit), decode(split)) <= 2
+
+    # The echoed seeds replay any single image
+    replay = tiny_models.handler({'input': {**request, 'seeds': split['settings']['seeds'][1:2], 'num_samples': 1}})
+    assert max_diff(decode(split)[1:2], decode(replay)) <= 2
+
+
+def test_sample_seeds_do_not_overlap_between_seeds():
+    seeds = {seed: [rp_handler.sample_seed(seed, i) for i in range(4)] for seed in (7, 8)}
+    assert len(set(seeds[7]) | set(seeds[8])) == 8
+
+
+def test_micro_batches_match_one_batch(tiny_models):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    kwargs = dict(steps=4, bg_source='left', seeds=[1, 2, 3])
+    batch = tiny_models.process_relight(fg, None, 'a cat', 64, 64, **kwargs)
+    split = tiny_models.process_relight(fg, None, 'a cat', 64, 64, micro_batch_size=2, **kwargs)
+    assert max_diff(batch, split) <= 2
+
+    batch = tiny_models.process_normal(fg, None, 'a cat', 64, 64, steps=4)
+    split = tiny_models.process_normal(fg, None, 'a cat', 64, 64, steps=4, micro_batch_size=1)
+    assert len(split) == len(batch)
+    assert max_diff(batch, split) <= 2
@@ -0,0 +1,43 @@
+"""
+Tests for the cached cross-attention key/value processor
+"""
+
+import torch
+from diffusers.models.attention_processor import AttnProcessor2_0
+
+from attention_processors import CachedKVAttnProcessor2_0, cross_attention_kv_cache
+
+
+def test_cached_kv_matches_attn_processor(tiny_models):
+    unet = tiny_models.unet
+    assert all(isinstance(p, CachedKVAttnProcessor2_0) for p in unet.attn_processors.values())
+    cross_attention_layers = [m for m in unet.modules() if getattr(m, 'is_cross_attention', False)]
+
+    generator = torch.Generator().manual_seed(0)
+    concat_conds = torch.randn(1, 8, 8, 8, generator=generator)
+    context = torch.randn(2, 77, 32, generator=generator)
+    samples = [torch.randn(2, 12, 8, 8, generator=generator) for _ in range(3)]
+
+    with tiny_models.unet_variants.use('fbc'), torch.inference_mode():
+        expected = [unet(sample, t, context).sample for t, sample in enumerate(samples)]
+        cache = {}
+        with cross_attention_kv_cache(cache):
+            results = [unet(sample, t, context).sample for t, sample in enumerate(samples)]
+            assert set(cache) == set(cross_attention_layers)
+            first_keys = {layer: entry[1] for layer, entry in cache.items()}
+            unet(samples[0], 0, context)
+            assert all(cache[layer][1] is key for layer, key in first_keys.items())
+            # New embeddings replace the cached projections
+            unet(samples[0], 0, context[1:].repeat(2, 1, 1))
+            assert all(cache[layer][1] is not key for layer, key in first_keys.items())
+
+        processors = unet.attn_processors
+        unet.set_attn_processor(AttnProcessor2_0())
+        try:
+            reference = [unet(sample, t, context).sample for t, sample in enumerate(samples)]
+        finally:
+            unet.set_attn_processor(processors)
+
+    for result, plain, ref in zip(results, expected, reference):
+        torch.testing.assert_close(result, ref, atol=1e-6, rtol=1e-6)
+        torch.testing.assert_close(plain, ref, atol=0, rtol=0)
@@ -0,0 +1,97 @@
+"""
+Tests for the BriaRMBG inference path
+"""
+
+import copy
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from briarmbg import BriaRMBG
+
+
+@pytest.fixture(scope="module")
+def briarmbg():
+    torch.manual_seed(0)
+    model = BriaRMBG().eval()
+    # Non-trivial BatchNorm statistics so parity checks exercise them
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.1, 0.1)
+            module.running_var.uniform_(0.5, 1.5)
+    return model
+
+
+def test_predict_matches_forward(briarmbg):
+    x = torch.rand(1, 3, 128, 96)
+    with torch.inference_mode():
+        expected = briarmbg(x)[0][0]
+    alpha = briarmbg.predict(x)
+    assert alpha.shape == (1, 1, 128, 96)
+    assert torch.equal(alpha, expected)
+
+
+def test_fused_batchnorm_parity(briarmbg):
+    x = torch.rand(1, 3, 128, 96)
+    expected = briarmbg.predict(x)
+    fused = copy.deepcopy(briarmbg).fuse_batchnorm()
+    assert not any(isinstance(m, torch.nn.BatchNorm2d) for m in fused.modules())
+    torch.testing.assert_close(fused.predict(x), expected, atol=1e-5, rtol=0)
+
+
+@pytest.mark.parametrize("path", ["imgs/i6.jpg", "imgs/i7.jpg"])
+def test_bf16_channels_last_close_to_fp32(briarmbg, path):
+    """Reduced-precision mattes of the reference images stay close to fp32"""
+    img = np.array(Image.open(path).convert('RGB').resize((256, 256)))
+    x = torch.from_numpy(img).float().div(255).movedim(-1, 0)[None]
+    expected = briarmbg.predict(x)
+    model = copy.deepcopy(briarmbg).fuse_batchnorm().to(memory_format=torch.channels_last)
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        alpha = model.predict(x.contiguous(memory_format=torch.channels_last))
+    assert (alpha.float() - expected).abs().mean().item() < 0.01
+
+
+def test_precision_guard_falls_back(tiny_models, monkeypatch):
+    monkeypatch.setattr(tiny_models, 'RMBG_PRECISION', 'bf16')
+    monkeypatch.setattr(tiny_models, 'RMBG_GUARD_IMAGES', ['imgs/i6.jpg'])
+    monkeypatch.setattr(tiny_models, 'RMBG_GUARD_TOLERANCE', 1.0)
+    assert tiny_models.select_rmbg_precision() == torch.bfloat16
+    monkeypatch.setattr(tiny_models, 'RMBG_GUARD_TOLERANCE', 0.0)
+    assert tiny_models.select_rmbg_precision() is None
+
+
+def test_matting_resolution_tiers(tiny_models):
+    img = np.zeros((3000, 2000, 3), dtype=np.uint8)
+    assert tiny_models.rmbg_feed_size(img, 1024) == (832, 1280)
+    assert tiny_models.rmbg_feed_size(img, 512) == (448, 640)
+    assert tiny_models.resolve_matting_resolution('auto', 512, 640, 1.0) == 512
+    assert tiny_models.resolve_matting_resolution('auto', 512, 640, 1.5) == 1024
+    assert tiny_models.resolve_matting_resolution('quality', 256, 256, 1.0) == 1024
+    with pytest.raises(tiny_models.RequestError):
+        tiny_models.resolve_matting_resolution('ultra', 512, 640, 1.0)
+
+
+def test_batched_matting_matches_single(tiny_models):
+    rng = np.random.RandomState(0)
+    imgs = [(rng.rand(*shape, 3) * 255).astype(np.uint8) for shape in [(120, 90), (240, 180), (90, 160)]]
+    batched = tiny_models.run_rmbg_batch(imgs, sigma=16, resolution=512)
+    for img, (result, alpha) in zip(imgs, batched):
+        single_result, single_alpha = tiny_models.run_rmbg(img, sigma=16, resolution=512)
+        assert alpha.shape == img.shape[:2] + (1,)
+        np.testing.assert_allclose(alpha, single_alpha, atol=1e-6)
+        assert np.abs(result.astype(int) - single_result.astype(int)).max() <= 1
+
+
+def test_large_upload_downscaled_to_working_size(tiny_models):
+    y, x = np.mgrid[0:4000, 0:6000]
+    img = np.stack([x % 256, y % 256, (x + y) // 40 % 256], axis=-1).astype(np.uint8)
+    small = tiny_models.downscale_to_working_size(img, 512, 640, 1.5, 1024)
+    assert small.shape == (960, 1440, 3)
+    # Smaller than both the highres crop and the matting budget: left alone
+    assert tiny_models.downscale_to_working_size(small[:500, :400], 512, 640, 1.5, 1024).shape == (500, 400, 3)
+
+    full_crop = tiny_models.resize_and_center_crop(img, 768, 960).astype(int)
+    small_crop = tiny_models.resize_and_center_crop(small, 768, 960).astype(int)
+    assert np.abs(full_crop - small_crop).mean() < 2
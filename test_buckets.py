@@ -0,0 +1,125 @@
+"""
+Tests for resolution bucketing and the bucket warmup
+"""
+
+import base64
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import rp_handler
+
+TINY_BUCKETS = [(64, 64), (128, 64), (64, 128)]
+
+
+def decode(image):
+    return np.array(Image.open(io.BytesIO(base64.b64decode(image))))
+
+
+@pytest.fixture
+def buckets(monkeypatch):
+    def configure(mode, buckets=TINY_BUCKETS, highres_scales=(1.5, 2.0)):
+        monkeypatch.setattr(rp_handler, 'RESOLUTION_BUCKETING', mode)
+        monkeypatch.setattr(rp_handler, 'RESOLUTION_BUCKETS', list(buckets))
+        monkeypatch.setattr(rp_handler, 'HIGHRES_SCALE_BUCKETS', list(highres_scales))
+    return configure
+
+
+def test_select_bucket(buckets):
+    buckets('crop', [(512, 512), (512, 640), (640, 512), (768, 512), (768, 768)])
+    assert rp_handler.select_bucket(500, 620) == (512, 640)
+    assert rp_handler.select_bucket(1000, 500) == (768, 512)
+    # Same aspect ratio, closest area wins
+    assert rp_handler.select_bucket(700, 700) == (768, 768)
+
+    buckets('pad', [(512, 512), (512, 640), (640, 640), (768, 768)])
+    assert rp_handler.select_bucket(500, 600) == (512, 640)
+    assert rp_handler.select_bucket(600, 512) == (640, 640)
+    with pytest.raises(rp_handler.RequestError):
+        rp_handler.select_bucket(1024, 512)
+
+
+def test_snap_highres_scale(buckets):
+    buckets('crop', highres_scales=(1.25, 1.5, 2.0))
+    assert rp_handler.snap_highres_scale(1.7) == 1.5
+    assert rp_handler.snap_highres_scale(3.0) == 2.0
+    assert rp_handler.snap_highres_scale(1.0) == 1.0
+
+
+def test_pad_and_crop_round_trip():
+    image = (np.random.RandomState(0).rand(120, 90, 3) * 255).astype(np.uint8)
+    padded = rp_handler.pad_to_bucket(image, 48, 64, 64, 64)
+    assert padded.shape == (120, 120, 3)
+    assert (padded[:, :15] == 127).all() and (padded[:, -15:] == 127).all()
+    assert np.array_equal(rp_handler.crop_from_bucket(padded, 48, 64, 64, 64), image)
+
+    edge = rp_handler.pad_to_bucket(image, 48, 64, 64, 64, value=None)
+    assert np.array_equal(edge[:, 0], image[:, 0])
+
+
+def test_padded_bucket_returns_requested_size(tiny_models, buckets):
+    buckets('pad')
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    request = {'foreground_image': tiny_models.encode_image_to_base64(fg), 'image_width': 48,
+               'image_height': 64, 'steps': 2, 'bg_source': 'left'}
+
+    response = tiny_models.handler({'input': {**request, 'highres_scale': 1.0}})
+    assert response['status'] == 'success', response
+    assert response['settings']['resolution_bucket'] == '64x64'
+    assert decode(response['images'][0]).shape == (64, 48, 3)
+
+    # 1.8 snaps to 2.0, the 128x128 highres result is cropped to 96x128
+    response = tiny_models.handler({'input': {**request, 'highres_scale': 1.8}})
+    assert response['status'] == 'success', response
+    assert response['settings']['highres_scale'] == 2.0
+    assert decode(response['images'][0]).shape == (128, 96, 3)
+
+
+def test_cropped_bucket_returns_bucket_size(tiny_models, buckets):
+    buckets('crop')
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    response = tiny_models.handler({'input': {
+        'foreground_image': tiny_models.encode_image_to_base64(fg), 'image_width': 120,
+        'image_height': 56, 'steps': 2, 'highres_scale': 1.0, 'model': 'fc'}})
+    assert response['status'] == 'success', response
+    assert response['settings']['resolution_bucket'] == '128x64'
+    assert decode(response['images'][0]).shape == (64, 128, 3)
+    # The bucket size differs from the requested 120x56, the response says so
+    assert (response['settings']['output_width'], response['settings']['output_height']) == (128, 64)
+
+
+def test_warmup_covers_every_bucket(tiny_models, buckets):
+    buckets('pad', [(64, 64), (128, 64)], highres_scales=(1.5,))
+    timings = tiny_models.warmup_buckets(steps=2)
+    assert sorted(timings) == [('fbc', 64, 64, 1.5), ('fbc', 128, 64, 1.5), ('fc', 64, 64, 1.5), ('fc', 128, 64, 1.5)]
+    assert tiny_models.unet_variants.active == tiny_models.DEFAULT_UNET_VARIANT
+
+
+@pytest.mark.skipif(os.environ.get('SLOW_TESTS') != '1', reason="compiles every warmup graph, set SLOW_TESTS=1")
+def test_compiled_warmup_leaves_nothing_to_recompile(run_tiny_worker, tmp_path):
+    # Dynamo's eager backend makes the same recompile decisions as inductor without its build time
+    result = run_tiny_worker("""
+        from torch._dynamo.utils import counters
+
+        compile_ = torch.compile
+        torch.compile = lambda fn, mode=None, **kwargs: compile_(fn, backend='eager', **kwargs)
+        initialize()
+        rp_handler.compile_models('default')
+        timings = rp_handler.warmup_buckets(steps=2)
+        graphs = counters['stats']['unique_graphs']
+
+        job = {'foreground_image': rp_handler.encode_image_to_base64(fg), 'prompt': 'a cat',
+               'image_width': 64, 'image_height': 64, 'steps': 2, 'highres_scale': 1.5}
+        statuses = [rp_handler.handler({'input': {**job, **extra}})['status'] for extra in
+                    ({'model': 'fc'}, {}, {'model': 'fc', 'bg_source': 'left'}, {'token_merging_ratio': 0.0})]
+        report({'timings': [list(key) for key in timings], 'statuses': statuses, 'warmup_graphs': graphs,
+                'new_graphs': counters['stats']['unique_graphs'] - graphs})
+    """, env={'RESOLUTION_BUCKETING': 'pad', 'RESOLUTION_BUCKETS': '64x64', 'HIGHRES_SCALE_BUCKETS': '1.5',
+              'TORCH_COMPILE_CACHE_DIR': str(tmp_path), 'TOKEN_MERGING_RATIO': '0.5'})
+    assert result['timings'] == [['fbc', 64, 64, 1.5], ['fc', 64, 64, 1.5]]
+    assert result['statuses'] == ['success'] * 4
+    assert result['warmup_graphs'] > 0
+    assert result['new_graphs'] == 0
@@ -0,0 +1,53 @@
+"""
+Stress test for running several relight requests at once in one process
+Concurrent outputs must be bit-identical to serial runs
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def make_jobs():
+    rng = np.random.RandomState(0)
+    jobs = []
+    for i, sampler in enumerate(['dpmpp_2m_sde_karras', 'euler_a', 'ddim', 'dpmpp_2m_karras'] * 2):
+        jobs.append(dict(
+            input_fg=(rng.rand(80, 64, 3) * 255).astype(np.uint8),
+            input_bg=None,
+            prompt='a cat',
+            image_width=64,
+            image_height=64 + 64 * (i % 2),
+            num_samples=1 + i % 2,
+            seed=100 + i,
+            steps=4,
+            cfg=[7.0, 1.0, 3.0, 5.0][i % 4],
+            highres_scale=1.5,
+            bg_source=['left', 'top', 'grey', 'right'][i % 4],
+            sampler=sampler,
+        ))
+    return jobs
+
+
+def test_concurrent_requests_match_serial(tiny_models):
+    jobs = make_jobs()
+    serial = [tiny_models.process_relight(**job) for job in jobs]
+
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [executor.submit(tiny_models.process_relight, **job) for job in jobs]
+        concurrent = [future.result() for future in futures]
+
+    for serial_images, concurrent_images in zip(serial, concurrent):
+        assert len(serial_images) == len(concurrent_images)
+        for a, b in zip(serial_images, concurrent_images):
+            assert np.array_equal(a, b)
+
+
+def test_requests_do_not_share_scheduler_state(tiny_models):
+    a = tiny_models.new_scheduler('dpmpp_2m_sde_karras')
+    b = tiny_models.new_scheduler('dpmpp_2m_sde_karras')
+    assert a is not b
+    assert a.config == tiny_models.schedulers['dpmpp_2m_sde_karras'].config
+    a.set_timesteps(10)
+    b.set_timesteps(4)
+    assert len(a.timesteps) == 10
@@ -0,0 +1,51 @@
+"""
+Tests for the CPU inference backend (device-aware dtypes, channels_last, threads)
+"""
+
+import pytest
+import torch
+
+import rp_handler
+
+
+@pytest.mark.parametrize("setting, bf16_cpu, expected", [
+    ('auto', True, torch.bfloat16),
+    ('auto', False, torch.float32),
+    ('fp32', True, torch.float32),
+    ('bf16', False, torch.bfloat16),
+])
+def test_cpu_model_dtypes(monkeypatch, setting, bf16_cpu, expected):
+    monkeypatch.setattr(rp_handler, 'CPU_DTYPE', setting)
+    monkeypatch.setattr(rp_handler, 'cpu_supports_bf16', lambda: bf16_cpu)
+    dtypes = rp_handler.select_model_dtypes(torch.device('cpu'))
+    assert dtypes['unet'] == dtypes['vae'] == dtypes['text_encoder'] == expected
+    assert dtypes['rmbg'] == torch.float32
+    # GPU dtypes are not affected by the CPU setting
+    assert rp_handler.select_model_dtypes(torch.device('cuda')) == rp_handler.MODEL_DTYPES
+
+
+def test_unknown_cpu_dtype(monkeypatch):
+    monkeypatch.setattr(rp_handler, 'CPU_DTYPE', 'fp16')
+    with pytest.raises(ValueError):
+        rp_handler.select_model_dtypes(torch.device('cpu'))
+
+
+def test_bf16_relight_end_to_end(run_tiny_worker):
+    result = run_tiny_worker("""
+        initialize()
+        results = rp_handler.process_relight(fg, None, 'a cat', 64, 64, steps=2, bg_source='left', num_samples=2)
+        report({
+            'unet': str(rp_handler.unet.dtype),
+            'vae': str(rp_handler.vae.dtype),
+            'text_encoder': str(rp_handler.text_encoder.dtype),
+            'channels_last': rp_handler.unet.conv_in.weight.is_contiguous(memory_format=torch.channels_last),
+            'threads': [torch.get_num_threads(), torch.get_num_interop_threads()],
+            'shapes': [list(r.shape) for r in results],
+            'std': [float(r.std()) for r in results],
+        })
+    """, env={'CPU_DTYPE': 'bf16', 'CPU_THREADS': '1', 'CPU_INTEROP_THREADS': '1'})
+    assert result['unet'] == result['vae'] == result['text_encoder'] == 'torch.bfloat16'
+    assert result['channels_last']
+    assert result['threads'] == [1, 1]
+    assert result['shapes'] == [[128, 128, 3], [128, 128, 3]]
+    assert all(std > 0 for std in result['std'])
@@ -0,0 +1,65 @@
+"""
+Tests for skipping and truncating classifier-free guidance and the guidance report
+"""
+
+import numpy as np
+import pytest
+
+import rp_handler
+
+
+@pytest.fixture
+def unet_batches(tiny_models):
+    """Batch size of every UNet call"""
+    batches = []
+    hook = tiny_models.unet.register_forward_pre_hook(lambda module, args: batches.append(args[0].shape[0]))
+    yield batches
+    hook.remove()
+
+
+def relight(tiny_models, **kwargs):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    stats = {}
+    tiny_models.process_relight(fg, None, 'a cat', 64, 64, steps=4, highres=False, bg_source='left',
+                                stats=stats, **kwargs)
+    return stats['guidance']
+
+
+def test_cfg_off_skips_negative_prompt_and_unconditional_batch(tiny_models, unet_batches, monkeypatch):
+    prompts = []
+    encode_prompt_inner = rp_handler.encode_prompt_inner
+    monkeypatch.setattr(rp_handler, 'encode_prompt_inner', lambda txt: prompts.append(txt) or encode_prompt_inner(txt))
+
+    assert relight(tiny_models, cfg=1.0) == {'steps': 4, 'guided_steps': 0, 'unet_batch_saving': 0.5}
+    assert prompts == ['a cat, best quality']
+    assert unet_batches == [1] * 4
+
+    # A truncation of 0 turns guidance off as well
+    del prompts[:], unet_batches[:]
+    assert relight(tiny_models, cfg=7.0, cfg_truncation=0.0)['guided_steps'] == 0
+    assert len(prompts) == 1 and unet_batches == [1] * 4
+
+    del prompts[:], unet_batches[:]
+    assert relight(tiny_models, cfg=7.0) == {'steps': 4, 'guided_steps': 4, 'unet_batch_saving': 0.0}
+    assert len(prompts) == 2 and unet_batches == [2] * 4
+
+
+@pytest.mark.parametrize("cfg_truncation, guided_steps", [(0.5, 2), (0.6, 3), (0.25, 1), (1.0, 4)])
+def test_truncation_drops_guidance_after_ceil_steps(tiny_models, unet_batches, cfg_truncation, guided_steps):
+    report = relight(tiny_models, cfg=7.0, cfg_truncation=cfg_truncation)
+    assert report['guided_steps'] == guided_steps
+    assert unet_batches == [2] * guided_steps + [1] * (4 - guided_steps)
+    assert report['unet_batch_saving'] == round(1 - (4 + guided_steps) / 8, 4)
+
+
+def test_guidance_report_in_response(tiny_models):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    request = {'foreground_image': tiny_models.encode_image_to_base64(fg), 'image_width': 64,
+               'image_height': 64, 'steps': 4, 'highres_scale': 1.0}
+    response = tiny_models.handler({'input': {**request, 'cfg_truncation': 0.5}})
+    assert response['guidance'] == {'steps': 4, 'guided_steps': 2, 'unet_batch_saving': 0.25}
+
+    for bad in ('x', -0.1, 1.5, True):
+        response = tiny_models.handler({'input': {**request, 'cfg_truncation': bad}})
+        assert response['status'] == 'error', bad
+        assert response['message'] == "'cfg_truncation' must be a number between 0 and 1"
@@ -34,11 +34,11 @@ def test_handler_locally():
     print("Testing IC-Light Handler Locally...")
     
     # Import handler
-    from rp_handler import handler, initialize_models
+    from rp_handler import handler, initialize_worker
     
     # Initialize models
     print("\nInitializing models...")
-    initialize_models()
+    initialize_worker()
     print("Models initialized!")
     
     # Create test image
@@ -83,11 +83,11 @@ def test_with_real_image(image_path):
     """Test with a real image"""
     print(f"Testing with real image: {image_path}")
     
-    from rp_handler import handler, initialize_models
+    from rp_handler import handler, initialize_worker
     
     # Initialize models
     print("\nInitializing models...")
-    initialize_models()
+    initialize_worker()
     
     # Load image
     img_base64 = image_to_base64(image_path)
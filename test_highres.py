@@ -0,0 +1,42 @@
+"""
+Tests for the single-pass path without the highres stage
+"""
+
+import base64
+import io
+
+import numpy as np
+from PIL import Image
+
+
+def decode(image):
+    return np.array(Image.open(io.BytesIO(base64.b64decode(image))))
+
+
+def test_highres_off_returns_first_pass(tiny_models):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    stats = {}
+    results = tiny_models.process_relight(fg, None, 'a cat', 64, 96, steps=4, highres=False, stats=stats)
+    assert results[0].shape == (96, 64, 3)
+    assert stats['guidance']['steps'] == 4
+
+
+def test_highres_mode_field(tiny_models):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    request = {'foreground_image': tiny_models.encode_image_to_base64(fg), 'image_width': 64,
+               'image_height': 64, 'steps': 2}
+
+    # highres_scale <= 1 turns the highres pass off automatically
+    response = tiny_models.handler({'input': {**request, 'highres_scale': 1.0}})
+    assert response['settings']['highres'] is False
+    assert response['guidance']['steps'] == 2
+    assert decode(response['images'][0]).shape == (64, 64, 3)
+
+    response = tiny_models.handler({'input': {**request, 'highres_scale': 1.0, 'highres': 'on'}})
+    assert response['settings']['highres'] is True
+    assert response['guidance']['steps'] > 2
+
+    response = tiny_models.handler({'input': {**request, 'highres_scale': 2.0, 'highres': 'off'}})
+    assert decode(response['images'][0]).shape == (64, 64, 3)
+
+    assert tiny_models.handler({'input': {**request, 'highres': 'maybe'}})['status'] == 'error'
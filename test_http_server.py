@@ -0,0 +1,126 @@
+"""
+Tests for the local HTTP serving mode, with a stub handler and with the tiny models
+"""
+
+import asyncio
+import socket
+
+import numpy as np
+from aiohttp.test_utils import TestClient, TestServer
+
+from http_server import JobStore, create_app, make_stub_handler
+
+
+def serve(app, scenario):
+    """Run scenario(client) against app on a local port"""
+    async def main():
+        async with TestClient(TestServer(app)) as client:
+            return await scenario(client)
+    return asyncio.run(main())
+
+
+def test_runsync_and_schema_errors():
+    async def scenario(client):
+        response = await client.post('/runsync', json={'input': {'prompt': 'a cat', 'steps': 2}})
+        assert response.status == 200
+        job = await response.json()
+        assert job['status'] == 'COMPLETED'
+        assert job['output'] == {'status': 'success', 'images': [], 'stub': True, 'input_keys': ['prompt', 'steps']}
+        assert job['delayTime'] >= 0 and job['executionTime'] >= 0
+
+        assert (await client.post('/runsync', json={'prompt': 'a cat'})).status == 400
+        assert (await client.post('/run', data='not json')).status == 400
+        assert (await client.get('/status/unknown')).status == 404
+
+    serve(create_app(make_stub_handler()), scenario)
+
+
+def test_async_jobs_queue_behind_concurrency():
+    async def scenario(client):
+        first = await (await client.post('/run', json={'input': {'n': 1}})).json()
+        second = await (await client.post('/run', json={'input': {'n': 2}})).json()
+        assert first['status'] == second['status'] == 'IN_QUEUE'
+        await asyncio.sleep(0.1)
+        statuses = [(await (await client.get(f"/status/{job['id']}")).json())['status'] for job in (first, second)]
+        assert statuses == ['IN_PROGRESS', 'IN_QUEUE']
+        health = await (await client.get('/health')).json()
+        assert health['jobs']['IN_QUEUE'] == 1 and health['worker'] == {'status': 'ready'}
+
+        while (await (await client.get(f"/status/{second['id']}")).json())['status'] != 'COMPLETED':
+            await asyncio.sleep(0.05)
+        done = await (await client.get(f"/status/{second['id']}")).json()
+        # The second job waited for the first one
+        assert done['delayTime'] >= 250
+        assert done['output']['input_keys'] == ['n']
+
+    serve(create_app(make_stub_handler(0.3), concurrency=1), scenario)
+
+
+def test_runsync_timeout_and_failures():
+    async def failing_handler(event):
+        raise RuntimeError("no GPU")
+
+    async def slow(client):
+        job = await (await client.post('/runsync', json={'input': {}})).json()
+        assert job['status'] == 'IN_PROGRESS'
+        await asyncio.sleep(0.4)
+        job = await (await client.get(f"/status/{job['id']}")).json()
+        assert job['status'] == 'COMPLETED'
+
+    async def failing(client):
+        job = await (await client.post('/runsync', json={'input': {}})).json()
+        assert job['status'] == 'FAILED' and job['error'] == 'RuntimeError: no GPU'
+
+    serve(create_app(make_stub_handler(0.3), sync_timeout=0.05), slow)
+    serve(create_app(failing_handler), failing)
+
+
+def test_job_store_expiry_and_limit():
+    async def scenario():
+        store = JobStore(ttl=0, max_jobs=1)
+        job = store.create({})
+        assert store.create({}) is None
+        job['finished'] = 0
+        assert store.get(job['id']) is None
+        assert store.create({}) is not None
+    asyncio.run(scenario())
+
+
+def test_keep_alive():
+    async def scenario(client):
+        request = (f"POST /runsync HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                   f"Content-Length: 13\r\n\r\n{{\"input\": {{}}}}").encode()
+
+        def two_requests_one_connection():
+            with socket.create_connection((client.host, client.port)) as sock:
+                replies = []
+                for _ in range(2):
+                    sock.sendall(request)
+                    data = b''
+                    while b'"COMPLETED"' not in data:
+                        data += sock.recv(65536)
+                    replies.append(data)
+                return replies
+
+        replies = await asyncio.to_thread(two_requests_one_connection)
+        assert all(reply.startswith(b'HTTP/1.1 200') for reply in replies)
+
+    serve(create_app(make_stub_handler()), scenario)
+
+
+def test_serves_real_handler(tiny_models):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    job_input = {'foreground_image': tiny_models.encode_image_to_base64(fg), 'prompt': 'a cat',
+                 'image_width': 64, 'image_height': 64, 'steps': 2, 'highres_scale': 1.0, 'num_samples': 2}
+
+    async def scenario(client):
+        jobs = await asyncio.gather(*[client.post('/runsync', json={'input': job_input}) for _ in range(2)])
+        for response in jobs:
+            job = await response.json()
+            assert job['status'] == 'COMPLETED'
+            assert job['output']['status'] == 'success', job['output']
+            assert len(job['output']['images']) == 2
+        bad = await (await client.post('/runsync', json={'input': {**job_input, 'image_width': 100}})).json()
+        assert bad['status'] == 'COMPLETED' and bad['output']['status'] == 'error'
+
+    serve(create_app(tiny_models.async_handler, concurrency=tiny_models.PIPELINE_CONCURRENCY), scenario)
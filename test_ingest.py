@@ -0,0 +1,69 @@
+"""
+Tests for decoding uploads into pipeline inputs
+"""
+
+import base64
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import rp_handler
+
+
+def to_base64(image, format, **kwargs):
+    buffered = io.BytesIO()
+    image.save(buffered, format=format, **kwargs)
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+def test_modes_are_normalized_to_rgb():
+    rgba = Image.new('RGBA', (40, 30), (255, 0, 0, 255))
+    rgba.paste((0, 0, 255, 0), (0, 0, 20, 30))
+    result = rp_handler.decode_base64_image(to_base64(rgba, 'PNG'))
+    assert result.shape == (30, 40, 3) and result.dtype == np.uint8
+    assert tuple(result[0, 0]) == (127, 127, 127)
+    assert tuple(result[0, 39]) == (255, 0, 0)
+
+    grey = rp_handler.decode_base64_image(to_base64(Image.new('L', (40, 30), 200), 'PNG'))
+    assert grey.shape == (30, 40, 3)
+
+
+def test_exif_orientation_applied():
+    image = Image.new('RGB', (60, 40), (10, 20, 30))
+    exif = image.getexif()
+    exif[0x0112] = 6
+    result = rp_handler.decode_base64_image(to_base64(image, 'JPEG', exif=exif))
+    assert result.shape == (60, 40, 3)
+
+
+def test_jpeg_draft_decode_near_working_size():
+    image = Image.new('RGB', (4000, 3000), (90, 120, 150))
+    data = to_base64(image, 'JPEG')
+    stats = {}
+    result = rp_handler.decode_base64_image(data, lambda w, h: 0.2, stats)
+    # Draft mode scales by 1/2, 1/4 or 1/8 and never below the requested 800x600
+    assert result.shape == (750, 1000, 3)
+    assert stats['original_size'] == [4000, 3000]
+    assert stats['decoded_size'] == [1000, 750]
+    assert stats['decode_seconds'] >= 0
+
+    assert rp_handler.decode_base64_image(data).shape == (3000, 4000, 3)
+
+
+def test_decompression_bomb_rejected(monkeypatch):
+    monkeypatch.setattr(rp_handler, 'MAX_INPUT_PIXELS', 1000)
+    with pytest.raises(rp_handler.RequestError):
+        rp_handler.decode_base64_image(to_base64(Image.new('RGB', (40, 30)), 'PNG'))
+
+
+def test_prepare_job_reports_ingest(tiny_models):
+    fg = Image.new('RGB', (1600, 2000), (200, 100, 50))
+    job = tiny_models.prepare_job({'foreground_image': to_base64(fg, 'JPEG'),
+                                   'image_width': 256, 'image_height': 320, 'highres_scale': 1.0})
+    ingest = job['ingest']['foreground_image']
+    assert ingest['original_size'] == [1600, 2000]
+    assert ingest['decoded_size'] == [800, 1000]
+    # Matting budget 512**2 (fast tier) is the largest need here
+    assert job['input_fg'].shape[:2] == (573, 458)
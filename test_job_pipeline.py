@@ -0,0 +1,98 @@
+"""
+Tests for the staged job pipeline
+Uses stub stages, no models required
+"""
+
+import threading
+import time
+
+from job_pipeline import StagedPipeline
+
+
+def test_results_and_timings():
+    """Each job goes through all three stages in order"""
+    pipeline = StagedPipeline(
+        prepare=lambda x: x + ['prepare'],
+        run=lambda x: x + ['run'],
+        finish=lambda x: x + ['finish'],
+    )
+    futures = [pipeline.submit([i]) for i in range(5)]
+    for i, future in enumerate(futures):
+        result, timings = future.result(timeout=5)
+        assert result == [i, 'prepare', 'run', 'finish']
+        assert set(timings) == {'prepare', 'run', 'finish'}
+    pipeline.shutdown()
+
+
+def test_cpu_stages_overlap_gpu_stage():
+    """Preparing the next job happens while the current one is running"""
+    events = []
+    lock = threading.Lock()
+
+    def record(name, delay):
+        def stage(x):
+            with lock:
+                events.append((name, x, 'start'))
+            time.sleep(delay)
+            with lock:
+                events.append((name, x, 'end'))
+            return x
+        return stage
+
+    pipeline = StagedPipeline(record('prepare', 0.05), record('run', 0.2), record('finish', 0.05), num_cpu_workers=1)
+    futures = [pipeline.submit(i) for i in range(3)]
+    for future in futures:
+        future.result(timeout=5)
+    pipeline.shutdown()
+
+    run_0_start = events.index(('run', 0, 'start'))
+    run_0_end = events.index(('run', 0, 'end'))
+    assert run_0_start < events.index(('prepare', 1, 'end')) < run_0_end
+
+    run_1_start = events.index(('run', 1, 'start'))
+    run_1_end = events.index(('run', 1, 'end'))
+    assert run_1_start < events.index(('finish', 0, 'end')) < run_1_end
+
+
+def test_stage_errors_fail_only_their_job():
+    """An exception in one job is set on its future and the pipeline keeps going"""
+    def run(x):
+        if x == 1:
+            raise ValueError('bad job')
+        return x
+
+    pipeline = StagedPipeline(lambda x: x, run, lambda x: x)
+    futures = [pipeline.submit(i) for i in range(3)]
+    assert futures[0].result(timeout=5)[0] == 0
+    try:
+        futures[1].result(timeout=5)
+        assert False, 'expected the job to fail'
+    except ValueError as e:
+        assert str(e) == 'bad job'
+    assert futures[2].result(timeout=5)[0] == 2
+    pipeline.shutdown()
+
+
+def test_submit_never_blocks():
+    """Submitting more jobs than the stages and queues hold returns at once"""
+    release = threading.Event()
+    pipeline = StagedPipeline(lambda x: x, lambda x: release.wait() and x, lambda x: x,
+                              num_cpu_workers=1, queue_size=1)
+    futures = []
+    submitter = threading.Thread(target=lambda: futures.extend(pipeline.submit(i) for i in range(10)), daemon=True)
+    submitter.start()
+    submitter.join(timeout=2)
+    assert not submitter.is_alive()
+    assert len(futures) == 10
+
+    release.set()
+    assert [future.result(timeout=5)[0] for future in futures] == list(range(10))
+    pipeline.shutdown()
+
+
+if __name__ == "__main__":
+    test_results_and_timings()
+    test_cpu_stages_overlap_gpu_stage()
+    test_stage_errors_fail_only_their_job()
+    test_submit_never_blocks()
+    print("All job pipeline tests passed")
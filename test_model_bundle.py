@@ -0,0 +1,165 @@
+"""
+Tests for the offline model bundle: resumable downloads, manifest verification and
+loading the handler's models from a bundle without the hub
+"""
+
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+import torch
+
+import rp_handler
+from conftest import TinyMatting, make_tiny_components, make_tiny_sd_offsets
+from model_bundle import BundleError, download_file, file_sha256, verify_bundle, write_manifest
+
+PAYLOAD = os.urandom(300_000)
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves PAYLOAD with Range support, the first response is cut off after cut_at bytes"""
+    cut_at = None
+    requests = []
+
+    def do_GET(self):
+        start = 0
+        if 'Range' in self.headers:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+        type(self).requests.append(start)
+        body = PAYLOAD[start:]
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if type(self).cut_at is not None:
+            body, type(self).cut_at = body[:type(self).cut_at], None
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        # The hub's LFS metadata: ETag is the file's SHA-256
+        self.send_response(200)
+        self.send_header('ETag', f'"{hashlib.sha256(PAYLOAD).hexdigest()}"')
+        self.send_header('Content-Length', str(len(PAYLOAD)))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    RangeHandler.requests = []
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/model.safetensors'
+    httpd.shutdown()
+
+
+def test_download_resumes_and_installs_atomically(server, tmp_path):
+    dst = str(tmp_path / 'model.safetensors')
+    RangeHandler.cut_at = 100_000
+    download_file(server, dst, sha256=hashlib.sha256(PAYLOAD).hexdigest(), size=len(PAYLOAD), backoff=0)
+    assert RangeHandler.requests == [0, 100_000]
+    assert open(dst, 'rb').read() == PAYLOAD
+    assert not os.path.exists(dst + '.part')
+
+    # A leftover .part from an interrupted run is resumed
+    dst = str(tmp_path / 'resumed.safetensors')
+    with open(dst + '.part', 'wb') as f:
+        f.write(PAYLOAD[:5000])
+    download_file(server, dst, size=len(PAYLOAD), backoff=0)
+    assert RangeHandler.requests[-1] == 5000
+    assert open(dst, 'rb').read() == PAYLOAD
+
+
+def test_download_rejects_bad_hash(server, tmp_path):
+    dst = str(tmp_path / 'model.safetensors')
+    with pytest.raises(BundleError):
+        download_file(server, dst, sha256='0' * 64, backoff=0)
+    assert not os.path.exists(dst) and not os.path.exists(dst + '.part')
+
+
+def test_ic_light_downloads_are_verified(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(rp_handler, 'IC_LIGHT_URL', server.replace('model.safetensors', '{filename}'))
+    variant = {'filename': 'model.safetensors', 'sha256': None, 'size': None}
+    monkeypatch.setitem(rp_handler.UNET_VARIANTS, 'test', variant)
+
+    # Unpinned: checked against the hub's LFS metadata
+    assert rp_handler.ic_light_checksums('test') == (hashlib.sha256(PAYLOAD).hexdigest(), len(PAYLOAD))
+    path = rp_handler.download_models('test', str(tmp_path))
+    assert open(path, 'rb').read() == PAYLOAD
+
+    variant.update(sha256=hashlib.sha256(PAYLOAD).hexdigest(), size=len(PAYLOAD))
+    RangeHandler.requests = []
+    assert rp_handler.download_models('test', str(tmp_path)) == path
+    assert RangeHandler.requests == []
+
+    # Truncated or corrupt files from an earlier run are downloaded again
+    for broken in (PAYLOAD[:1000], b'x' * len(PAYLOAD)):
+        with open(path, 'wb') as f:
+            f.write(broken)
+        rp_handler.download_models('test', str(tmp_path))
+        assert open(path, 'rb').read() == PAYLOAD
+
+    # A download that does not match the pin is never installed
+    variant.update(sha256='0' * 64)
+    os.remove(path)
+    with pytest.raises(BundleError):
+        rp_handler.download_models('test', str(tmp_path))
+    assert not os.path.exists(path)
+
+
+def test_manifest_detects_corruption(tmp_path):
+    os.makedirs(tmp_path / 'unet')
+    (tmp_path / 'unet' / 'weights.bin').write_bytes(b'a' * 100)
+    (tmp_path / 'offsets.safetensors').write_bytes(b'b' * 50)
+    (tmp_path / 'partial.safetensors.part').write_bytes(b'c')
+    manifest = write_manifest(str(tmp_path))
+    assert set(manifest['files']) == {'unet/weights.bin', 'offsets.safetensors'}
+    assert manifest['files']['unet/weights.bin']['sha256'] == file_sha256(str(tmp_path / 'unet' / 'weights.bin'))
+    verify_bundle(str(tmp_path))
+
+    # Same size, different content: only the hash check notices
+    (tmp_path / 'unet' / 'weights.bin').write_bytes(b'x' * 100)
+    verify_bundle(str(tmp_path), hashes=False)
+    with pytest.raises(BundleError, match='SHA-256'):
+        verify_bundle(str(tmp_path))
+
+    (tmp_path / 'offsets.safetensors').write_bytes(b'b' * 10)
+    with pytest.raises(BundleError, match='offsets.safetensors: 10 bytes'):
+        verify_bundle(str(tmp_path), hashes=False)
+
+
+def test_handler_loads_bundle_offline(tmp_path, monkeypatch):
+    components = make_tiny_components(str(tmp_path))
+    sd_offsets = make_tiny_sd_offsets(components['unet'])
+    bundle_dir = str(tmp_path / 'bundle')
+    manifest = rp_handler.build_model_bundle(bundle_dir, components, sd_offsets)
+    assert 'iclight_sd15_fbc.safetensors' in manifest['files']
+    assert any(path.startswith('unet/') for path in manifest['files'])
+
+    rp_handler.import_model_libraries()
+    monkeypatch.setattr(rp_handler, 'BriaRMBG', TinyMatting)
+    monkeypatch.setattr(rp_handler, 'MODEL_BUNDLE_DIR', bundle_dir)
+    assert rp_handler.resolve_model_bundle() == bundle_dir
+    loaded = rp_handler.load_pretrained_models(bundle_dir)
+    for name in ('text_encoder', 'vae', 'unet', 'rmbg'):
+        expected = components[name].state_dict()
+        for key, value in loaded[name].state_dict().items():
+            assert torch.equal(value, expected[key]), (name, key)
+    assert loaded['tokenizer'].get_vocab() == components['tokenizer'].get_vocab()
+
+    # Corrupt bundles fail startup instead of falling back to the hub
+    with open(os.path.join(bundle_dir, 'iclight_sd15_fc.safetensors'), 'ab') as f:
+        f.write(b'\0')
+    with pytest.raises(BundleError):
+        rp_handler.resolve_model_bundle()
+
+    monkeypatch.setattr(rp_handler, 'MODEL_BUNDLE_DIR', str(tmp_path / 'missing'))
+    assert rp_handler.resolve_model_bundle() is None
+    monkeypatch.setattr(rp_handler, 'MODEL_BUNDLE', 'require')
+    with pytest.raises(BundleError):
+        rp_handler.resolve_model_bundle()
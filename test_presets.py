@@ -0,0 +1,60 @@
+"""
+Tests for sampling presets, per-sampler default steps and the resolved settings in responses
+"""
+
+import numpy as np
+import pytest
+
+import rp_handler
+from rp_handler import PRESETS, SAMPLER_DEFAULT_STEPS, RequestError, resolve_sampling_params
+
+
+def test_preset_values():
+    for name, preset in PRESETS.items():
+        params = resolve_sampling_params({'preset': name})
+        assert {key: params[key] for key in preset} == preset
+        assert params['highres'] == (preset['highres_scale'] > 1.0)
+
+
+def test_explicit_fields_beat_the_preset():
+    params = resolve_sampling_params({'preset': 'quality', 'sampler': 'ddim', 'steps': 5, 'highres_scale': 1.25,
+                                      'highres_denoise': 0.3})
+    assert params == {'sampler': 'ddim', 'steps': 5, 'highres': True, 'highres_scale': 1.25, 'highres_denoise': 0.3}
+
+    # A sampler picked over the preset keeps the preset's step count
+    assert resolve_sampling_params({'preset': 'preview', 'sampler': 'euler_a'})['steps'] == PRESETS['preview']['steps']
+
+
+def test_sampler_default_steps():
+    for sampler, steps in SAMPLER_DEFAULT_STEPS.items():
+        assert resolve_sampling_params({'sampler': sampler})['steps'] == steps
+    params = resolve_sampling_params({})
+    assert params['sampler'] == rp_handler.DEFAULT_SAMPLER
+    assert params['steps'] == SAMPLER_DEFAULT_STEPS[rp_handler.DEFAULT_SAMPLER]
+
+
+def test_unknown_preset_or_sampler():
+    with pytest.raises(RequestError, match="Unknown preset 'ultra', expected one of: preview, fast"):
+        resolve_sampling_params({'preset': 'ultra'})
+    with pytest.raises(RequestError, match="Unknown sampler 'heun'"):
+        resolve_sampling_params({'preset': 'fast', 'sampler': 'heun'})
+
+
+def test_response_echoes_resolved_settings(tiny_models):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    request = {'foreground_image': tiny_models.encode_image_to_base64(fg), 'image_width': 64, 'image_height': 64}
+
+    response = tiny_models.handler({'input': {**request, 'preset': 'preview'}})
+    assert response['status'] == 'success', response
+    assert {key: response['settings'][key] for key in PRESETS['preview']} == PRESETS['preview']
+    assert response['settings']['highres'] is False
+    assert response['guidance']['steps'] == PRESETS['preview']['steps']
+
+    response = tiny_models.handler({'input': {**request, 'preset': 'preview', 'sampler': 'ddim', 'steps': 2}})
+    assert response['settings']['sampler'] == 'ddim'
+    assert response['settings']['steps'] == 2
+    assert response['guidance']['steps'] == 2
+
+    response = tiny_models.handler({'input': {**request, 'preset': 'ultra'}})
+    assert response['status'] == 'error'
+    assert response['message'].startswith("Unknown preset 'ultra'")
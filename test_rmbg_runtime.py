@@ -0,0 +1,98 @@
+"""
+Tests for the exported matting runtime, CPU matting workers and precomputed alphas
+"""
+
+import base64
+import io
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from briarmbg import BriaRMBG
+from conftest import TinyMatting
+from rmbg_runtime import MattingWorkerPool, export_rmbg, load_rmbg
+
+
+def to_base64(array):
+    buffered = io.BytesIO()
+    Image.fromarray(array).save(buffered, format='PNG')
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+def test_torchscript_export_parity(tmp_path):
+    torch.manual_seed(0)
+    model = BriaRMBG().eval().fuse_batchnorm()
+    path = export_rmbg(model, str(tmp_path / 'rmbg.pt'), example_size=(128, 96))
+    exported = load_rmbg(path)
+    # Traced with one size, run with another
+    x = torch.rand(2, 3, 160, 192)
+    with torch.inference_mode():
+        torch.testing.assert_close(exported(x), model.predict(x), atol=1e-5, rtol=0)
+
+
+def test_worker_pool_matches_eager(tmp_path):
+    torch.manual_seed(0)
+    model = TinyMatting().eval()
+    path = export_rmbg(model, str(tmp_path / 'tiny.pt'), example_size=(64, 64))
+    pool = MattingWorkerPool(path, num_workers=1)
+    try:
+        feed = torch.rand(1, 3, 64, 128)
+        alpha = pool.submit(feed.numpy()).result()
+        with torch.inference_mode():
+            np.testing.assert_allclose(alpha, model.predict(feed).numpy(), atol=1e-6)
+    finally:
+        pool.shutdown()
+
+
+def test_matte_only_and_foreground_alpha(tiny_models, monkeypatch):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    response = tiny_models.handler({'input': {'foreground_image': to_base64(fg), 'mode': 'matte_only'}})
+    assert response['status'] == 'success', response
+    alpha = np.array(Image.open(io.BytesIO(base64.b64decode(response['images'][0]))))
+    _, expected = tiny_models.run_rmbg(fg, resolution=response['settings']['matting_resolution'])
+    assert alpha.shape == (80, 64)
+    assert np.abs(alpha.astype(int) - np.round(expected[..., 0] * 255).astype(int)).max() <= 1
+
+    def no_matting(*args, **kwargs):
+        raise AssertionError("run_rmbg called despite foreground_alpha")
+    monkeypatch.setattr(tiny_models, 'run_rmbg', no_matting)
+    response = tiny_models.handler({'input': {
+        'foreground_image': to_base64(fg), 'foreground_alpha': to_base64(alpha),
+        'image_width': 64, 'image_height': 64, 'steps': 2, 'highres_scale': 1.0}})
+    assert response['status'] == 'success', response
+
+
+def test_foreground_alpha_channels_and_aspect_ratio(tiny_models):
+    rng = np.random.RandomState(2)
+    fg = (rng.rand(80, 64, 3) * 255).astype(np.uint8)
+    alpha = (rng.rand(80, 64) * 255).astype(np.uint8)
+    colour = (rng.rand(80, 64, 3) * 255).astype(np.uint8)
+    request = {'foreground_image': to_base64(fg), 'image_width': 64, 'image_height': 64, 'highres_scale': 1.0}
+
+    # The alpha channel is the matte, whatever the colour channels hold
+    for matte in (alpha, np.dstack([colour[..., 0], alpha]), np.dstack([colour, alpha]),
+                  np.dstack([alpha, alpha, alpha, np.full_like(alpha, 255)])):
+        job = tiny_models.prepare_job({**request, 'foreground_alpha': to_base64(matte)})
+        assert job['foreground_alpha'].shape == (80, 64, 1)
+        np.testing.assert_allclose(job['foreground_alpha'][..., 0], alpha / 255.0, atol=1e-6)
+
+    # Larger mattes with the same aspect ratio are scaled, others are rejected
+    job = tiny_models.prepare_job({**request, 'foreground_alpha': to_base64(np.kron(alpha, np.ones((2, 2), np.uint8)))})
+    assert job['foreground_alpha'].shape == (80, 64, 1)
+    with pytest.raises(tiny_models.RequestError, match="aspect ratio"):
+        tiny_models.prepare_job({**request, 'foreground_alpha': to_base64(alpha[:64])})
+
+
+def test_prepare_job_uses_cpu_workers(tiny_models, tmp_path, monkeypatch):
+    path = export_rmbg(tiny_models.rmbg, str(tmp_path / 'tiny.pt'), example_size=(64, 64))
+    pool = MattingWorkerPool(path, num_workers=1)
+    monkeypatch.setattr(tiny_models, 'matting_pool', pool)
+    try:
+        fg = (np.random.RandomState(1).rand(80, 64, 3) * 255).astype(np.uint8)
+        job = tiny_models.prepare_job({'foreground_image': to_base64(fg), 'mode': 'matte_only'})
+        _, expected = tiny_models.run_rmbg(fg, resolution=job['matting_resolution'])
+        np.testing.assert_allclose(job['foreground_alpha'], expected, atol=1e-5)
+    finally:
+        pool.shutdown()
@@ -0,0 +1,30 @@
+"""
+Tests for per-sample seeds
+"""
+
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("sampler", ['dpmpp_2m_sde_karras', 'euler_a'])
+def test_sample_reproducible_at_any_batch_size(tiny_models, sampler):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    kwargs = dict(image_width=64, image_height=64, steps=4, sampler=sampler, bg_source='left')
+    batch = tiny_models.process_relight(fg, None, 'a cat', seeds=[5, 7, 9], **kwargs)
+    alone = tiny_models.process_relight(fg, None, 'a cat', seeds=[7], **kwargs)
+    assert len(batch) == 3 and len(alone) == 1
+    assert np.abs(batch[1].astype(int) - alone[0].astype(int)).max() <= 2
+    assert np.abs(batch[0].astype(int) - batch[1].astype(int)).max() > 2
+
+
+def test_seeds_field(tiny_models):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    request = {'foreground_image': tiny_models.encode_image_to_base64(fg), 'image_width': 64,
+               'image_height': 64, 'steps': 2, 'highres_scale': 1.0, 'seeds': [3, 4]}
+    response = tiny_models.handler({'input': request})
+    assert response['status'] == 'success', response
+    assert len(response['images']) == 2
+    assert response['settings']['seeds'] == [3, 4]
+
+    for bad in ({'seeds': []}, {'seeds': [1, 'x']}, {'seeds': [1, 2], 'num_samples': 3}):
+        assert tiny_models.handler({'input': {**request, **bad}})['status'] == 'error'
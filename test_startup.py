@@ -0,0 +1,96 @@
+"""
+Tests for fast import, background initialization and readiness signalling
+"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+IMPORTED = """
+import sys, rp_handler
+print([name for name in ('diffusers', 'transformers', 'runpod') if name in sys.modules])
+"""
+
+# Runs with run_tiny_worker so the tiny_models session fixture keeps its worker state
+BACKGROUND_INIT = """
+import threading, time
+
+rp_handler.INIT_WARMUP_SIZE = 64
+if sys.argv[1] == 'fail':
+    del sd_offsets['fc']
+
+# Hold initialization until the early job is queued
+gate = threading.Event()
+initialize_models = rp_handler.initialize_models
+def gated_initialize_models(*args):
+    gate.wait()
+    initialize_models(*args)
+rp_handler.initialize_models = gated_initialize_models
+
+result = {}
+rp_handler.start_worker_initialization(components, sd_offsets, torch.device('cpu'))
+result['early_status'] = rp_handler.handler({'input': {'health_check': True}})['worker']['status']
+result['early_concurrency'] = rp_handler.worker_concurrency(1)
+
+job = {'input': {'foreground_image': rp_handler.encode_image_to_base64(fg), 'prompt': 'a cat',
+                 'image_width': 64, 'image_height': 64, 'steps': 2, 'highres_scale': 1.0}}
+responses = []
+thread = threading.Thread(target=lambda: responses.append(rp_handler.handler(job)))
+thread.start()
+time.sleep(0.5)
+result['answered_early'] = bool(responses)
+gate.set()
+thread.join()
+
+result['job'] = {key: responses[0][key] for key in ('status', 'message') if key in responses[0]}
+result['images'] = len(responses[0].get('images', []))
+result['worker'] = rp_handler.get_worker_status()['worker']
+result['concurrency'] = rp_handler.worker_concurrency(1)
+result['pipeline_concurrency'] = rp_handler.PIPELINE_CONCURRENCY
+report(result)
+"""
+
+
+def run(script, *args):
+    output = subprocess.run([sys.executable, '-c', script, *args], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def test_import_defers_model_libraries():
+    assert run(IMPORTED) == []
+
+
+def test_early_job_waits_for_background_init(run_tiny_worker):
+    result = run_tiny_worker(BACKGROUND_INIT, args=['ok'])
+    assert result['early_status'] == 'initializing'
+    assert result['early_concurrency'] == 1
+    assert not result['answered_early']
+    assert result['job'] == {'status': 'success'}
+    assert result['images'] == 1
+
+    worker = result['worker']
+    assert worker['status'] == 'ready' and worker['error'] is None
+    assert set(worker['timings']) == {'imports', 'models', 'warmup'}
+    assert worker['time_to_registered'] <= worker['time_to_ready']
+    assert result['concurrency'] == result['pipeline_concurrency']
+
+
+def test_failed_init_fails_queued_jobs(run_tiny_worker):
+    result = run_tiny_worker(BACKGROUND_INIT, args=['fail'])
+    assert result['job']['status'] == 'error'
+    assert result['job']['message'].startswith('Worker initialization failed: KeyError')
+    assert result['worker']['status'] == 'failed'
+    assert result['concurrency'] == 1
+
+
+def test_jobs_before_init_are_rejected(tiny_models, monkeypatch):
+    monkeypatch.setitem(tiny_models.worker_status, 'status', 'not_started')
+    job = {'input': {'prompt': 'a cat'}}
+    assert tiny_models.handler(job) == {'status': 'error', 'message': 'Worker not initialized'}
+    assert asyncio.run(tiny_models.async_handler(job)) == {'status': 'error', 'message': 'Worker not initialized'}
+    assert tiny_models.handler({'input': {'health_check': True}})['worker']['status'] == 'not_started'
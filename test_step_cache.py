@@ -0,0 +1,56 @@
+"""
+Tests for DeepCache-style step feature caching
+"""
+
+import numpy as np
+import pytest
+import torch
+
+from step_cache import StepFeatureCache, unet_forward
+
+
+@pytest.mark.parametrize("branch, size", [(0, (8, 8)), (1, (8, 8)), (0, (9, 10))])
+def test_cheap_step_matches_full_step(tiny_models, branch, size):
+    unet = tiny_models.unet
+    generator = torch.Generator().manual_seed(0)
+    sample = torch.randn(2, 12, *size, generator=generator)
+    context = torch.randn(2, 77, 32, generator=generator)
+    with tiny_models.unet_variants.use('fbc'), torch.inference_mode():
+        expected = unet(sample, 10, context).sample
+        full, feature = unet_forward(unet, sample, 10, context, branch)
+        # With the feature of the same step, the shallow path alone rebuilds the output
+        cheap, reused = unet_forward(unet, sample, 10, context, branch, cached=feature)
+    torch.testing.assert_close(full, expected, atol=0, rtol=0)
+    torch.testing.assert_close(cheap, expected, atol=0, rtol=0)
+    assert reused is feature
+
+
+def test_step_cache_schedule_and_cfg_truncation(tiny_models):
+    generator = torch.Generator().manual_seed(0)
+    concat_conds = torch.randn(1, 8, 8, 8, generator=generator)
+    stats = {}
+    with tiny_models.unet_variants.use('fbc'), torch.inference_mode():
+        view = tiny_models.ConcatCondUNet(tiny_models.unet, concat_conds, StepFeatureCache(3, stats=stats))
+        # Two guided steps, then the conditional-only batch after CFG truncation
+        for batch in (2, 2, 1, 1, 1):
+            sample = torch.randn(batch, 4, 8, 8, generator=generator)
+            context = torch.randn(batch, 77, 32, generator=generator)
+            output = view(sample, 10, context, return_dict=False)[0]
+            assert output.shape == (batch, 4, 8, 8)
+    assert stats == {'full_steps': 2, 'cached_steps': 3}
+
+
+def test_step_cache_interval_field(tiny_models):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    request = {'foreground_image': tiny_models.encode_image_to_base64(fg), 'image_width': 64,
+               'image_height': 64, 'steps': 4, 'highres_scale': 1.0}
+    response = tiny_models.handler({'input': {**request, 'step_cache_interval': 2}})
+    assert response['status'] == 'success', response
+    assert response['settings']['step_cache_interval'] == 2
+    assert response['step_cache'] == {'interval': 2, 'full_steps': 2, 'cached_steps': 2}
+
+    response = tiny_models.handler({'input': request})
+    assert 'step_cache' not in response
+    for bad in (0, 11, 1.5):
+        response = tiny_models.handler({'input': {**request, 'step_cache_interval': bad}})
+        assert response['status'] == 'error'
@@ -0,0 +1,65 @@
+"""
+Tests for token merging (ToMe) in UNet self-attention
+"""
+
+import numpy as np
+import torch
+
+from attention_processors import TokenMergingAttnProcessor2_0, bipartite_soft_matching_2d, token_merging
+
+
+def test_merging_duplicate_tokens_is_lossless():
+    generator = torch.Generator().manual_seed(0)
+    # Every 2x2 cell holds four copies of one token, so merging 3 of 4 loses nothing
+    cells = torch.randn(2, 4, 4, 16, generator=generator)
+    grid = cells.repeat_interleave(2, dim=1).repeat_interleave(2, dim=2)
+    x = grid.reshape(2, 64, 16)
+
+    merge, unmerge = bipartite_soft_matching_2d(x, 8, 8, r=48)
+    merged = merge(x)
+    assert merged.shape == (2, 16, 16)
+    torch.testing.assert_close(unmerge(merged), x)
+
+    merge, unmerge = bipartite_soft_matching_2d(x, 8, 8, r=0)
+    assert merge(x) is x and unmerge(x) is x
+
+
+def test_odd_grid_keeps_every_token():
+    x = torch.randn(1, 5 * 7, 8, generator=torch.Generator().manual_seed(1))
+    merge, unmerge = bipartite_soft_matching_2d(x, 7, 5, r=10)
+    assert merge(x).shape == (1, 25, 8)
+    assert unmerge(merge(x)).shape == x.shape
+
+
+def test_token_merging_in_unet(tiny_models):
+    unet = tiny_models.unet
+    assert all(isinstance(p, TokenMergingAttnProcessor2_0) for p in unet.attn_processors.values())
+    generator = torch.Generator().manual_seed(0)
+    sample = torch.randn(2, 12, 16, 16, generator=generator)
+    context = torch.randn(2, 77, 32, generator=generator)
+
+    with tiny_models.unet_variants.use('fbc'), torch.inference_mode():
+        reference = unet(sample, 10, context).sample
+        # The tiny UNet only has attention one level down
+        with token_merging(0.0, 16, 16, max_downsample=2):
+            torch.testing.assert_close(unet(sample, 10, context).sample, reference, atol=0, rtol=0)
+        with token_merging(0.5, 16, 16, max_downsample=1):
+            torch.testing.assert_close(unet(sample, 10, context).sample, reference, atol=0, rtol=0)
+        with token_merging(0.5, 16, 16, max_downsample=2):
+            merged = unet(sample, 10, context).sample
+    assert not torch.equal(merged, reference)
+    similarity = torch.nn.functional.cosine_similarity(merged.flatten(), reference.flatten(), dim=0)
+    assert similarity > 0.9
+
+
+def test_token_merging_ratio_field(tiny_models, monkeypatch):
+    monkeypatch.setattr(tiny_models, 'TOKEN_MERGING_MAX_DOWNSAMPLE', 2)
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    request = {'foreground_image': tiny_models.encode_image_to_base64(fg), 'image_width': 64,
+               'image_height': 64, 'steps': 2, 'highres_scale': 2.0}
+    response = tiny_models.handler({'input': {**request, 'token_merging_ratio': 0.5}})
+    assert response['status'] == 'success', response
+    assert response['settings']['token_merging_ratio'] == 0.5
+    for bad in (-0.1, 0.9, 'half'):
+        response = tiny_models.handler({'input': {**request, 'token_merging_ratio': bad}})
+        assert response['status'] == 'error'
@@ -0,0 +1,111 @@
+"""
+Tests for switching IC-Light UNet variants in place
+"""
+
+import numpy as np
+import pytest
+import torch
+
+from conftest import make_tiny_fc_offset
+
+
+def snapshot(unet):
+    return {k: v.clone() for k, v in unet.state_dict().items()}
+
+
+def test_switching_restores_weights_exactly(tiny_models):
+    registry = tiny_models.unet_variants
+    unet = tiny_models.unet
+    registry.activate('fbc')
+    fbc_weights = snapshot(unet)
+
+    with registry.use('fc') as info:
+        assert info['model'] == 'fc'
+        assert unet.conv_in.in_channels == 8
+        fc_weights = snapshot(unet)
+    assert any(not torch.equal(fbc_weights[k], fc_weights[k])
+               for k in fbc_weights if k.startswith('up_blocks.0.'))
+
+    for _ in range(3):
+        registry.activate('fbc')
+        registry.activate('fc')
+    registry.activate('fbc')
+    assert unet.conv_in.in_channels == 12
+    for k, v in snapshot(unet).items():
+        assert torch.equal(v, fbc_weights[k]), k
+
+
+def test_merged_weights_match_offsets(tiny_models):
+    """Each variant equals base + offset, as merging the IC-Light weights directly would give"""
+    components_unet = tiny_models.unet
+    registry = tiny_models.unet_variants
+    registry.activate('fbc')
+    base = snapshot(components_unet)
+    with registry.use('fc'):
+        merged = snapshot(components_unet)
+    offset = make_tiny_fc_offset(components_unet)
+    for k in merged:
+        if k.startswith('up_blocks.0.'):
+            assert torch.equal(merged[k], base[k] + offset[k]), k
+
+
+def test_host_copies_cover_only_changed_tensors(tiny_models):
+    """fc changes up_blocks.0, so both variants hold exactly those tensors and nothing else"""
+    registry = tiny_models.unet_variants
+    changed = {k for k in tiny_models.unet.state_dict() if k.startswith('up_blocks.0.')}
+    assert set(registry._weights['fc']) == set(registry._weights['fbc']) == changed
+    per_variant = sum(tiny_models.unet.state_dict()[k].numel() * 4 for k in changed)
+    assert registry.stats['host_bytes'] == 2 * per_variant
+
+    with pytest.raises(RuntimeError):
+        registry.register('late', make_tiny_fc_offset(tiny_models.unet), 8)
+
+
+def test_unknown_variant(tiny_models):
+    with pytest.raises(KeyError):
+        with tiny_models.unet_variants.use('nope'):
+            pass
+
+
+def test_fc_relight_and_model_field(tiny_models):
+    fg = (np.random.RandomState(0).rand(80, 64, 3) * 255).astype(np.uint8)
+    stats = {}
+    results = tiny_models.process_relight(fg, None, 'a cat', 64, 64, steps=4, cfg=2.0,
+                                          bg_source='left', model='fc', stats=stats)
+    assert len(results) == 1 and results[0].shape == (128, 128, 3)
+    assert stats['model']['model'] == 'fc'
+
+    event = {'input': {'foreground_image': tiny_models.encode_image_to_base64(fg), 'model': 'fc',
+                       'bg_source': 'none', 'image_width': 64, 'image_height': 64,
+                       'steps': 2, 'highres_scale': 1.0}}
+    response = tiny_models.handler(event)
+    assert response['status'] == 'success', response
+    assert response['settings']['model'] == 'fc'
+
+    for bad in ({'model': 'xyz'}, {'model': 'fc', 'bg_source': 'upload'},
+                {'model': 'fc', 'mode': 'normal'}):
+        response = tiny_models.handler({'input': {**event['input'], **bad}})
+        assert response['status'] == 'error'
+
+    for bad in (0, -0.5, 1.5, 'x'):
+        response = tiny_models.handler({'input': {**event['input'], 'bg_source': 'left', 'lowres_denoise': bad}})
+        assert response['status'] == 'error', bad
+        assert response['message'] == "'lowres_denoise' must be a number above 0 and at most 1"
+
+
+@pytest.mark.parametrize("variant, cond_channels", [('fbc', 8), ('fc', 4)])
+def test_precomputed_conv_in_matches_concat(tiny_models, variant, cond_channels):
+    unet = tiny_models.unet
+    generator = torch.Generator().manual_seed(0)
+    concat_conds = torch.randn(1, cond_channels, 8, 8, generator=generator)
+    with tiny_models.unet_variants.use(variant), torch.inference_mode():
+        view = tiny_models.ConcatCondUNet(unet, concat_conds)
+        # Unconditional + conditional batch, then the conditional-only layout after CFG truncation
+        for batch in (2, 1, 2):
+            sample = torch.randn(batch, 4, 8, 8, generator=generator)
+            context = torch.randn(batch, 77, 32, generator=generator)
+            full = torch.cat([sample, concat_conds.repeat(batch, 1, 1, 1)], dim=1)
+            expected = unet(full, 10, context).sample
+            result = view(sample, 10, context).sample
+            torch.testing.assert_close(result, expected, atol=1e-5, rtol=1e-5)
+        assert sorted(view._cond_terms) == [1, 2]
@@ -0,0 +1,161 @@
+"""
+IC-Light UNet variants sharing one base UNet
+Each variant's merged weights are kept in (pinned) host memory in the working dtype and
+copied into the live UNet parameters on a switch, so the device holds the UNet once and
+switching is exact no matter how often the worker switches. conv_in differs in channel
+layout between variants and is swapped whole.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+import torch.nn.functional as F
+
+
+_conditioning = threading.local()
+
+
+class ConcatCondConv2d(torch.nn.Conv2d):
+    """
+    IC-Light conv_in that can take the noisy latent channels alone
+
+    conv_in is linear, so the concatenated conditioning channels add the same term at
+    every denoising step. condition_term() computes that term (bias included) once;
+    while it is active on the calling thread, forward convolves only the latent
+    channels and adds it. Full-width inputs still run as a plain convolution.
+    """
+
+    def __init__(self, latent_channels, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latent_channels = latent_channels
+
+    def _conv(self, x, weight, bias):
+        return F.conv2d(x, weight, bias, self.stride, self.padding, self.dilation, self.groups)
+
+    def condition_term(self, c_concat):
+        """Conditioning channels' contribution to the output, plus the bias"""
+        return self._conv(c_concat, self.weight[:, self.latent_channels:].contiguous(), self.bias)
+
+    @contextmanager
+    def conditioned(self, term):
+        """Make forward add term to the convolved latent channels on this thread"""
+        _conditioning.state = (self.weight[:, :self.latent_channels].contiguous(), term)
+        try:
+            yield
+        finally:
+            _conditioning.state = None
+
+    def forward(self, x):
+        state = getattr(_conditioning, 'state', None)
+        if state is None or x.shape[1] != self.latent_channels:
+            return super().forward(x)
+        weight, term = state
+        return self._conv(x, weight, None) + term
+
+
+class UNetVariantRegistry:
+    """
+    Holds one base UNet and switches it between registered variants in place
+
+    Every variant keeps host copies of the tensors that any variant changes, pinned when
+    CUDA is available. A switch copies them into the live parameters, so no variant weights
+    stay on the device: device memory is one UNet plus each variant's conv_in, host memory
+    is one copy of the changed tensors per variant. Requests for the active variant can
+    run concurrently, a switch waits until the UNet is idle.
+    """
+
+    def __init__(self, unet, dtype):
+        self.unet = unet
+        self.dtype = dtype
+        self.device = torch.device('cpu')
+        self.active = None
+        self.stats = {'switches': 0, 'last_switch_seconds': 0.0, 'host_bytes': 0}
+        self._base_conv_in = unet.conv_in
+        self._conv_ins = {}
+        self._weights = {}
+        self._cond = threading.Condition()
+        self._users = 0
+
+    def _host_copy(self, tensor):
+        tensor = tensor.to(self.dtype, memory_format=torch.contiguous_format, copy=True)
+        self.stats['host_bytes'] += tensor.numel() * tensor.element_size()
+        return tensor.pin_memory() if torch.cuda.is_available() else tensor
+
+    @torch.no_grad()
+    def register(self, name, sd_offset, in_channels):
+        """Register a variant from IC-Light offsets against the float32 base UNet"""
+        if self.active is not None:
+            raise RuntimeError("Register every UNet variant before activating one")
+        base_conv_in = self._base_conv_in
+        conv_in = ConcatCondConv2d(base_conv_in.in_channels,
+                                   in_channels, base_conv_in.out_channels,
+                                   base_conv_in.kernel_size,
+                                   base_conv_in.stride,
+                                   base_conv_in.padding)
+        conv_in.weight.zero_()
+        conv_in.weight[:, :base_conv_in.in_channels].copy_(base_conv_in.weight)
+        conv_in.weight.add_(sd_offset['conv_in.weight'])
+        conv_in.bias.copy_(base_conv_in.bias + sd_offset['conv_in.bias'])
+        self._conv_ins[name] = conv_in.to(device=self.device, dtype=self.dtype)
+
+        state = self.unet.state_dict()
+        weights = {}
+        for k, base in state.items():
+            if k.startswith('conv_in.'):
+                continue
+            merged = (base.float() + sd_offset[k].float()).to(self.dtype)
+            # Untouched tensors need no copy unless another variant changes them
+            if not torch.equal(merged, base.to(self.dtype)) or any(k in other for other in self._weights.values()):
+                weights[k] = self._host_copy(merged)
+        # Earlier variants restore the base value of tensors only this one changes
+        for other in self._weights.values():
+            for k in weights.keys() - other.keys():
+                other[k] = self._host_copy(state[k])
+        self._weights[name] = weights
+
+    def to(self, device, memory_format=torch.preserve_format):
+        """Move the variant conv_in layers to the UNet's device and memory format"""
+        self.device = torch.device(device)
+        self._conv_ins = {name: conv_in.to(device=self.device, memory_format=memory_format)
+                          for name, conv_in in self._conv_ins.items()}
+        return self
+
+    @torch.no_grad()
+    def _switch(self, name):
+        start = time.perf_counter()
+        state = self.unet.state_dict()
+        for k, weight in self._weights[name].items():
+            state[k].copy_(weight, non_blocking=True)
+        self.unet.conv_in = self._conv_ins[name]
+        self.active = name
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        elapsed = time.perf_counter() - start
+        self.stats['switches'] += 1
+        self.stats['last_switch_seconds'] = elapsed
+        print(f"Switched UNet to '{name}' in {elapsed:.3f}s")
+        return elapsed
+
+    def activate(self, name):
+        """Switch to a variant outside of any request"""
+        with self.use(name):
+            pass
+
+    @contextmanager
+    def use(self, name):
+        """Hold the UNet as variant name for the duration of a request, yields switch info"""
+        if name not in self._weights:
+            raise KeyError(f"Unknown UNet variant '{name}'")
+        with self._cond:
+            while self.active != name and self._users > 0:
+                self._cond.wait()
+            switch_seconds = self._switch(name) if self.active != name else 0.0
+            self._users += 1
+        try:
+            yield {'model': name, 'switch_seconds': round(switch_seconds, 4)}
+        finally:
+            with self._cond:
+                self._users -= 1
+                self._cond.notify_all()